@@ -1,14 +1,21 @@
-import random
-import re
 import tkinter as tk
 from tkinter import ttk, scrolledtext, Menu, filedialog, messagebox
-from collections import defaultdict
+import tkinter.font as tkfont
 import json
 from datetime import datetime
 import os
+import random
+from collections import OrderedDict
 from pathlib import Path
+import sys
 import time
 import threading
+import queue
+
+# The Markov engine lives in muse_engine so it can be used without Tk
+from muse_engine import poet_files, poetic_devices, rhyme_schemes, generate_poem, model_registry
+from muse_store import PoemStore
+from muse_trace import tracer, format_run
 
 # Move the SHORTCUTS dictionary to the top with other constants
 SHORTCUTS = {
@@ -22,6 +29,165 @@ SHORTCUTS = {
     '<Escape>': 'Clear'
 }
 
+# Delay after the last keystroke before the poem browser searches
+SEARCH_DEBOUNCE_MS = 150
+
+# The browser's poem list fetches display rows from the poem store this many at a time,
+# keeps this many pages cached and loads this many rows beyond the visible ones
+POEM_LIST_PAGE_SIZE = 100
+POEM_LIST_CACHED_PAGES = 8
+POEM_LIST_BUFFER_ROWS = 20
+
+class PagedPoemList(tk.Frame):
+    """
+    Virtualized poem list for the browser: a Listbox that only ever holds the rows in view,
+    with a scrollbar that spans the whole library. The full ordering is just a sequence of
+    poem ids (for broad searches, one that finds them as they're read); display rows are
+    fetched from the poem store a page at a time as the list scrolls, so opening and
+    scrolling cost the same however many poems are saved. The selection is tracked by
+    poem id, so it survives scrolling, re-sorting and refreshes.
+    """
+    def __init__(self, parent, font, on_select, **listbox_options):
+        super().__init__(parent, bg=xp_colors['frame_bg'])
+        self.on_select = on_select
+        self.poem_ids = []
+        self.first = 0  # Position of the top row in view
+        self.selected_id = None
+        self._positions = None  # poem id -> position, built when first needed
+        self._pages = OrderedDict()  # page number -> {poem id: display text}, least recent first
+        
+        self.listbox = tk.Listbox(self, font=font, selectmode=tk.SINGLE,
+                                  exportselection=False, **listbox_options)
+        self.scrollbar = ttk.Scrollbar(self, orient="vertical", command=self.yview)
+        self.listbox.pack(side=tk.LEFT, fill="both")
+        self.scrollbar.pack(side=tk.RIGHT, fill="y")
+        
+        # Listbox line height, as Tk computes it
+        self._row_height = (tkfont.Font(font=font).metrics('linespace') + 1
+                            + 2 * self.tk.getint(self.listbox.cget('selectborderwidth')))
+        
+        self.listbox.bind('<<ListboxSelect>>', self._on_listbox_select)
+        self.listbox.bind('<Configure>', lambda e: self.render())
+        for sequence in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            self.listbox.bind(sequence, self._on_mousewheel)
+        self.listbox.bind('<Up>', lambda e: self.move_selection(-1))
+        self.listbox.bind('<Down>', lambda e: self.move_selection(1))
+        self.listbox.bind('<Prior>', lambda e: self.move_selection(-self.visible_rows()))
+        self.listbox.bind('<Next>', lambda e: self.move_selection(self.visible_rows()))
+    
+    @staticmethod
+    def format_row(row):
+        """List text for a poem store summary row"""
+        date = datetime.strptime(row['date'], "%Y-%m-%d %H:%M:%S")
+        star = "⭐ " if row['favorite'] else "   "
+        return f"{star}{date.strftime('%Y-%m-%d %H:%M')} │ {row['poet']}"
+    
+    def set_ids(self, poem_ids, keep_position=False):
+        """Show these poems (ids in display order); the selection is kept if still listed"""
+        self.poem_ids = poem_ids
+        self._positions = None
+        self._pages.clear()
+        if not keep_position:
+            self.first = 0
+        if self.selected_id is not None and self.selected_id not in self.poem_ids:
+            self.selected_id = None
+        self.render()
+    
+    def position_of(self, poem_id):
+        """Position of a poem in the list, or None"""
+        # Usually the poem is in view; only look further (listing every poem) when it isn't
+        visible = self.poem_ids[self.first:self.first + self.visible_rows()]
+        if poem_id in visible:
+            return self.first + visible.index(poem_id)
+        if self._positions is None:
+            self._positions = {poem_id: i for i, poem_id in enumerate(self.poem_ids)}
+        return self._positions.get(poem_id)
+    
+    def visible_rows(self):
+        """Number of rows the listbox can show at its current height"""
+        inset = 2 * (self.tk.getint(self.listbox.cget('borderwidth'))
+                     + self.tk.getint(self.listbox.cget('highlightthickness')))
+        return max(1, (self.listbox.winfo_height() - inset) // self._row_height + 1)
+    
+    def _page(self, page):
+        """Display texts for one page of the list, from the cache or the poem store"""
+        rows = self._pages.get(page)
+        if rows is None:
+            page_ids = self.poem_ids[page * POEM_LIST_PAGE_SIZE:(page + 1) * POEM_LIST_PAGE_SIZE]
+            rows = {row['id']: self.format_row(row) for row in poem_store.summaries(page_ids)}
+            self._pages[page] = rows
+            while len(self._pages) > POEM_LIST_CACHED_PAGES:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(page)
+        return rows
+    
+    def render(self):
+        """Redraw the rows in view (loading pages around them) and update the scrollbar"""
+        total = len(self.poem_ids)
+        rows = self.visible_rows()
+        self.first = max(0, min(self.first, total - rows + 1))
+        end = min(self.first + rows, total)
+        
+        # Make sure the pages just outside the view are cached before they're scrolled to
+        start_page = max(0, self.first - POEM_LIST_BUFFER_ROWS) // POEM_LIST_PAGE_SIZE
+        end_page = (min(total, end + POEM_LIST_BUFFER_ROWS) - 1) // POEM_LIST_PAGE_SIZE
+        pages = {page: self._page(page) for page in range(start_page, end_page + 1)}
+        
+        visible = self.poem_ids[self.first:end]
+        texts = [pages[i // POEM_LIST_PAGE_SIZE].get(poem_id, "")
+                 for i, poem_id in enumerate(visible, self.first)]
+        self.listbox.delete(0, tk.END)
+        if texts:
+            self.listbox.insert(tk.END, *texts)
+        
+        if self.selected_id in visible:
+            self.listbox.selection_set(visible.index(self.selected_id))
+        
+        if total:
+            self.scrollbar.set(self.first / total, min(1.0, (self.first + rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+    
+    def yview(self, *args):
+        """Scrollbar command: ('moveto', fraction) or ('scroll', count, 'units' | 'pages')"""
+        if args[0] == 'moveto':
+            self.first = int(float(args[1]) * len(self.poem_ids))
+        elif args[0] == 'scroll':
+            step = self.visible_rows() if args[2] == 'pages' else 1
+            self.first += int(args[1]) * step
+        self.render()
+    
+    def _on_mousewheel(self, event):
+        if event.num == 4 or event.delta > 0:
+            self.first -= 3
+        elif event.num == 5 or event.delta < 0:
+            self.first += 3
+        self.render()
+        return "break"  # Don't also scroll the main window
+    
+    def _on_listbox_select(self, event=None):
+        selection = self.listbox.curselection()
+        if selection and self.first + selection[0] < len(self.poem_ids):
+            self.selected_id = self.poem_ids[self.first + selection[0]]
+            self.on_select()
+    
+    def move_selection(self, delta):
+        """Move the selection by delta rows, scrolling to keep it in view"""
+        if not self.poem_ids:
+            return "break"
+        current = None if self.selected_id is None else self.position_of(self.selected_id)
+        position = 0 if current is None else max(0, min(current + delta, len(self.poem_ids) - 1))
+        self.selected_id = self.poem_ids[position]
+        rows = self.visible_rows()
+        if position < self.first:
+            self.first = position
+        elif position >= self.first + rows - 1:
+            self.first = position - rows + 2  # The last row may be cut off
+        self.render()
+        self.on_select()
+        return "break"
+
 # After imports and before poet_files dictionary
 class PoemBrowser(tk.Toplevel):
     def __init__(self, parent):
@@ -69,6 +235,7 @@ class PoemBrowser(tk.Toplevel):
                 bg=xp_colors['frame_bg'], fg=text_color).grid(row=0, column=0, padx=(0,5))
         
         self.search_var = tk.StringVar()
+        self.search_after_id = None  # Pending debounced search
         self.search_var.trace('w', self.filter_poems)
         search_entry = tk.Entry(search_frame, textvariable=self.search_var, 
                               font=current_font)
@@ -80,23 +247,13 @@ class PoemBrowser(tk.Toplevel):
         content_frame.grid_columnconfigure(1, weight=1)  # Make preview expand
         content_frame.grid_rowconfigure(0, weight=1)    # Make content expand vertically
         
-        # Create poem list with scrollbar
+        # Create poem list with scrollbar (only the rows in view are ever loaded)
         list_frame = tk.Frame(content_frame, bg=xp_colors['frame_bg'], relief="sunken", bd=1)
         list_frame.grid(row=0, column=0, sticky="ns", padx=(0,5))
         
-        self.poem_list = tk.Listbox(list_frame, font=current_font, 
-                                  bg=xp_colors['text_bg'],
-                                  selectmode=tk.SINGLE,
-                                  exportselection=False,
-                                  width=45)
-        scrollbar = ttk.Scrollbar(list_frame, orient="vertical", 
-                                command=self.poem_list.yview)
-        self.poem_list.configure(yscrollcommand=scrollbar.set)
-        
-        self.poem_list.pack(side=tk.LEFT, fill="both")
-        scrollbar.pack(side=tk.RIGHT, fill="y")
-        
-        self.poem_list.bind('<<ListboxSelect>>', self.show_selected_poem)
+        self.poem_list = PagedPoemList(list_frame, current_font, self.show_selected_poem,
+                                       bg=xp_colors['text_bg'], fg=text_color, width=45)
+        self.poem_list.pack(fill="y", expand=True)
         
         # Create preview frame
         preview_frame = tk.Frame(content_frame, bg=xp_colors['frame_bg'], relief="sunken", bd=1)
@@ -134,74 +291,55 @@ class PoemBrowser(tk.Toplevel):
                      font=current_font, bg=xp_colors['button'],
                      activebackground=xp_colors['highlight'], fg=text_color).grid(row=0, column=i, padx=2, sticky="ew")
         
-        # Load poems
+        # Load poems, then pick up any saves added, edited or removed outside the app
         self.load_poem_list()
+        self.after_idle(self.sync_saves)
         
         # Configure text colors for list and preview
-        self.poem_list.configure(fg=text_color)
         self.preview_text.configure(fg=text_color)
         self.preview_header.configure(fg=text_color)
     
-    def load_poem_list(self):
-        """Load and display the list of saved poems"""
-        self.poem_list.delete(0, tk.END)
+    def load_poem_list(self, keep_position=False):
+        """Load and display the saved poems matching the search box, in the chosen order"""
+        if self.search_after_id is not None:
+            self.after_cancel(self.search_after_id)  # A pending search would only repeat this
+            self.search_after_id = None
         try:
-            files = list(Path(SAVES_DIR).glob('*.json'))
-            poems = []
-            
-            for file in files:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    # Add favorite status if not present
-                    if 'favorite' not in data:
-                        data['favorite'] = False
-                    # Add file path for later use
-                    data['file_path'] = file
-                    poems.append(data)
-            
-            # Sort based on selected option
-            sort_option = self.sort_var.get()
-            if sort_option == "Date (Newest)":
-                poems.sort(key=lambda x: x['date'], reverse=True)
-            elif sort_option == "Date (Oldest)":
-                poems.sort(key=lambda x: x['date'])
-            elif sort_option == "Poet A-Z":
-                poems.sort(key=lambda x: x['poet'])
-            elif sort_option == "Poet Z-A":
-                poems.sort(key=lambda x: x['poet'], reverse=True)
-            elif sort_option == "Favorites First":
-                poems.sort(key=lambda x: (not x['favorite'], x['date']), reverse=True)
-            
-            for data in poems:
-                date = datetime.strptime(data['date'], "%Y-%m-%d %H:%M:%S")
-                star = "⭐ " if data['favorite'] else "   "
-                display_text = f"{star}{date.strftime('%Y-%m-%d %H:%M')} │ {data['poet']}"
-                self.poem_list.insert(tk.END, display_text)
-                self.poem_list.itemconfig(tk.END, {'bg': xp_colors['text_bg']})
-                
+            self.poem_list.set_ids(poem_store.search(self.search_var.get(), self.sort_var.get()),
+                                   keep_position)
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load poems: {str(e)}")
     
+    def sync_saves(self):
+        """Re-scan the saves directory and refresh the list if any poem files changed"""
+        try:
+            if any(poem_store.sync()):
+                self.load_poem_list(keep_position=True)
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to scan saved poems: {str(e)}")
+    
+    def selected_poem_id(self):
+        """Store id of the selected poem, or None if nothing is selected"""
+        return self.poem_list.selected_id
+    
     def show_selected_poem(self, event=None):
         """Display the selected poem's content"""
-        selection = self.poem_list.curselection()
-        if not selection:
+        poem_id = self.selected_poem_id()
+        if poem_id is None:
             return
             
         try:
-            files = sorted(Path(SAVES_DIR).glob('*.json'), key=os.path.getmtime, reverse=True)
-            file = files[selection[0]]
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = poem_store.get(poem_id)
+            if data is None:
+                return
                 
             # Update header with more metadata
             header = f"Poet: {data['poet']}\n"
             header += f"Date: {data['date']}\n"
-            if 'devices' in data:
+            if data['devices']:
                 header += f"Devices: {', '.join(data['devices'])}\n"
-            if 'favorite' in data:
-                header += f"Favorite: {'Yes' if data['favorite'] else 'No'}\n"
-            if 'theme' in data:
+            header += f"Favorite: {'Yes' if data['favorite'] else 'No'}\n"
+            if data['theme']:
                 header += f"Theme: {data['theme']}\n"
             
             self.preview_header.config(text=header)
@@ -213,36 +351,20 @@ class PoemBrowser(tk.Toplevel):
             messagebox.showerror("Error", f"Failed to load poem: {str(e)}")
     
     def filter_poems(self, *args):
-        """Filter poems based on search text"""
-        search_text = self.search_var.get().lower()
-        self.poem_list.delete(0, tk.END)
-        
-        try:
-            files = sorted(Path(SAVES_DIR).glob('*.json'), key=os.path.getmtime, reverse=True)
-            for file in files:
-                with open(file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    date = datetime.strptime(data['date'], "%Y-%m-%d %H:%M:%S")
-                    display_text = f"{date.strftime('%Y-%m-%d %H:%M')} │ {data['poet']}"
-                    if (search_text in display_text.lower() or 
-                        search_text in data['text'].lower()):
-                        self.poem_list.insert(tk.END, display_text)
-                        self.poem_list.itemconfig(tk.END, {'bg': xp_colors['text_bg']})
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to filter poems: {str(e)}")
+        """Search once typing pauses, so a burst of keystrokes runs a single query"""
+        if self.search_after_id is not None:
+            self.after_cancel(self.search_after_id)
+        self.search_after_id = self.after(SEARCH_DEBOUNCE_MS, self.load_poem_list)
     
     def load_selected(self):
         """Load the selected poem into the main window"""
-        selection = self.poem_list.curselection()
-        if not selection:
+        poem_id = self.selected_poem_id()
+        if poem_id is None:
             messagebox.showwarning("No Selection", "Please select a poem to load!")
             return
             
         try:
-            files = sorted(Path(SAVES_DIR).glob('*.json'), key=os.path.getmtime, reverse=True)
-            file = files[selection[0]]
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = poem_store.get(poem_id)
                 
             # Update main window
             text_output.delete("1.0", tk.END)
@@ -262,8 +384,8 @@ class PoemBrowser(tk.Toplevel):
     
     def delete_selected(self):
         """Delete the selected poem"""
-        selection = self.poem_list.curselection()
-        if not selection:
+        poem_id = self.selected_poem_id()
+        if poem_id is None:
             messagebox.showwarning("No Selection", "Please select a poem to delete!")
             return
             
@@ -271,10 +393,8 @@ class PoemBrowser(tk.Toplevel):
             return
             
         try:
-            files = sorted(Path(SAVES_DIR).glob('*.json'), key=os.path.getmtime, reverse=True)
-            file = files[selection[0]]
-            os.remove(file)
-            self.load_poem_list()  # Refresh the list
+            poem_store.delete(poem_id)
+            self.load_poem_list(keep_position=True)  # Refresh the list
             self.preview_header.config(text="")
             self.preview_text.delete('1.0', tk.END)
             messagebox.showinfo("Success", "Poem deleted successfully!")
@@ -283,28 +403,20 @@ class PoemBrowser(tk.Toplevel):
     
     def toggle_favorite(self):
         """Toggle favorite status of the selected poem"""
-        selection = self.poem_list.curselection()
-        if not selection:
+        poem_id = self.selected_poem_id()
+        if poem_id is None:
             messagebox.showwarning("No Selection", "Please select a poem to favorite!")
             return
             
         try:
-            files = sorted(Path(SAVES_DIR).glob('*.json'), key=os.path.getmtime, reverse=True)
-            file = files[selection[0]]
-            
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
             # Toggle favorite status
-            data['favorite'] = not data.get('favorite', False)
-            
-            with open(file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=4)
+            favorite = not poem_store.get(poem_id)['favorite']
+            poem_store.set_favorite(poem_id, favorite)
             
             # Refresh the list to show updated status
-            self.load_poem_list()
+            self.load_poem_list(keep_position=True)
             
-            status = "added to" if data['favorite'] else "removed from"
+            status = "added to" if favorite else "removed from"
             messagebox.showinfo("Success", f"Poem {status} favorites!")
             
         except Exception as e:
@@ -312,16 +424,13 @@ class PoemBrowser(tk.Toplevel):
     
     def export_selected(self):
         """Export the selected poem"""
-        selection = self.poem_list.curselection()
-        if not selection:
+        poem_id = self.selected_poem_id()
+        if poem_id is None:
             messagebox.showwarning("No Selection", "Please select a poem to export!")
             return
             
         try:
-            files = sorted(Path(SAVES_DIR).glob('*.json'), key=os.path.getmtime, reverse=True)
-            file = files[selection[0]]
-            with open(file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = poem_store.get(poem_id)
             
             filepath = filedialog.asksaveasfilename(
                 initialdir=".",
@@ -335,7 +444,7 @@ class PoemBrowser(tk.Toplevel):
                     f.write(f"Generated by Markov's Muse\n")
                     f.write(f"Poet: {data['poet']}\n")
                     f.write(f"Date: {data['date']}\n")
-                    if 'devices' in data:
+                    if data['devices']:
                         f.write(f"Devices: {', '.join(data['devices'])}\n")
                     f.write("\n" + "="*40 + "\n\n")
                     f.write(data['text'])
@@ -345,29 +454,6 @@ class PoemBrowser(tk.Toplevel):
         except Exception as e:
             messagebox.showerror("Error", f"Failed to export poem: {str(e)}")
 
-# Step 1: Data Collection - Dictionary containing available poets and their respective text files
-poet_files = {
-    "Emily Dickinson": "dickinson.txt",  # Replace with actual file paths
-    "Robert Frost": "frost.txt",
-    "William Shakespeare": "shakespeare.txt",
-    "Edgar Allan Poe": "poe.txt",
-}
-
-# List of available poetic devices that the user can apply to the poem
-poetic_devices = [
-    "Alliteration",
-    "Repetition", 
-    "Rhyme",  # This will become a parent option
-    "Metaphor"
-]
-
-# Add rhyme scheme options
-rhyme_schemes = [
-    "AABB (Paired)",
-    "ABAB (Alternating)",
-    "ABBA (Enclosed)"
-]
-
 # Add this to your constants section
 themes = {
     "Default (Cute)": {
@@ -431,408 +517,178 @@ def get_save_directory():
     
     return save_path
 
-# Replace the SAVES_DIR constant with this
-SAVES_DIR = get_save_directory()
-
-# Function to preprocess the text and build the Markov chain
-def preprocess_text(file_path, depth=2):
-    """
-    Reads the poet's text file, processes it, and creates a Markov transition matrix
-    to generate more coherent lines of poetry.
+# Background generation - the model build and sampling run on a worker thread and the
+# results are polled back onto the Tk thread, so the window never freezes
+GENERATION_POLL_MS = 16  # ~60 fps
+generation_job = None
+
+class GenerationCancelled(Exception):
+    """Raised inside a worker thread to abandon a cancelled generation"""
+
+class GenerationJob:
+    """One poem generation on a worker thread, reporting back through a message queue"""
+    def __init__(self, poet, num_lines, devices, rhyme_scheme=None, seed=None, backoff=False):
+        self.poet = poet
+        self.num_lines = num_lines
+        self.devices = devices
+        self.rhyme_scheme = rhyme_scheme
+        self.seed = seed
+        self.backoff = backoff  # Use the variable-order BackoffTrieModel
+        self.messages = queue.Queue()  # ('progress' | 'done' | 'error' | 'cancelled', text)
+        self.cancelled = threading.Event()
+        self.timings = ""  # Stage timings of the finished run, when tracing is enabled
+        self.thread = threading.Thread(target=self.run, daemon=True)
     
-    :param file_path: Path to the text file of the poet
-    :param depth: Number of words to use as context for the Markov model (bigram or trigram)
-    :return: A dictionary representing the transition probabilities for the Markov chain
-    """
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            text = f.read()
-            if not text:
-                print(f"Warning: {file_path} is empty")
-                return defaultdict(lambda: defaultdict(int))
-    except FileNotFoundError:
-        print(f"Error: Could not find file {file_path}")
-        return defaultdict(lambda: defaultdict(int))
-    except Exception as e:
-        print(f"Error reading {file_path}: {e}")
-        return defaultdict(lambda: defaultdict(int))
-
-    # Remove Roman numerals (common in classic poetry collections)
-    text = re.sub(r'\b[IVXLCDM]+\b', '', text)
-
-    # Extract words while preserving only alphabetical words (removes numbers and symbols)
-    words = re.findall(r'\b[a-zA-Z]+\b', text.lower())
-
-    # Stop words to exclude common but unhelpful words
-    stop_words = {
-        "a", "an", "the", "and", "or", "but", "is", "in", "on", "at", "by", "with",
-        "of", "to", "for", "as", "was", "were", "be", "am", "are", "it", "this", "that"
-    }
-    words = [word for word in words if word not in stop_words]
-
-    # Create a Markov transition matrix using n-grams for better coherence
-    transition_matrix = defaultdict(lambda: defaultdict(int))
-
-    for i in range(len(words) - depth):
-        key = tuple(words[i:i + depth])  # Use 'depth' words as context
-        next_word = words[i + depth]
-        transition_matrix[key][next_word] += 1  # Count occurrences
-
-    return transition_matrix
-
-def get_rhyme_pattern(word):
-    """Get the rhyming pattern of a word's ending"""
-    word = word.lower().strip('.,!?;:')
-    if len(word) < 3:
-        return None
-        
-    vowels = 'aeiou'
-    consonants = 'bcdfghjklmnpqrstvwxyz'
-    
-    # Find last stressed syllable
-    last_vowel_pos = -1
-    vowel_count = 0
-    for i in range(len(word) - 1, -1, -1):
-        if word[i] in vowels:
-            if vowel_count == 0:
-                last_vowel_pos = i
-            vowel_count += 1
-            # Include consecutive vowels
-            while i > 0 and word[i - 1] in vowels:
-                i -= 1
-                
-    if last_vowel_pos == -1:
-        return None
-        
-    # Get the rhyming part (from last stressed syllable to end)
-    rhyme_part = word[max(0, last_vowel_pos - 1):]
+    def start(self):
+        self.thread.start()
     
-    # Handle special cases
-    if rhyme_part.endswith('e') and len(rhyme_part) > 2:  # Silent e
-        rhyme_part = rhyme_part[:-1]
+    def cancel(self):
+        self.cancelled.set()
     
-    # Get vowel and consonant patterns separately
-    vowel_pattern = ''.join(c for c in rhyme_part if c in vowels)
-    consonant_pattern = ''.join(c for c in rhyme_part if c in consonants)
-    
-    return (vowel_pattern, consonant_pattern) if vowel_pattern else None
-
-def find_rhyming_pairs(lines):
-    """
-    Find pairs of lines that could rhyme based on their last words.
-    Uses strict AABB rhyming pattern with precise sound matching.
-    """
-    pairs = []
-    common_words = {
-        'the', 'and', 'but', 'or', 'if', 'of', 'to', 'in', 'on', 'at', 'a', 'an', 'for', 'with',
-        'is', 'was', 'were', 'be', 'been', 'has', 'have', 'had', 'do', 'does', 'did', 'will',
-        'would', 'should', 'could', 'may', 'might', 'must', 'shall', 'can', 'us', 'me', 'we',
-        'they', 'them', 'him', 'her', 'his', 'their', 'our', 'your', 'my', 'so', 'go', 'no',
-        'here', 'there', 'where', 'when', 'then', 'than', 'this', 'that', 'these', 'those',
-        'through', 'though', 'although', 'yet', 'still', 'just', 'now', 'how', 'who', 'what'
-    }
+    def report_progress(self, lines_done, num_lines):
+        """generate_poem progress callback - also where a cancel takes effect"""
+        if self.cancelled.is_set():
+            raise GenerationCancelled()
+        self.messages.put(('progress', f"Writing poem... line {lines_done}/{num_lines}"))
     
-    # Process lines in pairs for AABB pattern
-    for i in range(0, len(lines)-1, 2):
-        if i + 1 >= len(lines):
-            break
-            
-        words1 = lines[i].split()
-        words2 = lines[i+1].split()
-        
-        if not words1 or not words2:
-            continue
-            
-        last_word1 = words1[-1]
-        last_word2 = words2[-1]
-        
-        # Skip common words, short words, and identical words
-        if (last_word1.lower() in common_words or 
-            last_word2.lower() in common_words or
-            len(last_word1) < 3 or len(last_word2) < 3 or
-            last_word1.lower() == last_word2.lower()):
-            continue
-            
-        pattern1 = get_rhyme_pattern(last_word1)
-        pattern2 = get_rhyme_pattern(last_word2)
-        
-        if pattern1 and pattern2:
-            vowels1, cons1 = pattern1
-            vowels2, cons2 = pattern2
-            
-            # Perfect rhyme: same vowel and consonant patterns
-            if vowels1 == vowels2 and cons1 == cons2:
-                pairs.append((i, i+1, 4))
-            # Strong rhyme: same vowel pattern, similar consonants
-            elif vowels1 == vowels2 and len(set(cons1) & set(cons2)) >= max(1, len(cons1) // 2):
-                pairs.append((i, i+1, 3))
-            # Assonance: same vowel pattern
-            elif vowels1 == vowels2 and len(vowels1) >= 2:
-                pairs.append((i, i+1, 2))
-            # Weak rhyme: similar ending sound
-            elif vowels1[-1:] == vowels2[-1:] and cons1[-1:] == cons2[-1:]:
-                pairs.append((i, i+1, 1))
-    
-    return pairs
-
-# Function to apply multiple poetic devices to the generated poem
-def apply_poetic_devices(poem, devices):
-    """
-    Enhances the generated poem by applying selected poetic devices.
+    def run(self):
+        with tracer.span('generate') as run_span:
+            result = self.generate()
+        if result is None:
+            result = ('cancelled', None)
+        else:
+            self.timings = format_run(run_span.run)
+        self.messages.put(result)  # Always the last message, so the UI knows the thread is done
     
-    :param poem: The poem text as a string
-    :param devices: A list of poetic devices selected by the user
-    :return: Modified poem with applied poetic effects
-    """
-    lines = poem.split("\n")
-
-    if "Alliteration" in devices:
-        # Enhanced alliteration that actually creates alliterative patterns
-        new_lines = []
-        consonant_clusters = {
-            'ch': [], 'sh': [], 'th': [], 'wh': [], 'ph': [],
-            'b': [], 'c': [], 'd': [], 'f': [], 'g': [], 'h': [], 
-            'j': [], 'k': [], 'l': [], 'm': [], 'n': [], 'p': [], 
-            'q': [], 'r': [], 's': [], 't': [], 'v': [], 'w': [], 
-            'x': [], 'y': [], 'z': []
-        }
-        
-        for line in lines:
-            words = [w for w in line.split() if len(w) >= 2]  # Only consider words of 2+ characters
-            if not words:
-                new_lines.append(line)
-                continue
-            
-            # Categorize words by their starting sounds
-            for word in words:
-                word_lower = word.lower()
-                # Skip single letters or very short fragments
-                if len(word_lower) < 2:
-                    continue
-                    
-                # Check for consonant clusters first
-                first_two = word_lower[:2]
-                if first_two in consonant_clusters and len(word) >= 3:  # Ensure word is long enough
-                    consonant_clusters[first_two].append(word)
-                    continue
-                
-                # Check for single consonants
-                if word_lower[0] in consonant_clusters and len(word) >= 3:  # Ensure word is long enough
-                    consonant_clusters[word_lower[0]].append(word)
-            
-            # Try to create alliteration
-            most_common_sound = None
-            max_words = 1  # Start at 1 to ensure we have enough words
-            
-            for sound, word_list in consonant_clusters.items():
-                # Only consider sounds that have enough valid words
-                if len(word_list) > max_words and all(len(w) >= 3 for w in word_list):
-                    max_words = len(word_list)
-                    most_common_sound = sound
-            
-            if most_common_sound and len(consonant_clusters[most_common_sound]) >= 2:
-                # Create new line with alliteration
-                alliterative_words = [w for w in consonant_clusters[most_common_sound][:3] 
-                                    if len(w) >= 3]  # Additional length check
-                remaining_words = [w for w in words 
-                                 if w not in alliterative_words 
-                                 and len(w) >= 3][:2]  # Only use valid remaining words
-                
-                if len(alliterative_words) >= 2:  # Ensure we have at least 2 alliterative words
-                    new_line = ' '.join(alliterative_words + remaining_words)
-                    new_lines.append(new_line.capitalize())
-                else:
-                    new_lines.append(line)
-                
-                # Clear the used words
-                consonant_clusters[most_common_sound] = []
-            else:
-                new_lines.append(line)
-            
-            # Clear all categorized words for the next line
-            for sound in consonant_clusters:
-                consonant_clusters[sound] = []
-        
-        lines = new_lines
-
-    if "Repetition" in devices and len(lines) > 2:
-        # Repeats a phrase from the first line in every second line
-        repeated_phrase = lines[0].split()[:3]  # First 3 words of first line
-        if repeated_phrase:
-            for i in range(1, len(lines), 2):
-                lines[i] = lines[i] + " " + " ".join(repeated_phrase)
-
-    if "Rhyme" in devices:
-        new_lines = []
-        used_lines = set()
-        
-        # Find rhyming pairs
-        rhyme_pairs = find_rhyming_pairs(lines)
-        
-        # Sort by score
-        rhyme_pairs.sort(key=lambda x: x[2], reverse=True)
-        
-        # Apply rhymes in order of best scores
-        for i, j, score in rhyme_pairs:
-            if i not in used_lines and j not in used_lines:
-                new_lines.extend([lines[i], lines[j]])
-                used_lines.add(i)
-                used_lines.add(j)
-        
-        # Add remaining lines
-        for i, line in enumerate(lines):
-            if i not in used_lines:
-                new_lines.append(line)
-        
-        lines = new_lines
-
-    if "Metaphor" in devices:
-        # Replaces common words with metaphorical descriptions
-        metaphor_dict = {
-            "moon": "a silver lantern",
-            "sun": "a golden eye",
-            "river": "a winding ribbon",
-            "tree": "a silent guardian",
-            "sky": "a vast ocean",
-            "wind": "a whispering voice",
-            "stars": "celestial diamonds",
-            "clouds": "wandering dreamers",
-            "night": "a velvet shroud"
-        }
-        for i in range(len(lines)):
-            for key, value in metaphor_dict.items():
-                lines[i] = lines[i].replace(key, value)
-
-    return "\n".join(lines)
-
-# Function to generate a thoughtful poem using the Markov chain model
-def generate_poem(start_word, num_lines, transition_matrix, devices, depth=2):
-    """
-    Generates a poem using a Markov chain with simpler rhyming.
-    """
-    def get_rhyme_ending(word):
-        """Get the rhyming ending of a word"""
-        if len(word) < 4:
-            return None
+    def generate(self):
+        """Load the model and write the poem; returns the final message (None if cancelled)"""
+        try:
+            self.messages.put(('progress', f"Loading {self.poet} model..."))
+            with tracer.span('load model'):
+                transition_matrix = model_registry.get(self.poet, backoff=self.backoff)
+            if self.cancelled.is_set():
+                return None
+            if not transition_matrix:
+                return ('error', "Error: Could not generate poem from empty text file")
             
-        # Common rhyming patterns with their variants
-        patterns = {
-            'ing': ['ing', 'ring', 'sing', 'wing'],
-            'ight': ['ight', 'ite', 'yte', 'eight'],
-            'ound': ['ound', 'owned'],
-            'ead': ['ead', 'ed', 'eed'],
-            'ame': ['ame', 'aim'],
-            'ay': ['ay', 'ey', 'eigh'],
-            'ear': ['ear', 'eer', 'ere'],
-            'ine': ['ine', 'ign'],
-            'all': ['all', 'awl'],
-            'ow': ['ow', 'oe', 'o'],
-            'iss': ['iss', 'is'],
-            'est': ['est', 'essed']
-        }
-        
-        # Check for pattern matches
-        word = word.lower()
-        for main_pattern, variants in patterns.items():
-            if any(word.endswith(v) for v in variants):
-                return main_pattern
-        return word[-2:] if len(word) > 3 else None
-
-    def find_rhyming_word(word, available_words):
-        """Find a word that rhymes with the given word"""
-        if not word:
+            self.messages.put(('progress', "Writing poem..."))
+            poem = generate_poem(None, self.num_lines, transition_matrix, self.devices,
+                                 progress=self.report_progress, rhyme_scheme=self.rhyme_scheme,
+                                 seed=self.seed)
+            return ('done', poem)
+        except GenerationCancelled:
             return None
-        ending = get_rhyme_ending(word)
-        if not ending:
-            return None
-            
-        candidates = [w for w in available_words 
-                     if len(w) >= 4 and w != word and get_rhyme_ending(w) == ending]
-        return random.choice(candidates) if candidates else None
-
-    def generate_line(start_words, target_end=None):
-        """Generate a line with optional target ending"""
-        line = list(start_words)
-        if target_end:
-            line.append(target_end)
-            return line
-            
-        for _ in range(8):  # Keep lines reasonably short
-            if len(line) >= 4:  # If line long enough
-                break
-            key = tuple(line[-depth:])
-            if key not in transition_matrix:
-                break
-            next_words = list(transition_matrix[key].keys())
-            if not next_words:
-                break
-            next_word = random.choices(next_words, 
-                                     weights=[transition_matrix[key][w] for w in next_words])[0]
-            line.append(next_word)
-        return line if len(line) >= 4 else None
-
-    # Collect all available words
-    available_words = set()
-    for words in transition_matrix.values():
-        available_words.update(words.keys())
-
-    poem_lines = []
-    i = 0
-    while i < num_lines - 1:  # Process pairs of lines
-        # Generate first line
-        line1 = generate_line(start_word)
-        if not line1:
-            start_word = random.choice(list(transition_matrix.keys()))
-            continue
-            
-        # Try to find a rhyming word for second line
-        rhyme_word = find_rhyming_word(line1[-1], available_words)
-        if rhyme_word:
-            line2 = generate_line(random.choice(list(transition_matrix.keys())), rhyme_word)
-            if line2:
-                poem_lines.extend([' '.join(line1).capitalize(),
-                                 ' '.join(line2).capitalize()])
-                i += 2
-                start_word = random.choice(list(transition_matrix.keys()))
-                continue
-        
-        # If no rhyme found, just add the first line
-        poem_lines.append(' '.join(line1).capitalize())
-        i += 1
-        start_word = random.choice(list(transition_matrix.keys()))
-
-    # Add final line if needed
-    if i < num_lines:
-        if line1 := generate_line(start_word):
-            poem_lines.append(' '.join(line1).capitalize())
-
-    return apply_poetic_devices("\n".join(poem_lines), devices)
+        except Exception as e:
+            return ('error', f"Error generating poem: {e}")
 
 # Function to handle poem generation in the UI
 def on_generate():
     """
-    Triggers poem generation when the "Generate" button is pressed.
+    Triggers poem generation when the "Generate" button (or Ctrl+G) is pressed.
+    The work happens in a GenerationJob; only one runs at a time.
     """
+    global generation_job
+    if generation_job is not None:
+        root.bell()  # Already generating - ignore repeated presses
+        return
+    
     selected_poet = poet_var.get()
     num_lines = int(lines_var.get())
-    selected_devices = [device for device, var in device_vars.items() if var.get()]
+    selected_devices = [device for device in poetic_devices if device_vars[device].get()]
+    # With Rhyme ticked, lines are written to the chosen scheme
+    rhyme_scheme = device_vars["rhyme_scheme"].get() if "Rhyme" in selected_devices else None
+    
+    # A blank seed picks a new one; either way it's shown afterwards so the poem can be repeated
+    seed_text = seed_var.get().strip()
+    if seed_text and not seed_text.isdigit():
+        show_status("Seed must be a whole number (or blank for a random poem)")
+        return
+    seed = int(seed_text) if seed_text else random.randrange(2 ** 32)
 
     if selected_poet and num_lines > 0:
-        file_path = poet_files[selected_poet]
-        try:
-            transition_matrix = preprocess_text(file_path)
-            if not transition_matrix:
-                text_output.delete("1.0", tk.END)
-                text_output.insert(tk.INSERT, "Error: Could not generate poem from empty text file")
+        undo_manager.save_state()
+        generation_job = GenerationJob(selected_poet, num_lines, selected_devices, rhyme_scheme,
+                                       seed, backoff_var.get())
+        generate_button.config(state="disabled")
+        cancel_button.config(state="normal")
+        set_status("Generating poem...")
+        generation_job.start()
+        root.after(GENERATION_POLL_MS, poll_generation, generation_job)
+
+def poll_generation(job):
+    """Drain the job's messages on the Tk thread and reschedule until it finishes"""
+    if job is not generation_job:
+        return  # Cancelled (or superseded) - drop anything it still reports
+    
+    try:
+        while True:
+            kind, text = job.messages.get_nowait()
+            if kind != 'progress':
+                # A cancelled job's poem is dropped even if it got finished anyway
+                finish_generation('cancelled' if job.cancelled.is_set() else kind, text,
+                                  job.timings, job.seed)
                 return
-                
-            start_word = random.choice(list(transition_matrix.keys()))
-            poem = generate_poem(start_word, num_lines, transition_matrix, selected_devices)
-            text_output.delete("1.0", tk.END)
-            text_output.insert(tk.INSERT, poem)
-        except Exception as e:
-            text_output.delete("1.0", tk.END)
-            text_output.insert(tk.INSERT, f"Error generating poem: {e}")
+            if not job.cancelled.is_set():  # Keep "Cancelling..." up until the worker exits
+                set_status(text)
+    except queue.Empty:
+        pass
+    
+    root.after(GENERATION_POLL_MS, poll_generation, job)
+
+def finish_generation(kind, text, timings="", seed=None):
+    """Show a finished job's poem (or error), seed and stage timings, and re-enable generating"""
+    global generation_job
+    generation_job = None
+    generate_button.config(state="normal")
+    cancel_button.config(state="disabled")
+    if kind == 'cancelled':
+        show_status("Generation cancelled")
+        return
+    
+    text_output.delete("1.0", tk.END)
+    text_output.insert(tk.INSERT, text)
+    message = "Poem generated" if kind == 'done' else "Generation failed"
+    if kind == 'done' and seed is not None:
+        message += f" (seed {seed})"
+    if timings:
+        set_status(f"{message}: {timings}")  # Stays up until the next status message
+    else:
+        show_status(message)
+
+def export_timings():
+    """Save the recorded stage timings as a JSON summary or a Chrome trace"""
+    if not tracer.runs:
+        messagebox.showwarning("No Timings", "Generate a poem first to record stage timings!")
+        return
+    
+    filepath = filedialog.asksaveasfilename(
+        initialdir=".",
+        title="Export Stage Timings",
+        defaultextension=".json",
+        filetypes=[("Stage timings (JSON)", "*.json"), ("Chrome trace", "*.trace.json")]
+    )
+    
+    if not filepath:
+        return
+    
+    try:
+        # *.trace.json files get Chrome's trace event format, for chrome://tracing or Perfetto
+        tracer.export(filepath, 'chrome' if filepath.endswith('.trace.json') else 'json')
+        show_status("Stage timings exported")
+    except Exception as e:
+        messagebox.showerror("Error", f"Failed to export timings: {str(e)}")
+
+def cancel_generation():
+    """
+    Abandon the running generation. Its worker stops at the next checkpoint, but a model
+    build already under way runs to the end, so Generate stays disabled (and the status
+    bar says so) until poll_generation sees the worker exit.
+    """
+    if generation_job is None or generation_job.cancelled.is_set():
+        return
+    generation_job.cancel()
+    cancel_button.config(state="disabled")
+    set_status("Cancelling...")
 
 # Add this before the GUI Setup section
 def copy_text():
@@ -889,6 +745,7 @@ def apply_xp_style(theme_name="Default (Cute)"):
 
 # Also need to define create_poetic_device_frame before it's used
 def create_poetic_device_frame(parent):
+    global scheme_frame  # toggle_rhyme_schemes enables its radio buttons
     device_frame = tk.Frame(parent, bg=xp_colors['frame_bg'], relief="groove", bd=2)
     device_frame.pack(pady=5, padx=10, fill="x")
     
@@ -1022,6 +879,15 @@ def change_theme(event=None):
                     foreground='white' if theme_name == "Dark Mode" else 'black',
                     font=current_font
                 )
+            elif isinstance(widget, tk.Checkbutton):
+                widget.configure(
+                    bg=xp_colors['frame_bg'],
+                    fg='white' if theme_name == "Dark Mode" else 'black',
+                    activebackground=xp_colors['frame_bg'],
+                    activeforeground='white' if theme_name == "Dark Mode" else 'black',
+                    selectcolor=xp_colors['frame_bg'] if theme_name == "Dark Mode" else 'white',
+                    font=current_font
+                )
     
     # Update poetic devices section
     for widget in content_frame.winfo_children():
@@ -1091,11 +957,13 @@ def change_theme(event=None):
     button_frame.configure(bg=xp_colors['frame_bg'])
     all_buttons = [
         generate_button,
+        cancel_button,
         copy_button, 
         save_button,
         load_button,
         export_button,
         browse_button,
+        timings_button,
         help_button
     ]
     
@@ -1183,13 +1051,9 @@ def save_current_poem():
         "favorite": False  # Initialize as not favorite
     }
     
-    # Generate filename based on date
-    filename = f"poem_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-    filepath = os.path.join(SAVES_DIR, filename)
-    
     try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            json.dump(poem_data, f, indent=4)
+        # Written as a JSON file named by date and indexed in the poem library
+        _, filepath = poem_store.save(poem_data)
         messagebox.showinfo("Success", f"Poem saved to:\n{filepath}")
     except Exception as e:
         messagebox.showerror("Error", f"Failed to save poem: {str(e)}")
@@ -1264,16 +1128,26 @@ def export_poem():
         messagebox.showerror("Error", f"Failed to export poem: {str(e)}")
 
 # Add status bar to main window
+status_reset_id = None
+
+def set_status(message):
+    """Show a message in the status bar until something replaces it"""
+    global status_reset_id
+    if status_reset_id is not None:
+        root.after_cancel(status_reset_id)
+        status_reset_id = None
+    status_bar.config(text=message)
+
 def show_status(message, duration=3000):
     """Show a message in the status bar and clear it after duration"""
-    status_bar.config(text=message)
-    root.after(duration, lambda: status_bar.config(text="Ready"))
+    global status_reset_id
+    set_status(message)
+    status_reset_id = root.after(duration, lambda: set_status("Ready"))
 
 # Add keyboard shortcut handling
 def handle_shortcut(event):
     """Handle keyboard shortcuts and show in status bar"""
     if event.keysym == 'g' and event.state & 4:  # Control-G
-        show_status("Generating poem...")
         on_generate()
     elif event.keysym == 's' and event.state & 4:  # Control-S
         show_status("Saving poem...")
@@ -1284,276 +1158,298 @@ def handle_shortcut(event):
         redo_action()
     # ... add other shortcuts
 
-# GUI Setup
-root = tk.Tk()
-root.title("🌸 Poem Generator 🌸")
-root.geometry("700x650")
-root.minsize(600, 500)
-
-# Make the root window scalable
-root.grid_rowconfigure(0, weight=1)
-root.grid_columnconfigure(0, weight=1)
-
-# Apply Windows XP theme
-xp_colors = apply_xp_style()
-root.configure(bg=xp_colors['bg'])
-
-# Create theme variable after root
-theme_var = tk.StringVar(value="Default (Cute)")
-
-# Create main container that will scale
-main_container = tk.Frame(root, bg=xp_colors['bg'])
-main_container.grid(row=0, column=0, sticky="nsew")
-main_container.grid_columnconfigure(0, weight=1)
-main_container.grid_rowconfigure(1, weight=1)
-
-# Create title bar with XP style
-title_frame = tk.Frame(main_container, bg=xp_colors['title'], relief="raised", bd=1)
-title_frame.grid(row=0, column=0, sticky="ew", pady=(0, 10))
-title_label = tk.Label(title_frame, text="~ Markov's Muse - Poem Generator ~", 
-                      font=themes["Default (Cute)"]['title_font'], 
-                      bg=xp_colors['title'],
-                      fg="white", pady=5)
-title_label.pack()
-
-# Add status bar
-status_bar = tk.Label(main_container, text="Ready", bd=1, relief=tk.SUNKEN, anchor=tk.W,
-                     font=themes["Default (Cute)"]['font'], bg=xp_colors['frame_bg'])
-status_bar.grid(row=2, column=0, sticky="ew")
-
-# Create scrollable content frame
-canvas = tk.Canvas(main_container, bg=xp_colors['bg'])
-canvas.grid(row=1, column=0, sticky="nsew")
-
-scrollbar = ttk.Scrollbar(main_container, orient="vertical", command=canvas.yview)
-scrollbar.grid(row=1, column=1, sticky="ns")
-
-canvas.configure(yscrollcommand=scrollbar.set)
-
-# Create content frame inside canvas
-content_frame = tk.Frame(canvas, bg=xp_colors['bg'], relief="groove", bd=2)
-canvas.create_window((0, 0), window=content_frame, anchor="nw", tags="content")
-content_frame.grid_columnconfigure(0, weight=1)
-
-# Function to update canvas scroll region
-def update_scrollregion(event):
-    canvas.configure(scrollregion=canvas.bbox("all"))
-    width = main_container.winfo_width() - scrollbar.winfo_width()
-    canvas.itemconfig("content", width=width)
-
-content_frame.bind("<Configure>", update_scrollregion)
-
-# Add theme frame
-theme_frame = tk.LabelFrame(content_frame, text="Theme", 
-                          font=themes["Default (Cute)"]['font'], 
-                          bg=xp_colors['frame_bg'])
-theme_frame.pack(padx=10, pady=5, fill="x")
-
-theme_dropdown = ttk.Combobox(theme_frame, textvariable=theme_var, 
-                            values=list(themes.keys()), 
-                            font=themes["Default (Cute)"]['font'])
-theme_dropdown.pack(pady=5, padx=10, fill="x")
-theme_dropdown.bind('<<ComboboxSelected>>', change_theme)
-
-# Poet selection with XP styling
-poet_frame = tk.LabelFrame(content_frame, text="Select Poet", 
-                          font=("Tahoma", 11, "bold"), bg=xp_colors['frame_bg'])
-poet_frame.pack(padx=10, pady=5, fill="x")
-
-poet_var = tk.StringVar()
-poet_dropdown = ttk.Combobox(poet_frame, textvariable=poet_var, 
-                            values=list(poet_files.keys()), font=("Tahoma", 11))
-poet_dropdown.pack(pady=5, padx=10, fill="x")
-poet_dropdown.current(0)
-
-# Line count with XP styling
-lines_frame = tk.LabelFrame(content_frame, text="Number of Lines", 
-                           font=("Tahoma", 11, "bold"), bg=xp_colors['frame_bg'])
-lines_frame.pack(padx=10, pady=5, fill="x")
-
-lines_var = tk.StringVar()
-lines_entry = ttk.Spinbox(lines_frame, from_=1, to=50, textvariable=lines_var, 
-                         width=5, font=("Tahoma", 11))
-lines_entry.pack(pady=5)
-lines_entry.set(10)
-
-# Add poetic devices frame
-device_vars = create_poetic_device_frame(content_frame)
-
-# Generate button with XP styling
-generate_button = tk.Button(content_frame, text="✨ Generate Poem ✨", 
-                          command=on_generate, font=("Tahoma", 11, "bold"),
-                          bg=xp_colors['button'], relief="raised",
-                          activebackground=xp_colors['highlight'],
-                          activeforeground="white")
-generate_button.pack(pady=10)
-
-# Output text area with XP styling
-text_output = scrolledtext.ScrolledText(content_frame, wrap=tk.WORD, 
-                                      width=60, height=12, 
-                                      font=("Lucida Console", 11),
-                                      bg=xp_colors['text_bg'], relief="sunken")
-text_output.pack(pady=10, padx=10, fill="both", expand=True)
-
-# Copy button with XP styling
-copy_button = tk.Button(content_frame, text="📋 Copy to Clipboard", 
-                       command=copy_text, font=("Tahoma", 11),
-                       bg=xp_colors['button'], relief="raised",
-                       activebackground=xp_colors['highlight'])
-copy_button.pack(pady=5)
-
-# Add right-click menu
-popup_menu = Menu(root, tearoff=0)
-popup_menu.add_command(label="Copy", command=copy_text)
-
-# Bind events
-text_output.bind("<Button-3>", show_popup)  # Right click
-text_output.bind("<Control-c>", lambda e: copy_text())  # Ctrl+C shortcut
-
-# Add buttons to the UI (add after the copy button)
-button_frame = tk.Frame(content_frame, bg=xp_colors['frame_bg'])
-button_frame.pack(pady=5)
-
-save_button = tk.Button(button_frame, text="💾 Save Poem", 
-                       command=save_current_poem, 
-                       font=themes["Default (Cute)"]['font'],
-                       bg=xp_colors['button'], relief="raised",
-                       activebackground=xp_colors['highlight'])
-save_button.pack(side=tk.LEFT, padx=5)
-
-load_button = tk.Button(button_frame, text="📂 Load Poem", 
-                       command=load_saved_poem, 
-                       font=themes["Default (Cute)"]['font'],
-                       bg=xp_colors['button'], relief="raised",
-                       activebackground=xp_colors['highlight'])
-load_button.pack(side=tk.LEFT, padx=5)
-
-export_button = tk.Button(button_frame, text="📤 Export", 
-                         command=export_poem, 
-                         font=themes["Default (Cute)"]['font'],
-                         bg=xp_colors['button'], relief="raised",
-                         activebackground=xp_colors['highlight'])
-export_button.pack(side=tk.LEFT, padx=5)
-
-# Add to the button frame creation
-browse_button = tk.Button(button_frame, text="📚 Browse Poems", 
-                         command=lambda: PoemBrowser(root),
-                         font=themes["Default (Cute)"]['font'],
-                         bg=xp_colors['button'], relief="raised",
-                         activebackground=xp_colors['highlight'])
-browse_button.pack(side=tk.LEFT, padx=5)
-
-# Add mouse wheel scrolling
-def on_mousewheel(event):
-    canvas.yview_scroll(int(-1*(event.delta/120)), "units")
-
-canvas.bind_all("<MouseWheel>", on_mousewheel)
-
-# Add after the imports
-class UndoRedoManager:
-    def __init__(self, text_widget):
-        self.text_widget = text_widget
-        self.undo_stack = []
-        self.redo_stack = []
-        self.last_state = ""
-        
-    def save_state(self):
-        """Save current state for undo"""
-        current_state = self.text_widget.get("1.0", "end-1c")
-        if current_state != self.last_state:
-            self.undo_stack.append(self.last_state)
-            self.last_state = current_state
-            self.redo_stack.clear()
-            
-    def undo(self):
-        """Restore last state"""
-        if self.undo_stack:
-            current_state = self.text_widget.get("1.0", "end-1c")
-            self.redo_stack.append(current_state)
-            last_state = self.undo_stack.pop()
-            self.text_widget.delete("1.0", tk.END)
-            self.text_widget.insert("1.0", last_state)
-            self.last_state = last_state
-            show_status("Undo")
-            
-    def redo(self):
-        """Redo last undone action"""
-        if self.redo_stack:
-            current_state = self.text_widget.get("1.0", "end-1c")
-            self.undo_stack.append(current_state)
-            next_state = self.redo_stack.pop()
-            self.text_widget.delete("1.0", tk.END)
-            self.text_widget.insert("1.0", next_state)
-            self.last_state = next_state
-            show_status("Redo")
-
-# Create undo manager after text_output creation
-undo_manager = UndoRedoManager(text_output)
+if __name__ == "__main__":
+    # Headless batch mode: python markovsmuse.py batch --poet "Robert Frost" --count 1000
+    if sys.argv[1:2] == ['batch']:
+        from muse_batch import batch_main
+        sys.exit(batch_main(sys.argv[2:]))
+    
+    # Replace the SAVES_DIR constant with this
+    SAVES_DIR = get_save_directory()
+    poem_store = PoemStore(SAVES_DIR)
+    
+    # Time each generation's stages for the status bar and the Timings export
+    tracer.enable()
+    
+    # GUI Setup
+    root = tk.Tk()
+    root.title("🌸 Poem Generator 🌸")
+    root.geometry("700x650")
+    root.minsize(600, 500)
+
+    # Make the root window scalable
+    root.grid_rowconfigure(0, weight=1)
+    root.grid_columnconfigure(0, weight=1)
+
+    # Apply Windows XP theme
+    xp_colors = apply_xp_style()
+    root.configure(bg=xp_colors['bg'])
 
-# Update generate function to use undo manager
-def on_generate():
-    undo_manager.save_state()
-    selected_poet = poet_var.get()
-    num_lines = int(lines_var.get())
-    selected_devices = [device for device, var in device_vars.items() if var.get()]
+    # Create theme variable after root
+    theme_var = tk.StringVar(value="Default (Cute)")
+
+    # Create main container that will scale
+    main_container = tk.Frame(root, bg=xp_colors['bg'])
+    main_container.grid(row=0, column=0, sticky="nsew")
+    main_container.grid_columnconfigure(0, weight=1)
+    main_container.grid_rowconfigure(1, weight=1)
+
+    # Create title bar with XP style
+    title_frame = tk.Frame(main_container, bg=xp_colors['title'], relief="raised", bd=1)
+    title_frame.grid(row=0, column=0, sticky="ew", pady=(0, 10))
+    title_label = tk.Label(title_frame, text="~ Markov's Muse - Poem Generator ~", 
+                          font=themes["Default (Cute)"]['title_font'], 
+                          bg=xp_colors['title'],
+                          fg="white", pady=5)
+    title_label.pack()
+
+    # Add status bar
+    status_bar = tk.Label(main_container, text="Ready", bd=1, relief=tk.SUNKEN, anchor=tk.W,
+                         font=themes["Default (Cute)"]['font'], bg=xp_colors['frame_bg'])
+    status_bar.grid(row=2, column=0, sticky="ew")
+
+    # Create scrollable content frame
+    canvas = tk.Canvas(main_container, bg=xp_colors['bg'])
+    canvas.grid(row=1, column=0, sticky="nsew")
+
+    scrollbar = ttk.Scrollbar(main_container, orient="vertical", command=canvas.yview)
+    scrollbar.grid(row=1, column=1, sticky="ns")
+
+    canvas.configure(yscrollcommand=scrollbar.set)
+
+    # Create content frame inside canvas
+    content_frame = tk.Frame(canvas, bg=xp_colors['bg'], relief="groove", bd=2)
+    canvas.create_window((0, 0), window=content_frame, anchor="nw", tags="content")
+    content_frame.grid_columnconfigure(0, weight=1)
+
+    # Function to update canvas scroll region
+    def update_scrollregion(event):
+        canvas.configure(scrollregion=canvas.bbox("all"))
+        width = main_container.winfo_width() - scrollbar.winfo_width()
+        canvas.itemconfig("content", width=width)
+
+    content_frame.bind("<Configure>", update_scrollregion)
+
+    # Add theme frame
+    theme_frame = tk.LabelFrame(content_frame, text="Theme", 
+                              font=themes["Default (Cute)"]['font'], 
+                              bg=xp_colors['frame_bg'])
+    theme_frame.pack(padx=10, pady=5, fill="x")
+
+    theme_dropdown = ttk.Combobox(theme_frame, textvariable=theme_var, 
+                                values=list(themes.keys()), 
+                                font=themes["Default (Cute)"]['font'])
+    theme_dropdown.pack(pady=5, padx=10, fill="x")
+    theme_dropdown.bind('<<ComboboxSelected>>', change_theme)
+
+    # Poet selection with XP styling
+    poet_frame = tk.LabelFrame(content_frame, text="Select Poet", 
+                              font=("Tahoma", 11, "bold"), bg=xp_colors['frame_bg'])
+    poet_frame.pack(padx=10, pady=5, fill="x")
+
+    poet_var = tk.StringVar()
+    poet_dropdown = ttk.Combobox(poet_frame, textvariable=poet_var, 
+                                values=list(poet_files.keys()), font=("Tahoma", 11))
+    poet_dropdown.pack(pady=5, padx=10, fill="x")
+    poet_dropdown.current(0)
+
+    # Line count with XP styling
+    lines_frame = tk.LabelFrame(content_frame, text="Number of Lines", 
+                               font=("Tahoma", 11, "bold"), bg=xp_colors['frame_bg'])
+    lines_frame.pack(padx=10, pady=5, fill="x")
+
+    lines_var = tk.StringVar()
+    lines_entry = ttk.Spinbox(lines_frame, from_=1, to=50, textvariable=lines_var, 
+                             width=5, font=("Tahoma", 11))
+    lines_entry.pack(pady=5)
+    lines_entry.set(10)
+
+    # Opt in to the variable-order model: fewer lines cut short, a little more to load
+    backoff_var = tk.BooleanVar(value=False)
+    backoff_check = tk.Checkbutton(lines_frame, text="Back off to shorter contexts",
+                                   variable=backoff_var, font=("Tahoma", 11),
+                                   bg=xp_colors['frame_bg'],
+                                   activebackground=xp_colors['frame_bg'],
+                                   selectcolor=xp_colors['frame_bg'])
+    backoff_check.pack(pady=(0, 5))
+
+    # Seed - the same seed and settings always write the same poem
+    seed_frame = tk.LabelFrame(content_frame, text="Seed (blank for random)", 
+                              font=("Tahoma", 11, "bold"), bg=xp_colors['frame_bg'])
+    seed_frame.pack(padx=10, pady=5, fill="x")
+
+    seed_var = tk.StringVar()
+    seed_entry = ttk.Entry(seed_frame, textvariable=seed_var, width=12, font=("Tahoma", 11))
+    seed_entry.pack(pady=5)
+
+    # Add poetic devices frame
+    device_vars = create_poetic_device_frame(content_frame)
+
+    # Generate button with XP styling
+    generate_button = tk.Button(content_frame, text="✨ Generate Poem ✨", 
+                              command=on_generate, font=("Tahoma", 11, "bold"),
+                              bg=xp_colors['button'], relief="raised",
+                              activebackground=xp_colors['highlight'],
+                              activeforeground="white")
+    generate_button.pack(pady=10)
+
+    # Cancel button - only enabled while a poem is being generated
+    cancel_button = tk.Button(content_frame, text="✖ Cancel",
+                            command=cancel_generation, font=("Tahoma", 11),
+                            bg=xp_colors['button'], relief="raised",
+                            activebackground=xp_colors['highlight'],
+                            state="disabled")
+    cancel_button.pack(pady=(0, 10))
+
+    # Output text area with XP styling
+    text_output = scrolledtext.ScrolledText(content_frame, wrap=tk.WORD, 
+                                          width=60, height=12, 
+                                          font=("Lucida Console", 11),
+                                          bg=xp_colors['text_bg'], relief="sunken")
+    text_output.pack(pady=10, padx=10, fill="both", expand=True)
+
+    # Copy button with XP styling
+    copy_button = tk.Button(content_frame, text="📋 Copy to Clipboard", 
+                           command=copy_text, font=("Tahoma", 11),
+                           bg=xp_colors['button'], relief="raised",
+                           activebackground=xp_colors['highlight'])
+    copy_button.pack(pady=5)
+
+    # Add right-click menu
+    popup_menu = Menu(root, tearoff=0)
+    popup_menu.add_command(label="Copy", command=copy_text)
+
+    # Bind events
+    text_output.bind("<Button-3>", show_popup)  # Right click
+    text_output.bind("<Control-c>", lambda e: copy_text())  # Ctrl+C shortcut
+
+    # Add buttons to the UI (add after the copy button)
+    button_frame = tk.Frame(content_frame, bg=xp_colors['frame_bg'])
+    button_frame.pack(pady=5)
+
+    save_button = tk.Button(button_frame, text="💾 Save Poem", 
+                           command=save_current_poem, 
+                           font=themes["Default (Cute)"]['font'],
+                           bg=xp_colors['button'], relief="raised",
+                           activebackground=xp_colors['highlight'])
+    save_button.pack(side=tk.LEFT, padx=5)
+
+    load_button = tk.Button(button_frame, text="📂 Load Poem", 
+                           command=load_saved_poem, 
+                           font=themes["Default (Cute)"]['font'],
+                           bg=xp_colors['button'], relief="raised",
+                           activebackground=xp_colors['highlight'])
+    load_button.pack(side=tk.LEFT, padx=5)
+
+    export_button = tk.Button(button_frame, text="📤 Export", 
+                             command=export_poem, 
+                             font=themes["Default (Cute)"]['font'],
+                             bg=xp_colors['button'], relief="raised",
+                             activebackground=xp_colors['highlight'])
+    export_button.pack(side=tk.LEFT, padx=5)
+
+    # Add to the button frame creation
+    browse_button = tk.Button(button_frame, text="📚 Browse Poems", 
+                             command=lambda: PoemBrowser(root),
+                             font=themes["Default (Cute)"]['font'],
+                             bg=xp_colors['button'], relief="raised",
+                             activebackground=xp_colors['highlight'])
+    browse_button.pack(side=tk.LEFT, padx=5)
+
+    timings_button = tk.Button(button_frame, text="⏱ Timings", 
+                              command=export_timings,
+                              font=themes["Default (Cute)"]['font'],
+                              bg=xp_colors['button'], relief="raised",
+                              activebackground=xp_colors['highlight'])
+    timings_button.pack(side=tk.LEFT, padx=5)
+
+    # Add mouse wheel scrolling
+    def on_mousewheel(event):
+        canvas.yview_scroll(int(-1*(event.delta/120)), "units")
+
+    canvas.bind_all("<MouseWheel>", on_mousewheel)
+
+    # Add after the imports
+    class UndoRedoManager:
+        def __init__(self, text_widget):
+            self.text_widget = text_widget
+            self.undo_stack = []
+            self.redo_stack = []
+            self.last_state = ""
+
+        def save_state(self):
+            """Save current state for undo"""
+            current_state = self.text_widget.get("1.0", "end-1c")
+            if current_state != self.last_state:
+                self.undo_stack.append(self.last_state)
+                self.last_state = current_state
+                self.redo_stack.clear()
+
+        def undo(self):
+            """Restore last state"""
+            if self.undo_stack:
+                current_state = self.text_widget.get("1.0", "end-1c")
+                self.redo_stack.append(current_state)
+                last_state = self.undo_stack.pop()
+                self.text_widget.delete("1.0", tk.END)
+                self.text_widget.insert("1.0", last_state)
+                self.last_state = last_state
+                show_status("Undo")
+
+        def redo(self):
+            """Redo last undone action"""
+            if self.redo_stack:
+                current_state = self.text_widget.get("1.0", "end-1c")
+                self.undo_stack.append(current_state)
+                next_state = self.redo_stack.pop()
+                self.text_widget.delete("1.0", tk.END)
+                self.text_widget.insert("1.0", next_state)
+                self.last_state = next_state
+                show_status("Redo")
+
+    # Create undo manager after text_output creation
+    undo_manager = UndoRedoManager(text_output)
+
+    # Add undo/redo functions
+    def undo_action():
+        undo_manager.undo()
+
+    def redo_action():
+        undo_manager.redo()
+
+    def show_shortcuts():
+        """Display keyboard shortcuts help dialog"""
+        dialog = tk.Toplevel(root)
+        dialog.title("Keyboard Shortcuts")
+        dialog.geometry("400x300")
 
-    if selected_poet and num_lines > 0:
-        file_path = poet_files[selected_poet]
-        try:
-            transition_matrix = preprocess_text(file_path)
-            if not transition_matrix:
-                text_output.delete("1.0", tk.END)
-                text_output.insert(tk.INSERT, "Error: Could not generate poem from empty text file")
-                return
-                
-            start_word = random.choice(list(transition_matrix.keys()))
-            poem = generate_poem(start_word, num_lines, transition_matrix, selected_devices)
-            text_output.delete("1.0", tk.END)
-            text_output.insert(tk.INSERT, poem)
-        except Exception as e:
-            text_output.delete("1.0", tk.END)
-            text_output.insert(tk.INSERT, f"Error generating poem: {e}")
+        # Apply current theme
+        dialog.configure(bg=xp_colors['bg'])
+        current_font = themes[theme_var.get()]['font']
 
-# Add undo/redo functions
-def undo_action():
-    undo_manager.undo()
+        # Create scrollable text area
+        text = scrolledtext.ScrolledText(dialog, font=current_font, 
+                                       bg=xp_colors['text_bg'],
+                                       wrap=tk.WORD)
+        text.pack(fill="both", expand=True, padx=10, pady=10)
 
-def redo_action():
-    undo_manager.redo()
+        # Add shortcuts
+        text.insert("1.0", "Keyboard Shortcuts:\n\n")
+        for shortcut, description in SHORTCUTS.items():
+            text.insert("end", f"{shortcut:<15} - {description}\n")
 
-def show_shortcuts():
-    """Display keyboard shortcuts help dialog"""
-    dialog = tk.Toplevel(root)
-    dialog.title("Keyboard Shortcuts")
-    dialog.geometry("400x300")
-    
-    # Apply current theme
-    dialog.configure(bg=xp_colors['bg'])
-    current_font = themes[theme_var.get()]['font']
-    
-    # Create scrollable text area
-    text = scrolledtext.ScrolledText(dialog, font=current_font, 
-                                   bg=xp_colors['text_bg'],
-                                   wrap=tk.WORD)
-    text.pack(fill="both", expand=True, padx=10, pady=10)
-    
-    # Add shortcuts
-    text.insert("1.0", "Keyboard Shortcuts:\n\n")
-    for shortcut, description in SHORTCUTS.items():
-        text.insert("end", f"{shortcut:<15} - {description}\n")
-    
-    text.configure(state="disabled")
+        text.configure(state="disabled")
 
-# Add help button to button frame
-help_button = tk.Button(button_frame, text="⌨ Shortcuts", 
-                       command=show_shortcuts,
-                       font=themes["Default (Cute)"]['font'],
-                       bg=xp_colors['button'],
-                       activebackground=xp_colors['highlight'])
-help_button.pack(side=tk.LEFT, padx=5)
+    # Add help button to button frame
+    help_button = tk.Button(button_frame, text="⌨ Shortcuts", 
+                           command=show_shortcuts,
+                           font=themes["Default (Cute)"]['font'],
+                           bg=xp_colors['button'],
+                           activebackground=xp_colors['highlight'])
+    help_button.pack(side=tk.LEFT, padx=5)
 
-# Add keyboard shortcuts binding after all GUI elements are created
-root.bind_all('<Key>', handle_shortcut)
+    # Add keyboard shortcuts binding after all GUI elements are created
+    root.bind_all('<Key>', handle_shortcut)
 
-# Start the main loop
-root.mainloop()
+    # Start the main loop
+    root.mainloop()
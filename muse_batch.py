@@ -0,0 +1,142 @@
+"""
+Batch poem generation: fans generate_poem out over a process pool and streams the
+results to a JSON lines file.
+
+    python muse_batch.py --poet "Robert Frost" --count 1000 --seed 42 --workers 8 --output poems.jsonl
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from muse_engine import (build_workers, generate_poem, load_metaphor_lexicon, model_registry,
+                         poet_files, poetic_devices, preprocess_text, resolve_corpus_path,
+                         rhyme_schemes)
+
+# Each worker process loads the model (and metaphor lexicon) once and generates poems in chunks
+_batch_model = None
+_batch_metaphors = None
+
+def _init_batch_worker(poet, depth, backoff=False, metaphors=None):
+    """Process pool initializer: load the poet's model (from the disk cache) once per worker"""
+    global _batch_model, _batch_metaphors
+    _batch_model = model_registry.get(poet, depth, backoff=backoff)
+    _batch_metaphors = load_metaphor_lexicon(metaphors) if metaphors else None
+
+def _generate_batch_chunk(first_index, count, seed, num_lines, devices, rhyme_scheme=None):
+    """Generate poems first_index..first_index+count-1, each seeded with seed + index"""
+    results = []
+    for index in range(first_index, first_index + count):
+        results.append({
+            'index': index,
+            'seed': seed + index,
+            'text': generate_poem(None, num_lines, _batch_model, devices, seed=seed + index,
+                                  metaphors=_batch_metaphors, rhyme_scheme=rhyme_scheme)
+        })
+    return results
+
+def generate_batch(poet, num_lines, devices, count, seed=None, workers=None, output=sys.stdout,
+                   depth=2, chunk_size=50, backoff=False, metaphors=None, rhyme_scheme=None):
+    """
+    Generates count poems across a process pool and streams them to output as JSON lines
+    in completion order. Poem i is seeded with seed + i, so a run can be reproduced.
+    metaphors is the path of a JSON metaphor lexicon for the Metaphor device, and
+    rhyme_scheme (e.g. "ABAB") is passed on to generate_poem.
+    
+    :return: Summary dict with the seed used, poems written, elapsed seconds and poems/sec
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    workers = workers or os.cpu_count() or 1
+    
+    # Build (or validate) the cached model once here so workers only ever load it
+    file_path = resolve_corpus_path(poet)
+    if not preprocess_text(file_path, depth, workers=build_workers(file_path), backoff=backoff):
+        raise ValueError(f"Could not build a model for {poet}")
+    if metaphors:
+        load_metaphor_lexicon(metaphors)  # Report a bad lexicon before starting any workers
+    
+    chunks = ((first, min(chunk_size, count - first)) for first in range(0, count, chunk_size))
+    written = 0
+    start_time = time.perf_counter()
+    
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_batch_worker,
+                             initargs=(poet, depth, backoff, metaphors)) as executor:
+        pending = set()
+        # Keep a bounded number of chunks in flight so huge runs don't queue everything up front
+        for first, size in chunks:
+            pending.add(executor.submit(_generate_batch_chunk, first, size, seed, num_lines, devices,
+                                        rhyme_scheme))
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                written += _write_batch_results(done, output, poet, num_lines, devices)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            written += _write_batch_results(done, output, poet, num_lines, devices)
+    
+    elapsed = time.perf_counter() - start_time
+    return {
+        'seed': seed,
+        'poems': written,
+        'seconds': elapsed,
+        'poems_per_second': written / elapsed if elapsed > 0 else 0.0
+    }
+
+def _write_batch_results(futures, output, poet, num_lines, devices):
+    """Write finished chunks to output as JSON lines and return how many poems were written"""
+    written = 0
+    for future in futures:
+        for result in future.result():
+            record = {'index': result['index'], 'seed': result['seed'], 'poet': poet,
+                      'lines': num_lines, 'devices': devices, 'text': result['text']}
+            output.write(json.dumps(record) + "\n")
+            written += 1
+    output.flush()
+    return written
+
+def batch_main(argv=None):
+    """Command line entry point: python muse_batch.py --poet ... --count ..."""
+    parser = argparse.ArgumentParser(description="Generate many poems in parallel as JSON lines")
+    parser.add_argument('--poet', required=True,
+                        help=f"one of {', '.join(poet_files)} or a path to a corpus file")
+    parser.add_argument('--lines', type=int, default=10, help="lines per poem (default 10)")
+    parser.add_argument('--devices', nargs='*', default=[], choices=poetic_devices,
+                        help="poetic devices to apply")
+    parser.add_argument('--count', type=int, required=True, help="number of poems to generate")
+    parser.add_argument('--seed', type=int, help="base seed (poem i uses seed + i)")
+    parser.add_argument('--workers', type=int, help="worker processes (default: CPU count)")
+    parser.add_argument('--depth', type=int, default=2, help="Markov context depth (default 2)")
+    parser.add_argument('--backoff', action='store_true',
+                        help="back off to shorter contexts instead of ending lines early")
+    parser.add_argument('--rhyme-scheme', choices=[scheme.split()[0] for scheme in rhyme_schemes],
+                        help="write lines to this rhyme scheme")
+    parser.add_argument('--metaphors', metavar='LEXICON',
+                        help="JSON file of {word: metaphor} entries for the Metaphor device")
+    parser.add_argument('--output', default='-', help="JSONL file to write (default: stdout)")
+    args = parser.parse_args(argv)
+    
+    if args.count < 1 or args.lines < 1:
+        parser.error("--count and --lines must be positive")
+    
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    try:
+        summary = generate_batch(args.poet, args.lines, args.devices, args.count, seed=args.seed,
+                                 workers=args.workers, output=output, depth=args.depth,
+                                 backoff=args.backoff, metaphors=args.metaphors,
+                                 rhyme_scheme=args.rhyme_scheme)
+    except (ValueError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    
+    print(f"Generated {summary['poems']} poems in {summary['seconds']:.2f}s "
+          f"({summary['poems_per_second']:.1f} poems/sec, seed {summary['seed']})", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(batch_main())
@@ -0,0 +1,346 @@
+"""
+Reproducible benchmarks for the generation pipeline: model building (preprocess_text),
+poem sampling (generate_poem), rhyme analysis (get_rhyme_pattern, the per-vocabulary
+feature table, find_rhyming_pairs) and the poetic device pass (apply_poetic_devices),
+over the bundled corpora and synthetic scaled-up ones. Every stage runs from fixed seeds
+and records a digest of its output, so two runs on the same code produce the same work.
+
+    python muse_bench.py                                  # run and print a report
+    python muse_bench.py --save bench_baseline.json       # also store the results
+    python muse_bench.py --compare bench_baseline.json    # exit 1 on a regression
+"""
+import argparse
+import gc
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+from muse_engine import (MetaphorLexicon, apply_poetic_devices, build_feature_table,
+                         find_rhyming_pairs, generate_poem, get_rhyme_pattern, poet_files,
+                         poetic_devices, preprocess_text, resolve_corpus_path)
+from muse_trace import percentile
+
+BENCH_SEED = 1234
+
+# Synthetic corpora are shuffled lines of the bundled ones, grown to these sizes in bytes
+SYNTHETIC_SIZES = (2 << 20, 8 << 20)
+
+# Entries in the synthetic lexicon used to time the Metaphor device at scale
+LARGE_LEXICON_SIZE = 5000
+
+# Regressions are latencies or peak memory this much (relative) above the baseline
+DEFAULT_THRESHOLD = 0.15
+
+# Untimed calls made before timing a stage, so one-off setup (imports, the OS file cache,
+# lazily built lookups) isn't counted as the stage's cost
+WARMUP_BUILDS = 1
+WARMUP_POEMS = 10
+
+def digest(values):
+    """Short hash of a stage's outputs, so a run can tell whether results changed"""
+    return hashlib.sha256(json.dumps(values, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+def summarize(timings, poems=0, words=0, peak_bytes=None, output=None, repeated=False):
+    """
+    Benchmark record from per-operation timings (seconds). repeated marks timings of the
+    same work done over and over, whose fastest run (min_ms) is what gets compared: the
+    slower runs only add scheduler and cache noise.
+    """
+    total = sum(timings)
+    record = {
+        'runs': len(timings),
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p90_ms': percentile(timings, 0.90) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'mean_ms': total / len(timings) * 1000
+    }
+    if repeated:
+        record['min_ms'] = min(timings) * 1000
+    if poems:
+        record['poems_per_sec'] = poems / total if total else 0.0
+    if words:
+        record['words_per_sec'] = words / total if total else 0.0
+    if peak_bytes is not None:
+        record['peak_kb'] = peak_bytes / 1024
+    if output is not None:
+        record['digest'] = digest(output)
+    return record
+
+def timed_runs(function, repeats, warmup=WARMUP_BUILDS):
+    """Call function warmup times untimed, then repeats times; returns (seconds, results)"""
+    for _ in range(warmup):
+        function()
+    timings = []
+    results = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        results.append(function())
+        timings.append(time.perf_counter() - start)
+    return timings, results
+
+def peak_memory(function):
+    """Peak bytes traced by tracemalloc while function runs (a separate, untimed run)"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def make_synthetic_corpus(directory, size, seed=BENCH_SEED):
+    """Write a corpus of about size bytes made of shuffled lines of the bundled corpora"""
+    lines = []
+    for poet in poet_files:
+        with open(resolve_corpus_path(poet), 'r', encoding='utf-8') as f:
+            lines.extend(line for line in f.read().splitlines() if line.strip())
+    
+    rng = random.Random(seed)
+    path = os.path.join(directory, f"synthetic_{size >> 20}mb.txt")
+    written = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        while written < size:
+            rng.shuffle(lines)
+            for line in lines:
+                f.write(line + "\n")
+                written += len(line.encode('utf-8')) + 1
+                if written >= size:
+                    break
+    return path
+
+def corpus_word_count(model):
+    """Number of words counted into a model (the length of its source text in words)"""
+    return sum(sum(next_words.values()) for next_words in model.values()) + model.depth
+
+def bench_build(name, path, repeats):
+    """preprocess_text from scratch (no disk cache) on one corpus"""
+    timings, models = timed_runs(lambda: preprocess_text(path, use_cache=False), repeats)
+    model = models[-1]
+    words = corpus_word_count(model) * repeats if model else 0
+    return summarize(timings, words=words,
+                     peak_bytes=peak_memory(lambda: preprocess_text(path, use_cache=False)),
+                     output=[len(model), sorted(model.line_start_contexts)[:50]], repeated=True)
+
+def generate_fixed_poem(model, num_lines, seed):
+    """One poem from a fixed seed without devices, written afresh (not from result_cache)"""
+    return generate_poem(None, num_lines, model, [], seed=seed, use_cache=False)
+
+def generate_fixed_poems(model, count, num_lines, seed):
+    """count poems from fixed seeds (poem i uses seed + i) without devices"""
+    return [generate_fixed_poem(model, num_lines, seed + i) for i in range(count)]
+
+def bench_generate(model, count, num_lines, seed):
+    """generate_poem per poem, without devices"""
+    generate_fixed_poems(model, WARMUP_POEMS, num_lines, seed - WARMUP_POEMS)
+    timings = []
+    poems = []
+    for i in range(count):
+        start = time.perf_counter()
+        poems.append(generate_fixed_poem(model, num_lines, seed + i))
+        timings.append(time.perf_counter() - start)
+    words = sum(len(poem.split()) for poem in poems)
+    peak = peak_memory(lambda: generate_fixed_poems(model, min(count, 50), num_lines, seed))
+    return summarize(timings, poems=count, words=words, peak_bytes=peak, output=poems)
+
+def bench_rhyme_pattern(words, batch_size=1000):
+    """get_rhyme_pattern over a fixed word list, timed in batches (reported per batch)"""
+    timings = []
+    patterns = []
+    for first in range(0, len(words), batch_size):
+        batch = words[first:first + batch_size]
+        start = time.perf_counter()
+        patterns.extend(get_rhyme_pattern(word) for word in batch)
+        timings.append(time.perf_counter() - start)
+    return summarize(timings, words=len(words), output=patterns)
+
+def bench_feature_table(words, repeats):
+    """build_feature_table over a fixed word list (what each model build adds)"""
+    timings, tables = timed_runs(lambda: build_feature_table(words), repeats)
+    return summarize(timings, words=len(words) * repeats,
+                     peak_bytes=peak_memory(lambda: build_feature_table(words)),
+                     output=[tables[-1][word] for word in words], repeated=True)
+
+def bench_per_poem(function, poems):
+    """A per-poem function over a fixed list of poems"""
+    timings = []
+    outputs = []
+    for poem in poems:
+        start = time.perf_counter()
+        outputs.append(function(poem))
+        timings.append(time.perf_counter() - start)
+    words = sum(len(poem.split()) for poem in poems)
+    return summarize(timings, poems=len(poems), words=words, output=outputs)
+
+def run_benchmarks(poems_per_poet=200, num_lines=10, build_repeats=5,
+                   synthetic_sizes=SYNTHETIC_SIZES, seed=BENCH_SEED, log=None):
+    """
+    Run every stage and return {'meta': ..., 'results': {benchmark name: record}}.
+    Records have latency percentiles in ms, throughput where it applies, peak memory
+    for the stages that allocate, and a digest of the outputs.
+    """
+    log = log or (lambda message: None)
+    results = {}
+    
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        corpora = {poet: resolve_corpus_path(poet) for poet in poet_files}
+        for size in synthetic_sizes:
+            corpora[f"synthetic {size >> 20}MB"] = make_synthetic_corpus(synthetic_dir, size, seed)
+        
+        models = {}
+        for name, path in corpora.items():
+            log(f"preprocess_text: {name}")
+            results[f"preprocess_text/{name}"] = bench_build(name, path, build_repeats)
+            if name in poet_files:
+                models[name] = preprocess_text(path, use_cache=False)
+    
+    poems = []
+    vocabulary = set()
+    feature_words = set()
+    for poet, model in models.items():
+        if not model:
+            continue  # An empty corpus has nothing to sample
+        log(f"generate_poem: {poet}")
+        results[f"generate_poem/{poet}"] = bench_generate(model, poems_per_poet, num_lines, seed)
+        poems.extend(generate_fixed_poems(model, poems_per_poet, num_lines, seed))
+        vocabulary.update(word for next_words in model.values() for word in next_words)
+        feature_words.update(model.features)
+    # One table over every model's vocabulary, like the ones generate_poem hands the devices
+    features = build_feature_table(sorted(feature_words))
+    
+    log("get_rhyme_pattern")
+    words = sorted(vocabulary)
+    random.Random(seed).shuffle(words)
+    results["get_rhyme_pattern/vocabulary"] = bench_rhyme_pattern(words)
+    
+    log("build_feature_table")
+    results["build_feature_table/vocabulary"] = bench_feature_table(words, build_repeats)
+    
+    log("find_rhyming_pairs")
+    results["find_rhyming_pairs/poems"] = bench_per_poem(
+        lambda poem: find_rhyming_pairs(poem.split("\n"), features), poems)
+    
+    for device in poetic_devices + ["all"]:
+        devices = poetic_devices if device == "all" else [device]
+        log(f"apply_poetic_devices: {device}")
+        results[f"apply_poetic_devices/{device}"] = bench_per_poem(
+            lambda poem: apply_poetic_devices(poem, devices, features), poems)
+    
+    # A lexicon of thousands of vocabulary words, as loaded with load_metaphor_lexicon
+    log("apply_poetic_devices: Metaphor (large lexicon)")
+    lexicon = MetaphorLexicon({word: f"the {word} of dreams"
+                               for word in sorted(vocabulary)[:LARGE_LEXICON_SIZE]})
+    results[f"apply_poetic_devices/Metaphor {LARGE_LEXICON_SIZE}"] = bench_per_poem(
+        lambda poem: apply_poetic_devices(poem, ["Metaphor"], features, lexicon), poems)
+    
+    return {
+        'meta': {
+            'date': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': seed,
+            'poems_per_poet': poems_per_poet,
+            'num_lines': num_lines,
+            'build_repeats': build_repeats
+        },
+        'results': results
+    }
+
+def compare_results(current, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compare two run_benchmarks results. Returns (regressions, notes): regressions are
+    benchmarks whose latency (the fastest run for repeated work, else p50) or peak memory
+    grew by more than threshold; notes list benchmarks that are new, missing, faster, or
+    whose output digest changed.
+    """
+    regressions = []
+    notes = []
+    for name, record in current['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            notes.append(f"{name}: new benchmark")
+            continue
+        latency = 'min_ms' if 'min_ms' in record and 'min_ms' in old else 'p50_ms'
+        for metric in (latency, 'peak_kb'):
+            if metric not in record or metric not in old or old[metric] <= 0:
+                continue
+            change = record[metric] / old[metric] - 1
+            line = f"{name} {metric}: {old[metric]:.3f} -> {record[metric]:.3f} ({change:+.1%})"
+            if change > threshold:
+                regressions.append(line)
+            elif change < -threshold:
+                notes.append(line)
+        if record.get('digest') != old.get('digest'):
+            notes.append(f"{name}: output changed for the same seed")
+    for name in baseline['results']:
+        if name not in current['results']:
+            notes.append(f"{name}: missing from this run")
+    return regressions, notes
+
+def format_report(results):
+    """Plain text table of a run_benchmarks result"""
+    header = (f"{'benchmark':<42}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+              f"{'poems/s':>11}{'words/s':>13}{'peak KB':>11}")
+    lines = [header, '-' * len(header)]
+    for name, record in results['results'].items():
+        poems = f"{record['poems_per_sec']:.1f}" if 'poems_per_sec' in record else '-'
+        words = f"{record['words_per_sec']:.0f}" if 'words_per_sec' in record else '-'
+        peak = f"{record['peak_kb']:.0f}" if 'peak_kb' in record else '-'
+        lines.append(f"{name:<42}{record['p50_ms']:>10.3f}{record['p90_ms']:>10.3f}"
+                     f"{record['p99_ms']:>10.3f}{poems:>11}{words:>13}{peak:>11}")
+    return "\n".join(lines)
+
+def bench_main(argv=None):
+    """Command line entry point: python muse_bench.py [--save FILE] [--compare FILE]"""
+    parser = argparse.ArgumentParser(description="Benchmark the poem generation pipeline")
+    parser.add_argument('--poems', type=int, default=200,
+                        help="poems generated per poet (default 200)")
+    parser.add_argument('--lines', type=int, default=10, help="lines per poem (default 10)")
+    parser.add_argument('--repeats', type=int, default=5,
+                        help="timed builds per corpus for preprocess_text (default 5)")
+    parser.add_argument('--synthetic-mb', type=int, nargs='*',
+                        default=[size >> 20 for size in SYNTHETIC_SIZES],
+                        help="sizes of the synthetic corpora in MB (default 2 8)")
+    parser.add_argument('--seed', type=int, default=BENCH_SEED, help="base seed")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="baseline JSON file to check for regressions")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="relative slowdown counted as a regression (default 0.15)")
+    parser.add_argument('--strict-output', action='store_true',
+                        help="with --compare, also fail if any output digest changed")
+    args = parser.parse_args(argv)
+    
+    results = run_benchmarks(args.poems, args.lines, args.repeats,
+                             [size << 20 for size in args.synthetic_mb], args.seed,
+                             log=lambda message: print(f"  {message}", file=sys.stderr))
+    print(format_report(results))
+    
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        print(f"\nSaved results to {args.save}")
+    
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions, notes = compare_results(results, baseline, args.threshold)
+        print(f"\nCompared with {args.compare} (threshold {args.threshold:.0%}):")
+        for line in notes:
+            print(f"  note: {line}")
+        for line in regressions:
+            print(f"  REGRESSION: {line}")
+        output_changed = any(line.endswith("output changed for the same seed") for line in notes)
+        if regressions or (args.strict_output and output_changed):
+            return 1
+        print("  no regressions")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(bench_main())
@@ -0,0 +1,2420 @@
+"""
+Markov's Muse poem engine: corpus tokenizing, model building and caching, and poem
+generation. Nothing here touches Tk, so it can be imported by workers, services and
+scripts; markovsmuse.py builds the GUI on top of it.
+"""
+import random
+import re
+import io
+import codecs
+import json
+import os
+import sys
+import threading
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from collections.abc import Mapping
+from functools import lru_cache
+from itertools import accumulate
+from bisect import bisect_left, bisect_right
+from array import array
+
+from muse_trace import tracer
+
+# Corpus files in poet_files are looked up next to this module unless given as absolute paths
+CORPUS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Step 1: Data Collection - Dictionary containing available poets and their respective text files
+poet_files = {
+    "Emily Dickinson": "dickinson.txt",  # Replace with actual file paths
+    "Robert Frost": "frost.txt",
+    "William Shakespeare": "shakespeare.txt",
+    "Edgar Allan Poe": "poe.txt",
+}
+
+# List of available poetic devices that the user can apply to the poem
+poetic_devices = [
+    "Alliteration",
+    "Repetition", 
+    "Rhyme",  # This will become a parent option
+    "Metaphor"
+]
+
+# Add rhyme scheme options
+rhyme_schemes = [
+    "AABB (Paired)",
+    "ABAB (Alternating)",
+    "ABBA (Enclosed)"
+]
+
+def resolve_corpus_path(poet):
+    """
+    Path to the corpus for a poet name in poet_files (under CORPUS_DIR); anything else is
+    taken as a path of its own, relative to the current directory.
+    """
+    if poet in poet_files:
+        return os.path.join(CORPUS_DIR, poet_files[poet])
+    return os.path.abspath(poet)
+
+# Tokenizer settings - these are part of the model cache key, so changing any of them
+# automatically invalidates previously cached models
+ROMAN_NUMERAL_PATTERN = r'\b[IVXLCDM]+\b'
+WORD_PATTERN = r'\b[a-zA-Z]+\b'
+STOP_WORDS = frozenset({
+    "a", "an", "the", "and", "or", "but", "is", "in", "on", "at", "by", "with",
+    "of", "to", "for", "as", "was", "were", "be", "am", "are", "it", "this", "that"
+})
+
+_ROMAN_NUMERAL_RE = re.compile(ROMAN_NUMERAL_PATTERN)
+_WORD_RE = re.compile(WORD_PATTERN)
+_UP_TO_LAST_SPACE_RE = re.compile(r'.*\s', re.DOTALL)
+
+# Bytes read from a corpus at a time when building a model
+READ_CHUNK_SIZE = 1 << 20
+
+# Earlier content hashes remembered per corpus, so appends can reuse an older cached model
+SOURCE_HISTORY_LENGTH = 8
+
+# Bump this whenever the tokenizer or the pickled model layout changes
+MODEL_CACHE_VERSION = 11
+
+def get_cache_directory():
+    """Get or create the compiled model cache directory (override with MARKOVSMUSE_CACHE_DIR)"""
+    cache_path = os.environ.get('MARKOVSMUSE_CACHE_DIR')
+    if not cache_path:
+        docs_path = os.path.join(os.path.expanduser('~'), 'Documents')
+        cache_path = os.path.join(docs_path, 'MarkovsMuse', 'model_cache')
+    
+    os.makedirs(cache_path, exist_ok=True)
+    
+    return cache_path
+
+def tokenizer_fingerprint():
+    """Short hash of everything that affects how a corpus is turned into words"""
+    import hashlib  # Cache-only dependencies are imported lazily to keep engine import fast
+    settings = json.dumps([MODEL_CACHE_VERSION, ROMAN_NUMERAL_PATTERN, WORD_PATTERN,
+                           sorted(STOP_WORDS)])
+    return hashlib.sha256(settings.encode('utf-8')).hexdigest()[:12]
+
+def _write_atomic(path, data):
+    """
+    Write bytes to path via a temp file so readers never see a half-written file. The temp
+    file gets a unique name, so threads or processes writing the same path never share one.
+    """
+    import tempfile
+    
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=f"{os.path.basename(path)}.",
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def file_fingerprint(file_path):
+    """
+    Returns the SHA-256 of a corpus file. Hashes are remembered in the cache directory
+    against the file's size and mtime, so an unchanged file is never re-read just to hash it.
+    """
+    import hashlib
+    
+    stat = os.stat(file_path)
+    index_path = os.path.join(get_cache_directory(), 'sources.json')
+    source_key = os.path.abspath(file_path)
+    
+    try:
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    
+    entry = index.get(source_key)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+    
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    
+    history = []
+    if entry:
+        # The previous version's size is where text appended to it starts
+        history = [{'sha256': entry['sha256'], 'size': entry['size']}] + [
+            item for item in entry.get('history', []) if isinstance(item, dict)]
+        history = [item for item in history if item['sha256'] != digest.hexdigest()]
+    index[source_key] = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': digest.hexdigest(),
+        'history': history[:SOURCE_HISTORY_LENGTH]  # Previous versions, newest first
+    }
+    _write_atomic(index_path, json.dumps(index, indent=4).encode('utf-8'))
+    if len(history) > SOURCE_HISTORY_LENGTH:
+        prune_model_cache()  # Models of versions that fell out of the history can go
+    return digest.hexdigest()
+
+def model_cache_path(file_path, depth, sha256=None, model_class=None):
+    """
+    Location of the cached model for this corpus content (or given hash), depth, model
+    class (default MarkovModel) and tokenizer
+    """
+    sha256 = sha256 or file_fingerprint(file_path)
+    kind = (model_class or MarkovModel).__name__
+    filename = f"{sha256[:32]}_d{depth}_{kind}_{tokenizer_fingerprint()}.pickle"
+    return os.path.join(get_cache_directory(), filename)
+
+def load_cached_model(file_path, depth=2, sha256=None, model_class=None):
+    """
+    Return the cached model of model_class (default MarkovModel) for file_path, or None if
+    there isn't a valid one. Pass sha256 to load the model cached for an earlier version
+    of the file instead.
+    """
+    import pickle
+    
+    model_class = model_class or MarkovModel
+    try:
+        with open(model_cache_path(file_path, depth, sha256, model_class), 'rb') as f:
+            model = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        # A corrupt or incompatible cache entry is just a miss - it gets rebuilt and overwritten
+        print(f"Warning: ignoring unreadable model cache for {file_path}: {e}")
+        return None
+    return model if type(model) is model_class else None
+
+def find_appended_base(file_path, depth=2, model_class=None):
+    """
+    If file_path only had text appended since one of its earlier versions was cached,
+    return (model, offset): that version's cached model of model_class and the byte offset
+    where the new text starts. Otherwise (edited, truncated, never cached) return None.
+    
+    The old version must have ended with a newline, so the new text starts a fresh line
+    and can't have joined onto the old last word.
+    """
+    import hashlib
+    
+    file_fingerprint(file_path)  # Brings the file's hash history up to date
+    try:
+        with open(os.path.join(get_cache_directory(), 'sources.json'), 'r', encoding='utf-8') as f:
+            entry = json.load(f).get(os.path.abspath(file_path))
+    except (OSError, ValueError):
+        return None
+    if not entry:
+        return None
+    
+    # The history holds each earlier version's size, so only the chosen base is unpickled
+    size = os.path.getsize(file_path)
+    for item in entry.get('history', []):
+        if not isinstance(item, dict):
+            continue  # Written by an older version, without the size
+        sha256, offset = item['sha256'], item['size']
+        if not 0 < offset < size or not os.path.exists(
+                model_cache_path(file_path, depth, sha256, model_class)):
+            continue
+        
+        # The stored offset and hash must describe exactly the start of the current file
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            remaining = offset
+            while remaining:
+                block = f.read(min(remaining, 1 << 20))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+                last_byte = block[-1:]
+        if remaining == 0 and last_byte == b'\n' and digest.hexdigest() == sha256:
+            model = load_cached_model(file_path, depth, sha256, model_class)
+            if model is not None and (model.counter_state or {}).get('source_bytes') == offset:
+                return model, offset
+    return None
+
+def save_cached_model(file_path, depth, model):
+    """
+    Store a built model in the on-disk model cache. The model is pickled whole, with its
+    sampling tables ready to use, so loading it from the cache rebuilds nothing.
+    """
+    import pickle
+    
+    try:
+        _write_atomic(model_cache_path(file_path, depth, model_class=type(model)),
+                      pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception as e:
+        print(f"Warning: could not cache model for {file_path}: {e}")
+    prune_model_cache()
+
+def prune_model_cache():
+    """
+    Delete cached models that can never be loaded again: those written under other
+    tokenizer settings or cache versions, and those for file contents that no corpus
+    in sources.json has now or remembers in its history.
+    """
+    cache_dir = get_cache_directory()
+    try:
+        with open(os.path.join(cache_dir, 'sources.json'), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return  # Without the index there's no telling which entries are still wanted
+    
+    live = set()
+    for entry in index.values():
+        live.add(entry['sha256'][:32])
+        live.update(item['sha256'][:32] for item in entry.get('history', [])
+                    if isinstance(item, dict))
+    current = tokenizer_fingerprint()
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.pickle'):
+            continue
+        parts = name[:-len('.pickle')].split('_')
+        if parts[0] not in live or parts[-1] != current:
+            try:
+                os.remove(os.path.join(cache_dir, name))
+            except OSError:
+                pass  # Already gone, or in use on a platform that won't delete open files
+
+def _pick_other(candidates, word, i, rng):
+    """Uniform pick from candidates excluding word, which sits at index i if present"""
+    count = len(candidates)
+    if i < count and candidates[i] == word:
+        if count == 1:
+            return None
+        pick = rng.randrange(count - 1)
+        return candidates[pick + 1 if pick >= i else pick]
+    return rng.choice(candidates)
+
+def tokenize_line(text):
+    """Lower-cased words of a piece of text, without Roman numerals, symbols or stop words"""
+    # Remove Roman numerals (common in classic poetry collections)
+    text = _ROMAN_NUMERAL_RE.sub('', text)
+    
+    # Extract words while preserving only alphabetical words (removes numbers and symbols)
+    return [word for word in _WORD_RE.findall(text.lower()) if word not in STOP_WORDS]
+
+def _iter_text_chunks(file_path, chunk_size, start=0, end=None):
+    """
+    Decoded text of a corpus (or of its bytes start..end) chunk_size bytes at a time,
+    with the same UTF-8 decoding and newline translation as open(file_path, 'r').
+    """
+    decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder('utf-8')(), translate=True)
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        remaining = None if end is None else end - start
+        while True:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            with tracer.span('read'):
+                data = f.read(size) if size else b''
+                text = decoder.decode(data, final=not data)
+            if remaining is not None:
+                remaining -= len(data)
+            if text:
+                yield text
+            if not data:
+                break
+
+def iter_corpus_pieces(file_path, chunk_size=READ_CHUNK_SIZE, start=0, end=None):
+    """
+    Reads a corpus (or its bytes start..end) chunk_size bytes at a time and yields
+    (text, starts_line) pieces. Pieces are whole lines wherever possible; a line longer
+    than a chunk is split after its last whitespace, so no word is ever cut in half and
+    tokenizing the pieces gives exactly the words of the whole text.
+    """
+    carry = ''
+    carry_starts_line = True
+    for chunk in _iter_text_chunks(file_path, chunk_size, start, end):
+        buffer = carry + chunk
+        
+        last_newline = buffer.rfind('\n')
+        if last_newline >= 0:
+            for i, line in enumerate(buffer[:last_newline].split('\n')):
+                yield line, carry_starts_line or i > 0
+            carry = buffer[last_newline + 1:]
+            carry_starts_line = True
+        elif (match := _UP_TO_LAST_SPACE_RE.match(buffer)):
+            # One very long line - hand over everything up to its last whitespace
+            yield match.group(), carry_starts_line
+            carry = buffer[match.end():]
+            carry_starts_line = False
+        else:
+            carry = buffer
+    
+    yield carry, carry_starts_line
+
+class NgramCounter:
+    """
+    Counts depth-word contexts and the words that follow them from text fed in pieces.
+    The last depth words are carried between pieces, so feeding a corpus line by line
+    (or in any other split) gives exactly the counts of one pass over the whole text.
+    Also records, in first-seen order, the contexts that open a line of the source.
+    """
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.transition_matrix = defaultdict(lambda: defaultdict(int))
+        self.line_starts = {}  # Used as an ordered set
+        self.position = 0  # Number of words fed so far
+        self.head = []  # The first depth words, needed to stitch shards together
+        self._window = deque(maxlen=depth)
+        self._pending_line_starts = deque()  # Positions of line-initial words not yet counted
+        self._awaiting_line_start = True
+    
+    def feed_text(self, text, starts_line=True):
+        """
+        Tokenize and count a piece of text. starts_line says whether it begins a new line
+        of the source; the first word of each line marks a line-start context.
+        """
+        if starts_line:
+            self._awaiting_line_start = True
+        words = tokenize_line(text)
+        if words:
+            self.feed_words(words, self._awaiting_line_start)
+            self._awaiting_line_start = False
+    
+    def feed_words(self, words, line_start=False):
+        """Count already tokenized words; line_start marks the first one as opening a line"""
+        if line_start and words:
+            self._pending_line_starts.append(self.position)
+        if len(self.head) < self.depth:
+            self.head.extend(words[:self.depth - len(self.head)])
+        
+        depth = self.depth
+        window = self._window
+        pending = self._pending_line_starts
+        transition_matrix = self.transition_matrix
+        for word in words:
+            if len(window) == depth:
+                key = tuple(window)  # Use 'depth' words as context
+                transition_matrix[key][word] += 1  # Count occurrences
+                if pending and pending[0] == self.position - depth:
+                    pending.popleft()
+                    self.line_starts[key] = None
+            window.append(word)
+            self.position += 1
+    
+    def state(self):
+        """Where counting stopped, so text appended later can be counted on its own"""
+        return {
+            'tail': list(self._window),
+            'position': self.position,
+            'pending_line_starts': list(self._pending_line_starts),
+            'head': list(self.head)
+        }
+    
+    @classmethod
+    def resume(cls, depth, state):
+        """
+        A counter with no counts, positioned at the end of a text whose state() this is.
+        Whatever is fed to it next is counted as a continuation of that text, starting
+        on a new line, and its transition_matrix holds only the new counts.
+        """
+        counter = cls(depth)
+        counter._window.extend(state['tail'])
+        counter.position = state['position']
+        counter._pending_line_starts.extend(state['pending_line_starts'])
+        counter.head = list(state['head'])
+        return counter
+    
+    def shard_summary(self):
+        """
+        Everything merge_shard needs from a counter that saw one shard of a corpus:
+        its interior counts plus the words and line starts at its edges.
+        """
+        return {
+            'transition_matrix': {key: dict(next_words)
+                                  for key, next_words in self.transition_matrix.items()},
+            'line_starts': list(self.line_starts),
+            'pending_line_starts': list(self._pending_line_starts),
+            'head': self.head,
+            'tail': list(self._window),
+            'words': self.position
+        }
+    
+    def merge_shard(self, shard):
+        """
+        Fold in the shard_summary of the next shard of the corpus. Shards must be merged
+        in order; the result is identical to feeding their text here directly.
+        """
+        base = self.position
+        head = shard['head']
+        
+        # Seam transitions: contexts that start in earlier shards and end in this one's head.
+        # Line starts near this shard's end are still waiting for words from later shards.
+        self.feed_words(head)
+        self._pending_line_starts.extend(base + p for p in shard['pending_line_starts'])
+        
+        # Interior transitions were counted by the worker, all positioned after the seam
+        transition_matrix = self.transition_matrix
+        for key, next_words in shard['transition_matrix'].items():
+            counts = transition_matrix[key]
+            for word, count in next_words.items():
+                counts[word] += count
+        self.line_starts.update(dict.fromkeys(shard['line_starts']))
+        
+        if shard['words'] > len(head):
+            self._window.clear()
+            self._window.extend(shard['tail'])
+        self.position = base + shard['words']
+    
+    def payload(self):
+        """The counts as model constructor arguments (plain dicts, safe to pickle)"""
+        transition_matrix = {key: dict(next_words)
+                             for key, next_words in self.transition_matrix.items()}
+        features = build_feature_table(model_vocabulary(transition_matrix))
+        return {
+            'transition_matrix': transition_matrix,
+            'line_starts': list(self.line_starts),
+            'rhyme_index': build_rhyme_index(
+                {word for next_words in transition_matrix.values() for word in next_words},
+                features),
+            'features': features,
+            'counter_state': self.state()
+        }
+
+def _count_corpus_shard(file_path, start, end, depth):
+    """Process pool worker: count the n-grams of bytes start..end of a corpus"""
+    counter = NgramCounter(depth)
+    for piece, starts_line in iter_corpus_pieces(file_path, start=start, end=end):
+        counter.feed_text(piece, starts_line)
+    return counter.shard_summary()
+
+def shard_offsets(file_path, shards):
+    """Byte offsets that split a corpus into about `shards` equal pieces on line boundaries"""
+    size = os.path.getsize(file_path)
+    offsets = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, shards):
+            f.seek(max(size * i // shards, offsets[-1]))
+            f.readline()  # Move to the start of the next line
+            if f.tell() >= size:
+                break
+            if f.tell() > offsets[-1]:
+                offsets.append(f.tell())
+    offsets.append(size)
+    return offsets
+
+# Corpora at least this large are counted across a process pool when they have to be built
+PARALLEL_BUILD_BYTES = 32 << 20
+
+def build_workers(file_path):
+    """Processes to count a corpus with: one per CPU from PARALLEL_BUILD_BYTES up, else 1"""
+    try:
+        size = os.path.getsize(file_path)
+    except OSError:
+        return 1
+    return (os.cpu_count() or 1) if size >= PARALLEL_BUILD_BYTES else 1
+
+def count_corpus_parallel(file_path, depth=2, workers=None, shards=None):
+    """
+    Counts a corpus across a process pool: the file is cut into line-aligned shards,
+    each worker counts one shard, and the shard counts are merged in order (stitching the
+    depth-word seams between them) into an NgramCounter identical to a serial build.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    
+    workers = workers or os.cpu_count() or 1
+    offsets = shard_offsets(file_path, shards or workers * 2)
+    counter = NgramCounter(depth)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(_count_corpus_shard, [file_path] * (len(offsets) - 1),
+                               offsets[:-1], offsets[1:], [depth] * (len(offsets) - 1))
+        for shard in results:  # map() yields in shard order, so merging overlaps counting
+            counter.merge_shard(shard)
+    return counter
+
+class MarkovModel(Mapping):
+    """
+    Frozen, read-only sampling view of a transition matrix. Each context stores its
+    successors and their cumulative weights once, so drawing the next word is a single
+    bisect with no per-step list building. Reads like the original nested dict (counts
+    are worked back out of the cumulative weights), and is cached on disk as it is.
+    
+    Start contexts are kept in indexable tuples so picking one never materialises the
+    key list: uniformly, weighted by how often a context occurs, or among the contexts
+    that open a line in the source text (line_starts).
+    
+    rhyme_index maps each rhyme ending to the sorted successor words that have it, so
+    finding a rhyme is a lookup plus one random pick (built here unless cached).
+    
+    counter_state is the NgramCounter state at the end of the source text; with it,
+    update_model can add appended text without recounting the rest.
+    
+    features is a FeatureTable of every vocabulary word's WordFeatures, worked out once at
+    build time and cached with the model, so rhyme code only looks words up.
+    """
+    def __init__(self, transition_matrix, depth=2, line_starts=(), rhyme_index=None,
+                 features=None, counter_state=None):
+        self.depth = depth
+        self.counter_state = counter_state
+        self.fingerprint = None  # See model_fingerprint
+        if not isinstance(features, FeatureTable):
+            features = FeatureTable(tuple(model_vocabulary(transition_matrix)), source=features)
+        self.features = features
+        self._sampling_table = {
+            key: (tuple(next_words), tuple(accumulate(next_words.values())))
+            for key, next_words in transition_matrix.items()
+        }
+        self.contexts = tuple(transition_matrix)
+        self.line_start_contexts = tuple(key for key in line_starts if key in self._sampling_table)
+        self._context_weights = tuple(accumulate(
+            cum_weights[-1] for _, cum_weights in self._sampling_table.values()))
+        if rhyme_index is None:
+            rhyme_index = build_rhyme_index(
+                {word for next_words, _ in self._sampling_table.values() for word in next_words},
+                features)
+        self.rhyme_index = rhyme_index
+        self._reverse = _build_reverse_chain(transition_matrix, depth, features, counter_state)
+    
+    def __getitem__(self, key):
+        next_words, cum_weights = self._sampling_table[key]
+        return dict(zip(next_words, (b - a for a, b in zip((0,) + cum_weights, cum_weights))))
+    
+    def __iter__(self):
+        return iter(self._sampling_table)
+    
+    def __len__(self):
+        return len(self._sampling_table)
+    
+    def __contains__(self, key):
+        return key in self._sampling_table
+    
+    def sample_next(self, key, rng=random):
+        """Draw a successor of key weighted by its count, or None if key has none"""
+        entry = self._sampling_table.get(key)
+        if entry is None:
+            return None
+        next_words, cum_weights = entry
+        # Same draw as random.choices(next_words, weights=...) for a given random state
+        return next_words[bisect_right(cum_weights, rng.random() * cum_weights[-1],
+                                       0, len(next_words) - 1)]
+    
+    def random_context(self, rng=random, mode='uniform'):
+        """
+        Pick a start context without building a key list: mode is 'uniform',
+        'weighted' (by context frequency) or 'line' (contexts that open a source line,
+        falling back to uniform). Returns None for an empty model.
+        """
+        if not self.contexts:
+            return None
+        if mode == 'line' and self.line_start_contexts:
+            return rng.choice(self.line_start_contexts)
+        if mode == 'weighted':
+            weights = self._context_weights
+            return self.contexts[bisect_right(weights, rng.random() * weights[-1],
+                                              0, len(weights) - 1)]
+        return rng.choice(self.contexts)
+    
+    def find_rhyme(self, word, rng=random):
+        """A random vocabulary word with the same rhyme ending as word (never word itself)"""
+        ending = lookup_features(self.features, word).rhyme_ending
+        candidates = self.rhyme_index.get(ending) if ending else None
+        if not candidates:
+            return None
+        return _pick_other(candidates, word, bisect_left(candidates, word), rng)
+    
+    def reverse_chain(self):
+        """The model's ReverseChain (for lines that must end on a word)"""
+        return self._reverse
+    
+    def nbytes(self):
+        """Rough memory footprint of the sampling, start and rhyme tables"""
+        total = sys.getsizeof(self._sampling_table)
+        words = set()
+        for key, (next_words, cum_weights) in self._sampling_table.items():
+            total += sys.getsizeof(key) + sys.getsizeof(next_words) + sys.getsizeof(cum_weights)
+            words.update(key)
+            words.update(next_words)
+        total += sum(sys.getsizeof(word) for word in words)
+        total += sys.getsizeof(self.contexts) + sys.getsizeof(self.line_start_contexts)
+        total += sys.getsizeof(self.rhyme_index)
+        total += sum(sys.getsizeof(bucket) for bucket in self.rhyme_index.values())
+        total += self.features.nbytes()
+        total += self._reverse.nbytes()
+        return total + sys.getsizeof(self._context_weights)
+    
+    def payload(self):
+        """The model as constructor arguments, from which any model class can be built"""
+        return {
+            'transition_matrix': dict(self.items()),
+            'line_starts': list(self.line_start_contexts),
+            'rhyme_index': self.rhyme_index,
+            'features': self.features,
+            'counter_state': self.counter_state
+        }
+    
+    def extended(self, counter):
+        """
+        A new model with the counts of a resumed NgramCounter added. Only the contexts the
+        new text touched are re-frozen and only new words are filed into rhyme buckets;
+        everything else is shared with this model, which is left unchanged.
+        """
+        sampling_table = dict(self._sampling_table)
+        new_contexts = []
+        new_words = set()
+        for key, counts in counter.transition_matrix.items():
+            next_words = self.get(key)
+            if next_words is None:
+                new_contexts.append(key)
+                next_words = dict(counts)
+                new_words.update(counts)
+            else:
+                for word, count in counts.items():
+                    if word not in next_words:
+                        new_words.add(word)
+                        next_words[word] = count
+                    else:
+                        next_words[word] += count
+            sampling_table[key] = (tuple(next_words), tuple(accumulate(next_words.values())))
+        
+        model = self._extended_with(counter, new_contexts, new_words)
+        model._sampling_table = sampling_table
+        model._context_weights = tuple(accumulate(
+            sampling_table[key][1][-1] for key in model.contexts))
+        return model
+    
+    def _extended_with(self, counter, new_contexts, new_words):
+        """
+        A new model of this class for extended(), holding everything but the forward
+        tables: new_contexts are the contexts the counter added, and new_words the
+        successors it gave contexts that didn't have them before.
+        """
+        features = self.features.extended(
+            [word for key in new_contexts for word in key] + sorted(new_words))
+        rhyme_index = dict(self.rhyme_index)
+        for word in new_words:
+            ending = features[word].rhyme_ending
+            if ending:
+                bucket = rhyme_index.get(ending, ())
+                i = bisect_left(bucket, word)
+                if i == len(bucket) or bucket[i] != word:
+                    rhyme_index[ending] = bucket[:i] + (word,) + bucket[i:]
+        
+        known_starts = set(self.line_start_contexts)
+        model = object.__new__(type(self))
+        model.depth = self.depth
+        model.counter_state = counter.state()
+        model.fingerprint = None
+        model.contexts = self.contexts + tuple(new_contexts)
+        model.line_start_contexts = self.line_start_contexts + tuple(
+            key for key in counter.line_starts if key not in known_starts)
+        model.rhyme_index = rhyme_index
+        model.features = features
+        word_ids = features._index
+        model._reverse = self._reverse.extended(_id_rows(counter.transition_matrix, word_ids),
+                                                tuple(word_ids), word_ids, counter.head)
+        return model
+
+class CompactMarkovModel(Mapping):
+    """
+    Memory-lean alternative to MarkovModel with the same sampling interface. Words are
+    interned to integer ids, each context is packed into a single integer, and successors
+    live in flat arrays in CSR layout: row i's successors are successor_ids[offsets[i]:offsets[i+1]]
+    with matching cumulative counts. Contexts are looked up by binary search over the
+    sorted packed keys, and iterate in the same order as the matrix they were built from.
+    """
+    def __init__(self, transition_matrix, depth=2, line_starts=(), rhyme_index=None,
+                 features=None, counter_state=None):
+        self.depth = depth
+        self.counter_state = counter_state
+        self.fingerprint = None  # See model_fingerprint
+        
+        # Intern every word to an integer id
+        word_ids = {}
+        for key, next_words in transition_matrix.items():
+            for word in key:
+                word_ids.setdefault(word, len(word_ids))
+            for word in next_words:
+                word_ids.setdefault(word, len(word_ids))
+        self.words = tuple(word_ids)
+        self._word_ids = word_ids
+        self._base = max(len(word_ids), 1)
+        
+        # Rows are stored sorted by packed context so lookups can bisect
+        packed = [self._pack(key) for key in transition_matrix]
+        rows = sorted(range(len(packed)), key=packed.__getitem__)
+        key_type = 'Q' if self._base ** depth < 2 ** 64 else None
+        sorted_keys = [packed[i] for i in rows]
+        self._keys = array(key_type, sorted_keys) if key_type else sorted_keys
+        
+        matrix_rows = list(transition_matrix.values())
+        self._offsets = array('I', [0])
+        self._successor_ids = array('I')
+        self._cum_counts = array('I')
+        for i in rows:
+            next_words = matrix_rows[i]
+            self._successor_ids.extend(word_ids[word] for word in next_words)
+            self._cum_counts.extend(accumulate(next_words.values()))
+            self._offsets.append(len(self._successor_ids))
+        
+        # Maps insertion order -> row, so iteration matches the source matrix
+        row_of = array('I', bytes(4 * len(rows)))
+        for row, i in enumerate(rows):
+            row_of[i] = row
+        self._order = row_of
+        
+        # Start-state tables, all indexed by insertion order
+        self._context_weights = array('Q', accumulate(
+            self._cum_counts[self._offsets[row + 1] - 1] for row in row_of))
+        self._line_start_rows = array('I', (row for row in map(self._row, line_starts) if row >= 0))
+        
+        # Features are stored by word id (reusing ones passed in from another model)
+        if not isinstance(features, FeatureTable) or features._index is not word_ids:
+            features = FeatureTable(self.words, word_ids, source=features)
+        self.features = features
+        
+        # Rhyme buckets hold word ids, kept in the same (alphabetical) order as MarkovModel's
+        if rhyme_index is None:
+            rhyme_index = build_rhyme_index({self.words[i] for i in set(self._successor_ids)},
+                                            features)
+        self._rhyme_index = {ending: array('I', map(word_ids.__getitem__, bucket))
+                             for ending, bucket in rhyme_index.items()}
+        self._reverse = ReverseChain(self._id_rows(), depth, self.words, word_ids,
+                                     (counter_state or {}).get('head', ()))
+    
+    def _pack(self, key):
+        """Pack a context of words into one integer, or None if a word is unknown"""
+        value = 0
+        for word in key:
+            word_id = self._word_ids.get(word)
+            if word_id is None:
+                return None
+            value = value * self._base + word_id
+        return value
+    
+    def _unpack(self, value):
+        """Turn a packed context back into a tuple of words"""
+        ids = []
+        for _ in range(self.depth):
+            value, word_id = divmod(value, self._base)
+            ids.append(word_id)
+        return tuple(self.words[word_id] for word_id in reversed(ids))
+    
+    def _row(self, key):
+        """Row index for a context, or -1 if it isn't in the model"""
+        if len(key) != self.depth:
+            return -1
+        packed = self._pack(key)
+        if packed is None:
+            return -1
+        row = bisect_left(self._keys, packed)
+        if row < len(self._keys) and self._keys[row] == packed:
+            return row
+        return -1
+    
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row < 0:
+            raise KeyError(key)
+        start, end = self._offsets[row], self._offsets[row + 1]
+        counts = {}
+        previous = 0
+        for i in range(start, end):
+            counts[self.words[self._successor_ids[i]]] = self._cum_counts[i] - previous
+            previous = self._cum_counts[i]
+        return counts
+    
+    def __iter__(self):
+        for row in self._order:
+            yield self._unpack(self._keys[row])
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def __contains__(self, key):
+        return self._row(key) >= 0
+    
+    def sample_next(self, key, rng=random):
+        """Draw a successor of key weighted by its count, or None if key has none"""
+        row = self._row(key)
+        if row < 0:
+            return None
+        start, end = self._offsets[row], self._offsets[row + 1]
+        cum_counts = self._cum_counts
+        i = bisect_right(cum_counts, rng.random() * cum_counts[end - 1], start, end - 1)
+        return self.words[self._successor_ids[i]]
+    
+    def random_context(self, rng=random, mode='uniform'):
+        """Pick a start context; same modes and draws as MarkovModel.random_context"""
+        if not self._order:
+            return None
+        if mode == 'line' and self._line_start_rows:
+            row = rng.choice(self._line_start_rows)
+        elif mode == 'weighted':
+            weights = self._context_weights
+            i = bisect_right(weights, rng.random() * weights[-1], 0, len(weights) - 1)
+            row = self._order[i]
+        else:
+            row = rng.choice(self._order)
+        return self._unpack(self._keys[row])
+    
+    def find_rhyme(self, word, rng=random):
+        """A random vocabulary word with the same rhyme ending as word (never word itself)"""
+        ending = lookup_features(self.features, word).rhyme_ending
+        candidates = self._rhyme_index.get(ending) if ending else None
+        if not candidates:
+            return None
+        i = bisect_left(candidates, word, key=self.words.__getitem__)
+        word_id = self._word_ids.get(word, -1)
+        picked = _pick_other(candidates, word_id, i, rng)
+        return None if picked is None else self.words[picked]
+    
+    def reverse_chain(self):
+        """The model's ReverseChain (for lines that must end on a word)"""
+        return self._reverse
+    
+    def _id_rows(self):
+        """(context word ids, successor ids, counts) for each context, in insertion order"""
+        base, keys, offsets, cum_counts = self._base, self._keys, self._offsets, self._cum_counts
+        for row in self._order:
+            value = keys[row]
+            context = []
+            for _ in range(self.depth):
+                value, word_id = divmod(value, base)
+                context.append(word_id)
+            start, end = offsets[row], offsets[row + 1]
+            yield (context[::-1], self._successor_ids[start:end],
+                   [cum_counts[i] - (cum_counts[i - 1] if i > start else 0)
+                    for i in range(start, end)])
+    
+    def nbytes(self):
+        """Rough memory footprint of the vocabulary and the packed arrays"""
+        total = sys.getsizeof(self.words) + sys.getsizeof(self._word_ids)
+        total += sum(sys.getsizeof(word) for word in self.words)
+        for buffer in (self._keys, self._offsets, self._successor_ids, self._cum_counts, self._order,
+                       self._context_weights, self._line_start_rows):
+            total += sys.getsizeof(buffer)
+        total += sys.getsizeof(self._rhyme_index)
+        total += sum(sys.getsizeof(bucket) for bucket in self._rhyme_index.values())
+        total += self._reverse.nbytes(shared_words=True)
+        return total + self.features.nbytes(shared_index=True)
+    
+    def payload(self):
+        """The model as constructor arguments, from which any model class can be built"""
+        words = self.words
+        return {
+            'transition_matrix': {key: self[key] for key in self},
+            'line_starts': [self._unpack(self._keys[row]) for row in self._line_start_rows],
+            'rhyme_index': {ending: tuple(words[i] for i in bucket)
+                            for ending, bucket in self._rhyme_index.items()},
+            'features': self.features,
+            'counter_state': self.counter_state
+        }
+    
+    def extended(self, counter):
+        """
+        A new model with the counts of a resumed NgramCounter added. New words get the
+        next ids, untouched rows are copied into the new arrays as whole slices, and only
+        the contexts the new text touched are re-packed; this model is left unchanged.
+        """
+        touched = {}  # Existing row -> new counts
+        new_contexts = []
+        new_words = set()
+        for key, counts in counter.transition_matrix.items():
+            row = self._row(key)
+            if row < 0:
+                new_contexts.append(key)
+                new_words.update(counts)
+            else:
+                touched[row] = counts
+                known = self[key]
+                new_words.update(word for word in counts if word not in known)
+        
+        features = self.features.extended(
+            [word for key in new_contexts for word in key] + sorted(new_words))
+        word_ids = features._index
+        model = object.__new__(type(self))
+        model.depth = self.depth
+        model.counter_state = counter.state()
+        model.fingerprint = None
+        model.words = tuple(word_ids)
+        model._word_ids = word_ids
+        model.features = features
+        
+        # Repack the keys if the new ids outgrew the base (sorted order is unchanged)
+        keys = self._keys
+        model._base = self._base
+        if len(word_ids) > self._base:
+            model._base = max(len(word_ids), 2 * self._base)
+            if model._base ** self.depth >= 2 ** 64 > len(word_ids) ** self.depth:
+                model._base = len(word_ids)
+            repacked = []
+            for value in keys:
+                ids = []
+                for _ in range(self.depth):
+                    value, word_id = divmod(value, self._base)
+                    ids.append(word_id)
+                value = 0
+                for word_id in reversed(ids):
+                    value = value * model._base + word_id
+                repacked.append(value)
+            keys = repacked
+        key_type = 'Q' if model._base ** self.depth < 2 ** 64 else None
+        
+        # New contexts go in before the old row at their sorted position
+        inserted = sorted(new_contexts, key=model._pack)
+        inserted_keys = list(map(model._pack, inserted))
+        positions = [bisect_left(keys, value) for value in inserted_keys]
+        updates = sorted([(row, 1, row) for row in touched]
+                         + [(position, 0, j) for j, position in enumerate(positions)])
+        
+        old_offsets, old_successors, old_counts = self._offsets, self._successor_ids, self._cum_counts
+        merged_keys = array(key_type) if key_type else []
+        offsets, successor_ids, cum_counts = array('I', [0]), array('I'), array('I')
+        copied = 0  # Old rows copied over so far
+        for position, is_old, i in updates:
+            if position > copied:
+                start, end = old_offsets[copied], old_offsets[position]
+                shift = len(successor_ids) - start
+                merged_keys.extend(keys[copied:position])
+                offsets.extend(offset + shift for offset in old_offsets[copied + 1:position + 1])
+                successor_ids.extend(old_successors[start:end])
+                cum_counts.extend(old_counts[start:end])
+                copied = position
+            if is_old:
+                start, end = old_offsets[i], old_offsets[i + 1]
+                counts = dict(zip(old_successors[start:end],
+                                  (b - a for a, b in zip((0, *old_counts[start:end - 1]),
+                                                         old_counts[start:end]))))
+                for word, count in touched[i].items():
+                    word_id = word_ids[word]
+                    counts[word_id] = counts.get(word_id, 0) + count
+                merged_keys.append(keys[i])
+                copied = i + 1
+            else:
+                counts = {word_ids[word]: count
+                          for word, count in counter.transition_matrix[inserted[i]].items()}
+                merged_keys.append(inserted_keys[i])
+            successor_ids.extend(counts)
+            cum_counts.extend(accumulate(counts.values()))
+            offsets.append(len(successor_ids))
+        if copied < len(keys):
+            start, end = old_offsets[copied], old_offsets[-1]
+            shift = len(successor_ids) - start
+            merged_keys.extend(keys[copied:])
+            offsets.extend(offset + shift for offset in old_offsets[copied + 1:])
+            successor_ids.extend(old_successors[start:end])
+            cum_counts.extend(old_counts[start:end])
+        model._keys, model._offsets = merged_keys, offsets
+        model._successor_ids, model._cum_counts = successor_ids, cum_counts
+        
+        # Old rows move down by the number of contexts inserted before them
+        if positions:
+            new_rows = {value: position + j
+                        for j, (value, position) in enumerate(zip(inserted_keys, positions))}
+            model._order = array('I', (row + bisect_right(positions, row) for row in self._order))
+            model._order.extend(new_rows[model._pack(key)] for key in new_contexts)
+        else:
+            model._order = self._order
+        model._context_weights = array('Q', accumulate(
+            cum_counts[offsets[row + 1] - 1] for row in model._order))
+        
+        known_starts = set(self._line_start_rows)
+        model._line_start_rows = array('I', (row + bisect_right(positions, row)
+                                             for row in self._line_start_rows))
+        model._line_start_rows.extend(
+            row for row in map(model._row, (key for key in counter.line_starts
+                                            if self._row(key) not in known_starts))
+            if row >= 0)
+        
+        # New successors are filed into copies of their (alphabetical) rhyme buckets
+        rhyme_index = dict(self._rhyme_index)
+        for word in new_words:
+            ending = features[word].rhyme_ending
+            if ending:
+                bucket = rhyme_index.get(ending, array('I'))
+                i = bisect_left(bucket, word, key=model.words.__getitem__)
+                if i == len(bucket) or model.words[bucket[i]] != word:
+                    rhyme_index[ending] = bucket[:i] + array('I', [word_ids[word]]) + bucket[i:]
+        model._rhyme_index = rhyme_index
+        model._reverse = self._reverse.extended(_id_rows(counter.transition_matrix, word_ids),
+                                                model.words, word_ids, counter.head)
+        return model
+
+class BackoffTrieModel(MarkovModel):
+    """
+    Variable-order model holding every context order from 1 to depth in one trie.
+    The trie is keyed by context words read backwards from the most recent one, so the
+    order-k context of a line is a k-step walk from the root and contexts that end the
+    same way share their nodes. Each node holds the successor table for its context.
+    
+    sample_next backs off to the longest suffix of the key that was ever seen, so a line
+    only runs dry on a word that was never followed by anything. Whenever the full
+    context is known, draws are identical to MarkovModel's for the same random state.
+    Shorter contexts list their successors alphabetically, so extended() can merge new
+    counts into them and still get exactly the trie a full build would.
+    
+    Lower orders are derived from the depth-order counts plus the corpus head (the
+    first depth words), which gives exactly the counts a separate order-k pass would.
+    """
+    def __init__(self, transition_matrix, depth=2, line_starts=(), rhyme_index=None,
+                 features=None, counter_state=None):
+        self.depth = depth
+        self.counter_state = counter_state
+        self.fingerprint = None  # See model_fingerprint
+        
+        # Build with [children, counts] lists, then freeze into (children, words, cum_weights)
+        root = {}
+        for key, next_words in transition_matrix.items():
+            children = root
+            for word in reversed(key):
+                node = children.get(word)
+                if node is None:
+                    node = children[word] = [{}, {}]
+                counts = node[1]
+                for next_word, count in next_words.items():
+                    counts[next_word] = counts.get(next_word, 0) + count
+                children = node[0]
+        
+        # Positions before the first full context only ever reach the lower orders
+        head = (counter_state or {}).get('head', ())
+        for position in range(1, min(len(head), depth)):
+            children = root
+            for word in reversed(head[:position]):
+                node = children.setdefault(word, [{}, {}])
+                node[1][head[position]] = node[1].get(head[position], 0) + 1
+                children = node[0]
+        
+        self._root = self._freeze(root, depth)
+        self.contexts = tuple(transition_matrix)
+        self.line_start_contexts = tuple(key for key in line_starts if key in transition_matrix)
+        self._context_weights = tuple(accumulate(
+            sum(next_words.values()) for next_words in transition_matrix.values()))
+        if not isinstance(features, FeatureTable):
+            features = FeatureTable(tuple(model_vocabulary(transition_matrix)), source=features)
+        self.features = features
+        if rhyme_index is None:
+            rhyme_index = build_rhyme_index(
+                {word for next_words in transition_matrix.values() for word in next_words},
+                features)
+        self.rhyme_index = rhyme_index
+        self._reverse = _build_reverse_chain(transition_matrix, depth, features, counter_state)
+    
+    @classmethod
+    def _freeze(cls, children, depth, order=1):
+        """Turn a building subtree into nested (children or None, words, cum_weights) tuples"""
+        return {
+            word: (cls._freeze(node_children, depth, order + 1) if node_children else None,
+                   *_frozen_counts(counts, order < depth))
+            for word, (node_children, counts) in children.items()
+        }
+    
+    @classmethod
+    def _merged(cls, children, changes, depth, order=1):
+        """
+        A frozen subtree with a building subtree's counts added. Only nodes on the paths
+        of changes are copied; every other node is shared with the original.
+        """
+        merged = dict(children) if children else {}
+        for word, (changed_children, counts) in changes.items():
+            node = merged.get(word)
+            if node is None:
+                merged[word] = cls._freeze({word: (changed_children, counts)}, depth, order)[word]
+                continue
+            node_children, next_words, cum_weights = node
+            totals = dict(zip(next_words, (b - a for a, b in zip((0,) + cum_weights, cum_weights))))
+            for next_word, count in counts.items():
+                totals[next_word] = totals.get(next_word, 0) + count
+            if changed_children:
+                node_children = cls._merged(node_children, changed_children, depth, order + 1)
+            merged[word] = (node_children, *_frozen_counts(totals, order < depth))
+        return merged
+    
+    def _node(self, key):
+        """The trie node for exactly this context, or None"""
+        node = None
+        children = self._root
+        for word in reversed(key):
+            if children is None or word not in children:
+                return None
+            node = children[word]
+            children = node[0]
+        return node
+    
+    def __getitem__(self, key):
+        node = self._node(key) if len(key) == self.depth else None
+        if node is None:
+            raise KeyError(key)
+        _, next_words, cum_weights = node
+        return dict(zip(next_words, (b - a for a, b in zip((0,) + cum_weights, cum_weights))))
+    
+    def __iter__(self):
+        return iter(self.contexts)
+    
+    def __len__(self):
+        return len(self.contexts)
+    
+    def __contains__(self, key):
+        return len(key) == self.depth and self._node(key) is not None
+    
+    def sample_next(self, key, rng=random):
+        """
+        Draw a successor weighted by its count in the longest known suffix of key
+        (backing off one word at a time), or None if even its last word has none
+        """
+        node = None
+        children = self._root
+        for word in reversed(key[-self.depth:]):
+            child = children.get(word)
+            if child is None:
+                break
+            node = child
+            children = child[0]
+            if children is None:
+                break
+        if node is None:
+            return None
+        _, next_words, cum_weights = node
+        return next_words[bisect_right(cum_weights, rng.random() * cum_weights[-1],
+                                       0, len(next_words) - 1)]
+    
+    def order_sizes(self):
+        """Number of contexts held at each order, shortest first"""
+        sizes = []
+        level = [self._root]
+        while level:
+            sizes.append(sum(len(children) for children in level))
+            level = [node[0] for children in level for node in children.values() if node[0]]
+        return sizes
+    
+    def nbytes(self):
+        """Rough memory footprint of the trie plus the start and rhyme tables"""
+        total = 0
+        words = set()
+        stack = [self._root]
+        while stack:
+            children = stack.pop()
+            total += sys.getsizeof(children)
+            for word, node in children.items():
+                words.add(word)
+                words.update(node[1])
+                total += sys.getsizeof(node) + sys.getsizeof(node[1]) + sys.getsizeof(node[2])
+                if node[0]:
+                    stack.append(node[0])
+        total += sum(sys.getsizeof(word) for word in words)
+        total += sys.getsizeof(self.contexts) + sum(sys.getsizeof(key) for key in self.contexts)
+        total += sys.getsizeof(self.line_start_contexts) + sys.getsizeof(self._context_weights)
+        total += sys.getsizeof(self.rhyme_index)
+        total += sum(sys.getsizeof(bucket) for bucket in self.rhyme_index.values())
+        total += self._reverse.nbytes()
+        return total + self.features.nbytes()
+    
+    def payload(self):
+        """The model as constructor arguments, from which any model class can be built"""
+        return {
+            'transition_matrix': {key: self[key] for key in self.contexts},
+            'line_starts': list(self.line_start_contexts),
+            'rhyme_index': self.rhyme_index,
+            'features': self.features,
+            'counter_state': self.counter_state
+        }
+    
+    def extended(self, counter):
+        """
+        A new model with the counts of a resumed NgramCounter added. Only the trie nodes
+        on the new n-grams' paths are copied and re-frozen; the rest are shared with this
+        model, which is left unchanged.
+        """
+        changes = {}  # Built like __init__'s trie, holding only the new counts
+        new_contexts = []
+        new_words = set()
+        for key, counts in counter.transition_matrix.items():
+            node = self._node(key)
+            if node is None:
+                new_contexts.append(key)
+                new_words.update(counts)
+            else:
+                known = set(node[1])
+                new_words.update(word for word in counts if word not in known)
+            children = changes
+            for word in reversed(key):
+                node = children.setdefault(word, [{}, {}])
+                for next_word, count in counts.items():
+                    node[1][next_word] = node[1].get(next_word, 0) + count
+                children = node[0]
+        
+        # Head positions the original text was too short to reach
+        head = counter.head
+        for position in range(max(1, len(self.counter_state['head'])), min(len(head), self.depth)):
+            children = changes
+            for word in reversed(head[:position]):
+                node = children.setdefault(word, [{}, {}])
+                node[1][head[position]] = node[1].get(head[position], 0) + 1
+                children = node[0]
+        
+        model = self._extended_with(counter, new_contexts, new_words)
+        model._root = self._merged(self._root, changes, self.depth)
+        totals = [b - a for a, b in zip((0,) + self._context_weights, self._context_weights)]
+        totals += [0] * len(new_contexts)
+        rows = {key: i for i, key in enumerate(model.contexts)}
+        for key, counts in counter.transition_matrix.items():
+            totals[rows[key]] += sum(counts.values())
+        model._context_weights = tuple(accumulate(totals))
+        return model
+
+def _frozen_counts(counts, alphabetical=False):
+    """(words, cumulative counts) of a {word: count} dict, in its own or alphabetical order"""
+    words = tuple(sorted(counts) if alphabetical else counts)
+    return words, tuple(accumulate(map(counts.__getitem__, words)))
+
+def _narrowest_array(values, bits=None):
+    """
+    values as an array of the narrowest unsigned item size holding bits-bit numbers (by
+    default, the largest of values), or as a list past 64 bits
+    """
+    if bits is None:
+        bits = max(values, default=0).bit_length()
+    for typecode in 'BHIQ':
+        if bits <= 8 * array(typecode).itemsize:
+            return array(typecode, values)
+    return list(values)
+
+def _widened(column, largest):
+    """column, or a copy with a wider item size if largest doesn't fit in it"""
+    if isinstance(column, array) and largest >> (8 * column.itemsize):
+        return _narrowest_array(column, largest.bit_length())
+    return column
+
+class ReverseChain:
+    """
+    Right-to-left view of a model, for growing a line backwards from the word it must end
+    on: given the words that follow a position, which words come before them and how often.
+    
+    It is derived from the forward counts rather than a second pass over the corpus. A
+    forward context (a, b) followed by c n times is the n-gram "a b c", which read
+    backwards says (b, c) is preceded by a n times and (c,) by b n times. Every order
+    from 1 to depth is kept (plus the corpus head, as BackoffTrieModel does), so a line
+    can start from a single word and sample_before backs off to shorter contexts.
+    
+    It is stored by word id, like CompactMarkovModel: for each order k, the k-word
+    following contexts are packed into sorted integers (bits per word), and row i's
+    preceding words are previous_ids[offsets[i]:offsets[i+1]] with matching cumulative
+    counts, in arrays of the narrowest item size that fits. Preceding words are kept in
+    alphabetical order rather than id order (which depends on how the model was built),
+    so extended() gives exactly the chain a full build of the updated model would.
+    
+    Models build theirs alongside their forward tables, so it is cached on disk with them
+    and counted in their nbytes.
+    """
+    def __init__(self, rows, depth, words, word_ids, head=()):
+        """
+        rows yields (context word ids, successor ids, counts) for each forward context;
+        words and word_ids map ids to words and back, and head is the corpus head.
+        """
+        self.depth = depth
+        self.words = words
+        self._word_ids = word_ids
+        self._bits = max(len(words), 1).bit_length()
+        counts = [{} for _ in range(depth)]
+        by_rank = self._alphabetical()
+        self._head_length = self._fold(counts, rows, head, by_rank)
+        self._tables = tuple(self._frozen(table, order, by_rank)
+                             for order, table in enumerate(counts, 1))
+    
+    def _alphabetical(self):
+        """Word ids in alphabetical order of their words"""
+        return sorted(range(len(self.words)), key=self.words.__getitem__)
+    
+    def _fold(self, counts, rows, head, by_rank, head_start=1):
+        """
+        Add the n-grams of rows (and of head positions from head_start on) to counts, a
+        {packed following context and previous word: count} dict per order. The previous
+        word is packed last as its alphabetical rank, so sorted keys list each following
+        context's preceding words in order. Returns how much of the head is folded in.
+        """
+        bits = self._bits
+        rank = [0] * len(by_rank)
+        for i, word_id in enumerate(by_rank):
+            rank[word_id] = i
+        for context, successor_ids, successor_counts in rows:
+            # An n-gram's key at each order is its last word (shifted) plus a part that
+            # depends only on the context: the earlier following words and the previous rank
+            parts, following = [], 0
+            for order, previous in enumerate(reversed(context)):
+                parts.append((counts[order], following << bits | rank[previous]))
+                following |= previous << (bits * (order + 1))
+            for word_id, count in zip(successor_ids, successor_counts):
+                shifted = word_id << bits
+                for table, part in parts:
+                    key = shifted | part
+                    table[key] = table.get(key, 0) + count
+        
+        # The first depth words are only ever preceded within the lower orders
+        head = [self._word_ids.get(word) for word in head[:self.depth]]
+        if None in head:
+            return head_start
+        for position in range(head_start, len(head)):
+            following = head[position]
+            for order in range(position):
+                previous = head[position - order - 1]
+                key = following << bits | rank[previous]
+                counts[order][key] = counts[order].get(key, 0) + 1
+                following |= previous << (bits * (order + 1))
+        return max(head_start, len(head))
+    
+    def _frozen(self, table, order, by_rank):
+        """Pack one order's folded counts into sorted CSR arrays"""
+        bits, mask = self._bits, (1 << self._bits) - 1
+        keys, offsets, previous_ids, cum_counts = [], [], [], []
+        add_previous, add_count = previous_ids.append, cum_counts.append
+        last = None
+        for key in sorted(table):  # Sorting plain ints is quicker than sorting items
+            count = table[key]
+            following = key >> bits
+            if following != last:
+                last = following
+                keys.append(following)
+                offsets.append(len(previous_ids))
+                total = 0
+            total += count
+            add_previous(by_rank[key & mask])
+            add_count(total)
+        offsets.append(len(previous_ids))
+        return (_narrowest_array(keys, self._bits * order), _narrowest_array(offsets),
+                _narrowest_array(previous_ids, self._bits), _narrowest_array(cum_counts))
+    
+    def _pack(self, word_ids):
+        value = 0
+        for word_id in word_ids:
+            value = value << self._bits | word_id
+        return value
+    
+    def _row(self, order, value):
+        """Row of a packed following context in its order's table, or -1"""
+        keys = self._tables[order - 1][0]
+        row = bisect_left(keys, value)
+        if row < len(keys) and keys[row] == value:
+            return row
+        return -1
+    
+    def __contains__(self, word):
+        word_id = self._word_ids.get(word)
+        return word_id is not None and self._row(1, word_id) >= 0
+    
+    def sample_before(self, words, rng=random):
+        """
+        Draw a word to put in front of words, weighted by how often it precedes the
+        longest known start of words (backing off one word at a time), or None
+        """
+        ids = []
+        for word in words[:self.depth]:
+            word_id = self._word_ids.get(word)
+            if word_id is None:
+                break  # No context holding an unknown word was ever seen
+            ids.append(word_id)
+        while ids:
+            row = self._row(len(ids), self._pack(ids))
+            if row >= 0:
+                _, offsets, previous_ids, cum_counts = self._tables[len(ids) - 1]
+                start, end = offsets[row], offsets[row + 1]
+                i = bisect_right(cum_counts, rng.random() * cum_counts[end - 1], start, end - 1)
+                return self.words[previous_ids[i]]
+            ids.pop()
+        return None
+    
+    def table(self):
+        """The chain as {following words: {preceding word: count}} (for inspection and tests)"""
+        words, mask = self.words, (1 << self._bits) - 1
+        table = {}
+        for order, (keys, offsets, previous_ids, cum_counts) in enumerate(self._tables, 1):
+            for row, value in enumerate(keys):
+                following = []
+                for _ in range(order):
+                    following.append(words[value & mask])
+                    value >>= self._bits
+                start, end = offsets[row], offsets[row + 1]
+                table[tuple(reversed(following))] = {
+                    words[previous_ids[i]]: cum_counts[i] - (cum_counts[i - 1] if i > start else 0)
+                    for i in range(start, end)}
+        return table
+    
+    def extended(self, rows, words, word_ids, head=()):
+        """
+        A new chain with the n-grams of rows (counts added to the model, as in __init__)
+        folded in. Only the rows those n-grams touch are rebuilt; the rest of each array
+        is copied over in slices. This chain is left unchanged.
+        """
+        chain = object.__new__(type(self))
+        chain.depth = self.depth
+        chain.words = words
+        chain._word_ids = word_ids
+        chain._bits = self._bits
+        tables = self._tables
+        if len(words) >> self._bits:
+            # New word ids no longer fit in the packing, so every key is repacked
+            chain._bits = len(words).bit_length()
+            tables = [(chain._repacked(table[0], order, self._bits),) + table[1:]
+                      for order, table in enumerate(tables, 1)]
+        
+        delta = [{} for _ in range(self.depth)]
+        by_rank = chain._alphabetical()
+        chain._head_length = chain._fold(delta, rows, head, by_rank, self._head_length)
+        mask = (1 << chain._bits) - 1
+        merged = []
+        for table, folded in zip(tables, delta):
+            changes = {}  # Following context -> {previous id: count}
+            for key, count in folded.items():
+                changes.setdefault(key >> chain._bits, {})[by_rank[key & mask]] = count
+            merged.append(chain._merged(table, changes) if changes else table)
+        chain._tables = tuple(merged)
+        return chain
+    
+    def _repacked(self, keys, order, old_bits):
+        """An order's keys packed with old_bits per word, repacked with this chain's bits"""
+        mask = (1 << old_bits) - 1
+        repacked = []
+        for value in keys:
+            packed = 0
+            for position in range(order):
+                packed |= ((value >> (old_bits * position)) & mask) << (self._bits * position)
+            repacked.append(packed)
+        return _narrowest_array(repacked, self._bits * order)
+    
+    def _merged(self, table, changes):
+        """One order's CSR arrays with changes ({following: {previous id: count}}) added"""
+        keys, offsets, previous_ids, cum_counts = table
+        # Widen up front to fit anything the merge can produce, so slices copy as they are
+        added = sum(len(before) for before in changes.values())
+        offsets = _widened(offsets, len(previous_ids) + added)
+        previous_ids = _widened(previous_ids, (1 << self._bits) - 1)
+        cum_counts = _widened(cum_counts, max(cum_counts, default=0) + sum(
+            count for before in changes.values() for count in before.values()))
+        new_keys, new_offsets = keys[:0], offsets[:0]
+        new_previous_ids, new_cum_counts = previous_ids[:0], cum_counts[:0]
+        copied = 0  # Rows before this one are in the new arrays
+        
+        def copy_rows(end):
+            # Unchanged rows move as slices; only their offsets are shifted
+            start = offsets[copied]
+            shift = len(new_previous_ids) - start
+            new_keys.extend(keys[copied:end])
+            new_offsets.extend([offset + shift for offset in offsets[copied:end]])
+            new_previous_ids.extend(previous_ids[start:offsets[end]])
+            new_cum_counts.extend(cum_counts[start:offsets[end]])
+        
+        for value in sorted(changes):
+            row = bisect_left(keys, value)
+            copy_rows(row)
+            before = changes[value]
+            if row < len(keys) and keys[row] == value:
+                start, end = offsets[row], offsets[row + 1]
+                for i in range(start, end):
+                    count = cum_counts[i] - (cum_counts[i - 1] if i > start else 0)
+                    before[previous_ids[i]] = before.get(previous_ids[i], 0) + count
+                copied = row + 1
+            else:
+                copied = row
+            previous = sorted(before, key=self.words.__getitem__)
+            new_keys.append(value)
+            new_offsets.append(len(new_previous_ids))
+            new_previous_ids.extend(previous)
+            new_cum_counts.extend(accumulate(map(before.__getitem__, previous)))
+        copy_rows(len(keys))
+        new_offsets.append(len(new_previous_ids))
+        return new_keys, new_offsets, new_previous_ids, new_cum_counts
+    
+    def nbytes(self, shared_words=False):
+        """Rough memory footprint of the arrays (and of the id -> word tuple, if it's ours)"""
+        total = sum(sys.getsizeof(buffer) for table in self._tables for buffer in table)
+        return total if shared_words else total + sys.getsizeof(self.words)
+
+def _id_rows(transition_matrix, word_ids):
+    """(context word ids, successor ids, counts) for each context of a transition matrix"""
+    for key, next_words in transition_matrix.items():
+        yield (tuple(map(word_ids.__getitem__, key)), list(map(word_ids.__getitem__, next_words)),
+               next_words.values())
+
+def _build_reverse_chain(transition_matrix, depth, features, counter_state):
+    """A model's ReverseChain, with words numbered as in its feature table"""
+    word_ids = features._index
+    return ReverseChain(_id_rows(transition_matrix, word_ids), depth, tuple(word_ids), word_ids,
+                        (counter_state or {}).get('head', ()))
+
+def update_model(model, text):
+    """
+    Returns a copy of model with text counted as if it had been appended to the model's
+    corpus (starting on a new line), without recounting the corpus itself. Only the
+    contexts the new text touches are rebuilt, whatever the model's class.
+    """
+    if model.counter_state is None:
+        raise ValueError("model has no counter state to resume from - rebuild it instead")
+    
+    counter = NgramCounter.resume(model.depth, model.counter_state)
+    for line in text.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
+        counter.feed_text(line)
+    
+    updated = model.extended(counter)
+    updated.counter_state['source_bytes'] = None  # No longer matches any file on disk
+    return updated
+
+def model_fingerprint(model):
+    """
+    Short hash identifying what a model samples from, used to key generated poems.
+    Models from preprocess_text's cache are stamped with one derived from the corpus hash;
+    any other model is hashed from its counts on first use and remembered.
+    """
+    if model.fingerprint is None:
+        import hashlib
+        import pickle
+        
+        payload = model.payload()
+        data = pickle.dumps((type(model).__name__, model.depth, payload['transition_matrix'],
+                             payload['line_starts']), protocol=pickle.HIGHEST_PROTOCOL)
+        model.fingerprint = hashlib.sha256(data).hexdigest()[:32]
+    return model.fingerprint
+
+def _stamp_fingerprint(model, file_path):
+    """Give a model built from the cache a fingerprint from its cache key, without hashing it"""
+    cache_path = model_cache_path(file_path, model.depth, model_class=type(model))
+    model.fingerprint = os.path.splitext(os.path.basename(cache_path))[0]
+    return model
+
+# Function to preprocess the text and build the Markov chain
+@tracer.traced('preprocess')
+def preprocess_text(file_path, depth=2, use_cache=True, compact=False, workers=1, backoff=False):
+    """
+    Reads the poet's text file, processes it, and creates a Markov transition matrix
+    to generate more coherent lines of poetry. Compiled matrices are cached on disk,
+    keyed by the file's contents, depth and tokenizer settings.
+    
+    :param file_path: Path to the text file of the poet
+    :param depth: Number of words to use as context for the Markov model (bigram or trigram)
+    :param use_cache: Reuse (and populate) the on-disk model cache
+    :param compact: Return a CompactMarkovModel (integer ids, flat arrays) instead
+    :param workers: Build with this many processes on a cache miss (None = one per CPU;
+                    build_workers picks a count from the file size)
+    :param backoff: Return a BackoffTrieModel (orders 1..depth, backs off on unseen contexts)
+    :return: A MarkovModel mapping each context to its successor counts
+    """
+    if compact and backoff:
+        raise ValueError("compact and backoff models can't be combined")
+    model_class = CompactMarkovModel if compact else BackoffTrieModel if backoff else MarkovModel
+    appended = None
+    if use_cache:
+        try:
+            with tracer.span('cache'):
+                model = load_cached_model(file_path, depth, model_class=model_class)
+                if model is None:
+                    appended = find_appended_base(file_path, depth, model_class)
+        except OSError:
+            model = None  # Missing file - reported below
+        if model is not None:
+            return _stamp_fingerprint(model, file_path)
+    
+    try:
+        size = os.path.getsize(file_path)
+        if size == 0:
+            print(f"Warning: {file_path} is empty")
+            return model_class({}, depth)
+        
+        if appended:
+            # Only new text was added since a cached build - count just that and merge it in
+            base_model, offset = appended
+            with tracer.span('tokenize'):
+                counter = NgramCounter.resume(depth, base_model.counter_state)
+                for piece, starts_line in iter_corpus_pieces(file_path, start=offset):
+                    counter.feed_text(piece, starts_line)
+            with tracer.span('build'):
+                model = base_model.extended(counter)
+                model.counter_state['source_bytes'] = size
+                save_cached_model(file_path, depth, model)
+                return _stamp_fingerprint(model, file_path)
+        elif workers == 1:
+            # Stream the corpus so memory stays flat however large the file is
+            with tracer.span('tokenize'):
+                counter = NgramCounter(depth)
+                for piece, starts_line in iter_corpus_pieces(file_path):
+                    counter.feed_text(piece, starts_line)
+        else:
+            with tracer.span('tokenize'):
+                counter = count_corpus_parallel(file_path, depth, workers)
+    except FileNotFoundError:
+        print(f"Error: Could not find file {file_path}")
+        return model_class({}, depth)
+    except Exception as e:
+        print(f"Error reading {file_path}: {e}")
+        return model_class({}, depth)
+    
+    with tracer.span('build'):
+        payload = counter.payload()
+        payload['counter_state']['source_bytes'] = size
+        model = model_class(depth=depth, **payload)
+        if use_cache and payload['transition_matrix']:
+            save_cached_model(file_path, depth, model)
+            return _stamp_fingerprint(model, file_path)
+        
+        return model
+
+# Upper bound on the memory held by in-process models before the least recently used are dropped
+MODEL_MEMORY_BUDGET = 256 * 1024 * 1024
+
+def estimate_model_size(transition_matrix):
+    """Rough number of bytes held by a transition matrix (containers, keys and unique words)"""
+    if hasattr(transition_matrix, 'nbytes'):
+        return transition_matrix.nbytes()
+    
+    total = sys.getsizeof(transition_matrix)
+    words = set()
+    for key, next_words in transition_matrix.items():
+        total += sys.getsizeof(key) + sys.getsizeof(next_words)
+        words.update(key)
+        words.update(next_words)
+    return total + sum(sys.getsizeof(word) for word in words)
+
+class ModelRegistry:
+    """
+    Keeps built transition matrices in memory per (poet, depth) so switching between
+    poets is a dictionary lookup instead of a rebuild. Least recently used models are
+    evicted once the estimated size of everything held exceeds max_bytes.
+    
+    Models are built outside the registry lock, so a slow build only holds up callers
+    waiting for that same model; they share its result instead of building it again.
+    Every hit checks the corpus file's size and mtime, and a changed file is rebuilt
+    (through the disk cache, which only counts appended text).
+    """
+    def __init__(self, max_bytes=MODEL_MEMORY_BUDGET):
+        self.max_bytes = max_bytes
+        # (poet, depth, compact, backoff) -> (model, size in bytes, corpus (size, mtime))
+        self._models = OrderedDict()
+        self._building = {}  # Key -> Future of the build in progress
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.evictions = 0
+    
+    def get(self, poet, depth=2, compact=False, backoff=False):
+        """
+        Return the model for a poet (a key of poet_files, or a path to a corpus file),
+        building it through preprocess_text on a miss or when the file has changed.
+        """
+        from concurrent.futures import Future
+        
+        key = (poet, depth, compact, backoff)
+        file_path = resolve_corpus_path(poet)
+        signature = _corpus_signature(file_path)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is not None and entry[2] == signature:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            
+            building = self._building.get(key)
+            if building is None:
+                if entry is not None:
+                    # The corpus changed on disk since this model was built
+                    del self._models[key]
+                    self.current_bytes -= entry[1]
+                    self.reloads += 1
+                self.misses += 1
+                building = self._building[key] = Future()
+                owner = True
+            else:
+                owner = False
+        
+        if not owner:
+            return building.result()  # Another thread is building this model
+        
+        try:
+            transition_matrix = preprocess_text(file_path, depth, compact=compact,
+                                                workers=build_workers(file_path), backoff=backoff)
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+            building.set_exception(e)
+            raise
+        
+        with self._lock:
+            del self._building[key]
+            if transition_matrix:  # Don't hold on to failed builds
+                size = estimate_model_size(transition_matrix)
+                self._models[key] = (transition_matrix, size, signature)
+                self.current_bytes += size
+                self._evict()
+        building.set_result(transition_matrix)
+        return transition_matrix
+    
+    def _evict(self):
+        """Drop least recently used models until within budget (always keeping the newest)"""
+        while self.current_bytes > self.max_bytes and len(self._models) > 1:
+            _, (_, size, _) = self._models.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+    
+    def set_budget(self, max_bytes):
+        """Change the memory budget, evicting immediately if it shrank"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+    
+    def clear(self):
+        """Forget every held model (counters are kept)"""
+        with self._lock:
+            self._models.clear()
+            self.current_bytes = 0
+    
+    def stats(self):
+        """Snapshot of the registry counters"""
+        with self._lock:
+            return {
+                'models': len(self._models),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'evictions': self.evictions
+            }
+
+def _corpus_signature(file_path):
+    """(size, mtime) of a corpus file, or None if it can't be read"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+# Shared registry used by the UI and any headless callers
+model_registry = ModelRegistry()
+
+# Common rhyming patterns with their variants, checked in this order
+RHYME_ENDING_PATTERNS = {
+    'ing': ('ing', 'ring', 'sing', 'wing'),
+    'ight': ('ight', 'ite', 'yte', 'eight'),
+    'ound': ('ound', 'owned'),
+    'ead': ('ead', 'ed', 'eed'),
+    'ame': ('ame', 'aim'),
+    'ay': ('ay', 'ey', 'eigh'),
+    'ear': ('ear', 'eer', 'ere'),
+    'ine': ('ine', 'ign'),
+    'all': ('all', 'awl'),
+    'ow': ('ow', 'oe', 'o'),
+    'iss': ('iss', 'is'),
+    'est': ('est', 'essed')
+}
+
+def get_rhyme_ending(word):
+    """Get the rhyming ending of a word (None for words shorter than 4 letters)"""
+    if len(word) < 4:
+        return None
+    
+    # Check for pattern matches
+    word = word.lower()
+    for main_pattern, variants in RHYME_ENDING_PATTERNS.items():
+        if word.endswith(variants):
+            return main_pattern
+    return word[-2:] if len(word) > 3 else None
+
+def build_rhyme_index(words, features=None):
+    """Map each rhyme ending to a sorted tuple of the words (4+ letters) that have it"""
+    index = defaultdict(list)
+    for word in words:
+        ending = lookup_features(features, word).rhyme_ending
+        if ending:
+            index[ending].append(word)
+    return {ending: tuple(sorted(bucket)) for ending, bucket in index.items()}
+
+def get_rhyme_pattern(word):
+    """Get the rhyming pattern of a word's ending"""
+    word = word.lower().strip('.,!?;:')
+    if len(word) < 3:
+        return None
+    
+    vowels = 'aeiou'
+    consonants = 'bcdfghjklmnpqrstvwxyz'
+    
+    # Find last stressed syllable
+    last_vowel_pos = -1
+    vowel_count = 0
+    for i in range(len(word) - 1, -1, -1):
+        if word[i] in vowels:
+            if vowel_count == 0:
+                last_vowel_pos = i
+            vowel_count += 1
+            # Include consecutive vowels
+            while i > 0 and word[i - 1] in vowels:
+                i -= 1
+    
+    if last_vowel_pos == -1:
+        return None
+    
+    # Get the rhyming part (from last stressed syllable to end)
+    rhyme_part = word[max(0, last_vowel_pos - 1):]
+    
+    # Handle special cases
+    if rhyme_part.endswith('e') and len(rhyme_part) > 2:  # Silent e
+        rhyme_part = rhyme_part[:-1]
+    
+    # Get vowel and consonant patterns separately
+    vowel_pattern = ''.join(c for c in rhyme_part if c in vowels)
+    consonant_pattern = ''.join(c for c in rhyme_part if c in consonants)
+    
+    return (vowel_pattern, consonant_pattern) if vowel_pattern else None
+
+# Sounds a word can open with for alliteration: these two-letter clusters are checked
+# before single consonants, so "thorn" and "tide" don't alliterate
+ONSET_CLUSTERS = frozenset({'ch', 'sh', 'th', 'wh', 'ph'})
+CONSONANTS = frozenset('bcdfghjklmnpqrstvwxyz')
+
+# When two sounds open equally many words of a line, alliteration uses the one listed first
+ONSET_RANK = {onset: rank for rank, onset in enumerate(
+    ('ch', 'sh', 'th', 'wh', 'ph') + tuple('bcdfghjklmnpqrstvwxyz'))}
+
+def get_onset(word):
+    """The consonant sound a word starts with ('th', 's', ...), or None if it starts otherwise"""
+    word = word.lower()
+    if word[:2] in ONSET_CLUSTERS:
+        return word[:2]
+    if word[:1] in CONSONANTS:
+        return word[0]
+    return None
+
+# Everything the rhyme and alliteration code needs to know about a word
+WordFeatures = namedtuple('WordFeatures', 'rhyme_pattern rhyme_ending onset')
+_new_tuple = tuple.__new__  # Builds a WordFeatures without going through its __new__
+
+def word_features(word):
+    """Compute a word's WordFeatures"""
+    return WordFeatures(get_rhyme_pattern(word), get_rhyme_ending(word), get_onset(word))
+
+# Features of words missing from a model's table (or looked up without one) are memoized
+@lru_cache(maxsize=4096)
+def _uncached_word_features(word):
+    return word_features(word)
+
+def model_vocabulary(transition_matrix):
+    """Every word in a transition matrix, as a context word or a successor"""
+    words = {word for key in transition_matrix for word in key}
+    for next_words in transition_matrix.values():
+        words.update(next_words)
+    return words
+
+class FeatureTable(Mapping):
+    """
+    Read-only map of a model's vocabulary to WordFeatures, stored as parallel arrays
+    indexed by word id instead of a tuple per word. Rhyme patterns, endings and onsets
+    are interned (a few thousand distinct values at most), so each word costs a few bytes
+    of array plus its index entry. Entries are rebuilt as WordFeatures when looked up.
+    
+    index maps each word to its id (its position in words); a CompactMarkovModel passes
+    its own word ids so the table adds nothing per word but the arrays. Entries found in
+    source (another feature table) are copied rather than worked out again.
+    """
+    def __init__(self, words, index=None, source=None):
+        self._index = {word: i for i, word in enumerate(words)} if index is None else index
+        # Distinct rhyme patterns, endings and onsets, and each word's id into them (one
+        # byte per word, widened if a column runs out of ids)
+        self._patterns, self._endings, self._onsets = [None], [None], [None]
+        self._pattern_ids, self._ending_ids, self._onset_ids = array('B'), array('B'), array('B')
+        self._append(words, source)
+    
+    def _interned(self):
+        """(values, name of the id column) for each interned field, in WordFeatures order"""
+        return ((self._patterns, '_pattern_ids'), (self._endings, '_ending_ids'),
+                (self._onsets, '_onset_ids'))
+    
+    def _append(self, words, source=None):
+        """Add words' features (from source, a feature table, where it has them) in id order"""
+        interned = [(values, name, {value: i for i, value in enumerate(values)})
+                    for values, name in self._interned()]
+        for word in words:
+            features = (source.get(word) if source is not None else None) or word_features(word)
+            for (values, name, value_ids), value in zip(interned, features):
+                value_id = value_ids.get(value)
+                column = getattr(self, name)
+                if value_id is None:
+                    value_id = value_ids[value] = len(values)
+                    values.append(value)
+                    if value_id >> (8 * column.itemsize):
+                        column = array('H' if column.typecode == 'B' else 'I', column)
+                        setattr(self, name, column)
+                column.append(value_id)
+    
+    def get(self, word, default=None):
+        i = self._index.get(word)
+        if i is None:
+            return default
+        return _new_tuple(WordFeatures, (self._patterns[self._pattern_ids[i]],
+                                         self._endings[self._ending_ids[i]],
+                                         self._onsets[self._onset_ids[i]]))
+    
+    def __getitem__(self, word):
+        entry = self.get(word)
+        if entry is None:
+            raise KeyError(word)
+        return entry
+    
+    def onset(self, word):
+        """
+        Just a word's onset, read from its column (matching case-insensitively, like
+        lookup_features); words the table doesn't hold are worked out on the spot
+        """
+        i = self._index.get(word)
+        if i is None:
+            i = self._index.get(word.lower())
+            if i is None:
+                return get_onset(word)
+        return self._onsets[self._onset_ids[i]]
+    
+    def __iter__(self):
+        return iter(self._index)
+    
+    def __len__(self):
+        return len(self._index)
+    
+    def __contains__(self, word):
+        return word in self._index
+    
+    def extended(self, words):
+        """A copy of the table that also holds words (ones it already has are skipped)"""
+        table = object.__new__(type(self))
+        table._index = dict(self._index)
+        table._patterns, table._endings, table._onsets = (
+            self._patterns[:], self._endings[:], self._onsets[:])
+        table._pattern_ids, table._ending_ids, table._onset_ids = (
+            self._pattern_ids[:], self._ending_ids[:], self._onset_ids[:])
+        new_words = []
+        for word in words:
+            if word not in table._index:
+                table._index[word] = len(table._index)
+                new_words.append(word)
+        table._append(new_words)
+        return table
+    
+    def nbytes(self, shared_index=False):
+        """Rough memory footprint (leaving out the word index if a model owns it)"""
+        total = 0
+        for values, name in self._interned():
+            total += sys.getsizeof(getattr(self, name)) + sys.getsizeof(values)
+            total += sum(sys.getsizeof(value) for value in values)
+        return total if shared_index else total + sys.getsizeof(self._index)
+
+def build_feature_table(words):
+    """A FeatureTable of each word's WordFeatures (done once per model, at build time)"""
+    return FeatureTable(tuple(words))
+
+def lookup_features(features, word):
+    """
+    A word's WordFeatures from a feature table, matching case-insensitively (features
+    don't depend on case); words the table doesn't hold are computed on the spot.
+    """
+    if features is not None:
+        entry = features.get(word) or features.get(word.lower())
+        if entry is not None:
+            return entry
+    return _uncached_word_features(word)
+
+def find_rhyming_pairs(lines, features=None):
+    """
+    Find pairs of lines that could rhyme based on their last words.
+    Uses strict AABB rhyming pattern with precise sound matching.
+    features is the model's feature table, used for rhyme patterns where it has them.
+    """
+    pairs = []
+    common_words = {
+        'the', 'and', 'but', 'or', 'if', 'of', 'to', 'in', 'on', 'at', 'a', 'an', 'for', 'with',
+        'is', 'was', 'were', 'be', 'been', 'has', 'have', 'had', 'do', 'does', 'did', 'will',
+        'would', 'should', 'could', 'may', 'might', 'must', 'shall', 'can', 'us', 'me', 'we',
+        'they', 'them', 'him', 'her', 'his', 'their', 'our', 'your', 'my', 'so', 'go', 'no',
+        'here', 'there', 'where', 'when', 'then', 'than', 'this', 'that', 'these', 'those',
+        'through', 'though', 'although', 'yet', 'still', 'just', 'now', 'how', 'who', 'what'
+    }
+    
+    # Process lines in pairs for AABB pattern
+    for i in range(0, len(lines)-1, 2):
+        if i + 1 >= len(lines):
+            break
+        
+        words1 = lines[i].split()
+        words2 = lines[i+1].split()
+        
+        if not words1 or not words2:
+            continue
+        
+        last_word1 = words1[-1]
+        last_word2 = words2[-1]
+        
+        # Skip common words, short words, and identical words
+        if (last_word1.lower() in common_words or 
+            last_word2.lower() in common_words or
+            len(last_word1) < 3 or len(last_word2) < 3 or
+            last_word1.lower() == last_word2.lower()):
+            continue
+        
+        pattern1 = lookup_features(features, last_word1).rhyme_pattern
+        pattern2 = lookup_features(features, last_word2).rhyme_pattern
+        
+        if pattern1 and pattern2:
+            vowels1, cons1 = pattern1
+            vowels2, cons2 = pattern2
+            
+            # Perfect rhyme: same vowel and consonant patterns
+            if vowels1 == vowels2 and cons1 == cons2:
+                pairs.append((i, i+1, 4))
+            # Strong rhyme: same vowel pattern, similar consonants
+            elif vowels1 == vowels2 and len(set(cons1) & set(cons2)) >= max(1, len(cons1) // 2):
+                pairs.append((i, i+1, 3))
+            # Assonance: same vowel pattern
+            elif vowels1 == vowels2 and len(vowels1) >= 2:
+                pairs.append((i, i+1, 2))
+            # Weak rhyme: similar ending sound
+            elif vowels1[-1:] == vowels2[-1:] and cons1[-1:] == cons2[-1:]:
+                pairs.append((i, i+1, 1))
+    
+    return pairs
+
+def alliterate_line(line, features=None):
+    """
+    Rebuild a line around its most common opening sound: up to three words (3+ letters)
+    starting with it, then up to two of the line's other 3+ letter words. Lines where no
+    sound opens at least two words are returned unchanged. Onsets come from the model's
+    feature table, and the line is scanned once.
+    """
+    onset_of = features.onset if features is not None else get_onset
+    words = line.split()
+    groups = {}
+    for word in words:
+        if len(word) >= 3:
+            onset = onset_of(word)
+            if onset:
+                group = groups.get(onset)
+                if group is None:
+                    groups[onset] = [word]
+                else:
+                    group.append(word)
+    
+    best = None
+    for onset, group in groups.items():
+        if len(group) > 1 and (best is None or len(group) > len(groups[best])
+                               or (len(group) == len(groups[best])
+                                   and ONSET_RANK[onset] < ONSET_RANK[best])):
+            best = onset
+    if best is None:
+        return line
+    
+    alliterative_words = groups[best][:3]
+    chosen = set(alliterative_words)
+    remaining_words = []
+    for word in words:
+        if len(word) >= 3 and word not in chosen:
+            remaining_words.append(word)
+            if len(remaining_words) == 2:
+                break
+    return ' '.join(alliterative_words + remaining_words).capitalize()
+
+# Words the Metaphor device replaces, and what with (load_metaphor_lexicon reads more)
+METAPHORS = {
+    "moon": "a silver lantern",
+    "sun": "a golden eye",
+    "river": "a winding ribbon",
+    "tree": "a silent guardian",
+    "sky": "a vast ocean",
+    "wind": "a whispering voice",
+    "stars": "celestial diamonds",
+    "clouds": "wandering dreamers",
+    "night": "a velvet shroud"
+}
+
+def _trie_pattern(keys):
+    """
+    Regex source matching exactly the given strings, factored into a character trie so a
+    match attempt costs the length of the key rather than the number of keys. Optional
+    groups are greedy, so longer keys are tried before their prefixes.
+    """
+    trie = {}
+    for key in keys:
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = None  # Marks the end of a key
+    
+    def emit(node):
+        branches = [re.escape(char) + emit(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        return f"(?:{body})?" if '' in node else body
+    
+    return emit(trie)
+
+class MetaphorLexicon:
+    """
+    A metaphor dictionary compiled into a single regular expression, so a poem gets all of
+    its substitutions in one scan however many entries there are. Keys (words or phrases,
+    case-sensitive) only match whole words, so "sun" leaves "sunder" alone; where keys
+    overlap the longest wins, and substituted text is never matched again.
+    """
+    def __init__(self, metaphors):
+        import hashlib
+        
+        self.metaphors = {key.strip(): value for key, value in metaphors.items() if key.strip()}
+        self.fingerprint = hashlib.sha256(json.dumps(sorted(self.metaphors.items())).encode(
+            'utf-8')).hexdigest()[:16]  # Identifies the lexicon in result cache keys
+        self._pattern = (re.compile(rf"\b{_trie_pattern(self.metaphors)}\b")
+                         if self.metaphors else None)
+    
+    def __len__(self):
+        return len(self.metaphors)
+    
+    def substitute(self, text):
+        """text with every whole-word occurrence of a key replaced by its metaphor"""
+        if self._pattern is None:
+            return text
+        metaphors = self.metaphors
+        return self._pattern.sub(lambda match: metaphors[match.group()], text)
+
+@lru_cache(maxsize=1)
+def default_metaphor_lexicon():
+    """The built-in METAPHORS, compiled once"""
+    return MetaphorLexicon(METAPHORS)
+
+# Compiled lexicons by path, recompiled when the file's size or mtime changes
+_metaphor_lexicons = {}
+
+def load_metaphor_lexicon(path):
+    """
+    Load a metaphor lexicon from a JSON file holding one object of {"word": "metaphor"}
+    entries. Compiled lexicons are cached until the file changes.
+    """
+    stat = os.stat(path)
+    cache_key = os.path.abspath(path)
+    cached = _metaphor_lexicons.get(cache_key)
+    if cached and cached[0] == (stat.st_size, stat.st_mtime_ns):
+        return cached[1]
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        metaphors = json.load(f)
+    if not isinstance(metaphors, dict) or not all(
+            isinstance(key, str) and isinstance(value, str) for key, value in metaphors.items()):
+        raise ValueError(f"{path} must hold a JSON object mapping words to metaphors")
+    
+    lexicon = MetaphorLexicon(metaphors)
+    _metaphor_lexicons[cache_key] = ((stat.st_size, stat.st_mtime_ns), lexicon)
+    return lexicon
+
+# Function to apply multiple poetic devices to the generated poem
+@tracer.traced('devices')
+def apply_poetic_devices(poem, devices, features=None, metaphors=None):
+    """
+    Enhances the generated poem by applying selected poetic devices.
+    
+    :param poem: The poem text as a string
+    :param devices: A list of poetic devices selected by the user
+    :param features: The model's feature table (onsets and rhyme patterns are looked up there)
+    :param metaphors: MetaphorLexicon for the Metaphor device (default: the built-in METAPHORS)
+    :return: Modified poem with applied poetic effects
+    """
+    lines = poem.split("\n")
+    
+    if "Alliteration" in devices:
+        lines = [alliterate_line(line, features) for line in lines]
+    
+    if "Repetition" in devices and len(lines) > 2:
+        # Repeats a phrase from the first line in every second line
+        repeated_phrase = lines[0].split()[:3]  # First 3 words of first line
+        if repeated_phrase:
+            for i in range(1, len(lines), 2):
+                lines[i] = lines[i] + " " + " ".join(repeated_phrase)
+    
+    if "Rhyme" in devices:
+        new_lines = []
+        used_lines = set()
+        
+        # Find rhyming pairs
+        rhyme_pairs = find_rhyming_pairs(lines, features)
+        
+        # Sort by score
+        rhyme_pairs.sort(key=lambda x: x[2], reverse=True)
+        
+        # Apply rhymes in order of best scores
+        for i, j, score in rhyme_pairs:
+            if i not in used_lines and j not in used_lines:
+                new_lines.extend([lines[i], lines[j]])
+                used_lines.add(i)
+                used_lines.add(j)
+        
+        # Add remaining lines
+        for i, line in enumerate(lines):
+            if i not in used_lines:
+                new_lines.append(line)
+        
+        lines = new_lines
+    
+    poem = "\n".join(lines)
+    
+    if "Metaphor" in devices:
+        # Replaces common words with metaphorical descriptions, in one pass over the poem
+        if metaphors is None:
+            metaphors = default_metaphor_lexicon()
+        poem = metaphors.substitute(poem)
+    
+    return poem
+
+# Number of generated poems kept for repeated seeded requests
+RESULT_CACHE_SIZE = 1024
+
+class ResultCache:
+    """
+    Bounded LRU cache of generated poems, keyed by everything that decides a seeded
+    poem: the model fingerprint, seed, line count, devices, depth and generate_poem's
+    other options. Repeated requests from the UI, batch jobs or a service are then a
+    dictionary lookup, and return exactly what the first one did.
+    """
+    def __init__(self, max_entries=RESULT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._poems = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key):
+        """The cached poem for key, or None"""
+        with self._lock:
+            poem = self._poems.get(key)
+            if poem is None:
+                self.misses += 1
+                return None
+            self._poems.move_to_end(key)
+            self.hits += 1
+            return poem
+    
+    def put(self, key, poem):
+        """Remember a poem, dropping the least recently used beyond max_entries"""
+        with self._lock:
+            self._poems[key] = poem
+            self._poems.move_to_end(key)
+            while len(self._poems) > self.max_entries:
+                self._poems.popitem(last=False)
+    
+    def clear(self):
+        """Forget every cached poem (counters are kept)"""
+        with self._lock:
+            self._poems.clear()
+    
+    def stats(self):
+        """Snapshot of the cache counters"""
+        with self._lock:
+            return {
+                'poems': len(self._poems),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+# Shared cache of seeded poems used by generate_poem
+result_cache = ResultCache()
+
+def parse_rhyme_scheme(scheme):
+    """
+    The letters of a rhyme scheme such as "ABAB" or a rhyme_schemes label such as
+    "ABBA (Enclosed)". Lines with the same letter in a stanza rhyme.
+    """
+    letters = scheme.split()[0].upper() if scheme and scheme.strip() else ''
+    if not letters.isalpha():
+        raise ValueError(f"Unknown rhyme scheme: {scheme!r}")
+    return letters
+
+# Function to generate a thoughtful poem using the Markov chain model
+def generate_poem(start_word, num_lines, transition_matrix, devices, depth=2, start_mode='uniform',
+                  progress=None, metaphors=None, rhyme_scheme=None, seed=None, use_cache=True):
+    """
+    Generates a poem using a Markov chain with simpler rhyming.
+    start_mode picks how new line contexts are drawn (see MarkovModel.random_context).
+    progress, if given, is called as progress(lines_done, num_lines) whenever lines are added;
+    an exception raised from it aborts generation.
+    metaphors is a MetaphorLexicon for the Metaphor device (default: the built-in one).
+    
+    rhyme_scheme (e.g. "ABAB" or "ABBA (Enclosed)") lays rhymes out per stanza as lines
+    are written; the Rhyme device's reordering is then skipped. Without one, lines are
+    written in rhyming pairs where a rhyme can be found. A rhyming line is grown
+    backwards from its rhyme word with the model's ReverseChain, so it ends on it.
+    
+    With a seed, every draw comes from random.Random(seed) instead of the global random
+    module, so the same request always writes the same poem; start_word may then be None
+    to draw the first context from the seed too. Seeded poems of a model object (not a
+    plain dict) are kept in result_cache unless use_cache is False.
+    """
+    # Sample from a frozen view of the model (preprocess_text already returns one)
+    model = (transition_matrix if hasattr(transition_matrix, 'sample_next')
+             else MarkovModel(transition_matrix, depth))
+    depth = model.depth
+    scheme = parse_rhyme_scheme(rhyme_scheme or "AABB")
+    if rhyme_scheme:
+        devices = [device for device in devices if device != "Rhyme"]
+    rng = random if seed is None else random.Random(seed)
+    
+    cache_key = None
+    if seed is not None and use_cache and model is transition_matrix:
+        cache_key = (model_fingerprint(model), seed, num_lines, tuple(sorted(set(devices))), depth,
+                     tuple(start_word) if start_word else None, start_mode, rhyme_scheme and scheme,
+                     None if metaphors is None else metaphors.fingerprint)
+        poem = result_cache.get(cache_key)
+        if poem is not None:
+            if progress:
+                progress(num_lines, num_lines)
+            return poem
+    if start_word is None:
+        start_word = model.random_context(rng, mode=start_mode)
+    
+    def find_rhyming_word(word):
+        """Find a word that rhymes with the given word"""
+        if not word:
+            return None
+        with tracer.span('rhyme search'):
+            return model.find_rhyme(word, rng)
+    
+    def generate_line(start_words):
+        """Generate a line forwards from a start context"""
+        line = list(start_words)
+        for _ in range(8):  # Keep lines reasonably short
+            if len(line) >= 4:  # If line long enough
+                break
+            next_word = model.sample_next(tuple(line[-depth:]), rng)
+            if next_word is None:
+                break
+            line.append(next_word)
+        return line if len(line) >= 4 else None
+    
+    def generate_line_ending(target_end):
+        """Generate a line backwards from the word it must end on"""
+        reverse = model.reverse_chain()
+        line = [target_end]
+        while len(line) < 4:
+            previous_word = reverse.sample_before(line, rng)
+            if previous_word is None:
+                return None
+            line.insert(0, previous_word)
+        return line
+    
+    with tracer.span('sample'):
+        poem_lines = []
+        rhyme_ends = {}  # (stanza, letter) -> last word of the first line with that letter
+        while len(poem_lines) < num_lines:
+            i = len(poem_lines)
+            rhyme_key = (i // len(scheme), scheme[i % len(scheme)])
+            
+            # Lines after the first of their letter end on a word rhyming with it
+            line = None
+            rhyme_word = find_rhyming_word(rhyme_ends.get(rhyme_key))
+            if rhyme_word:
+                line = generate_line_ending(rhyme_word)
+            if line is None:
+                line = generate_line(start_word)
+                start_word = model.random_context(rng, mode=start_mode)
+                if not line:
+                    continue
+            
+            rhyme_ends.setdefault(rhyme_key, line[-1])
+            poem_lines.append(' '.join(line).capitalize())
+            if progress:
+                progress(len(poem_lines), num_lines)
+    
+    poem = apply_poetic_devices("\n".join(poem_lines), devices, features=model.features,
+                                metaphors=metaphors)
+    if cache_key is not None:
+        result_cache.put(cache_key, poem)
+    return poem
@@ -0,0 +1,377 @@
+"""
+Local poem-generation service: a small HTTP/1.1 JSON server on asyncio. Every poet in
+poet_files is built (or checked in the model cache) once at startup and loaded by each
+worker process; generation runs in the process pool, so the event loop only parses
+requests and writes responses and never waits on sampling.
+
+    python muse_service.py --port 8765 --workers 4
+    
+    curl -s localhost:8765/poets
+    curl -s -X POST localhost:8765/generate \
+         -d '{"poet": "Robert Frost", "lines": 8, "devices": ["Rhyme"], "seed": 42}'
+    curl -s localhost:8765/metrics
+
+The service only listens on loopback addresses.
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from muse_engine import (build_workers, generate_poem, model_registry, parse_rhyme_scheme,
+                         poet_files, poetic_devices, preprocess_text, resolve_corpus_path,
+                         result_cache, rhyme_schemes)
+from muse_trace import percentile
+
+DEFAULT_PORT = 8765
+
+# Request limits: header block and body size in bytes, and lines per poem
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+MAX_POEM_LINES = 100
+
+# Latencies kept per endpoint for the percentiles, and the window for current throughput
+METRICS_WINDOW = 1000
+THROUGHPUT_WINDOW_SECONDS = 60
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error", 501: "Not Implemented"}
+
+# Path -> (method, PoemService handler)
+ROUTES = {
+    '/health': ('GET', '_health'),
+    '/poets': ('GET', '_list_poets'),
+    '/metrics': ('GET', '_metrics'),
+    '/generate': ('POST', '_generate')
+}
+
+class RequestError(Exception):
+    """A request the service rejects, answered with status and message"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# Each worker process loads every poet's model once (from the disk cache) at startup
+def _init_service_worker(poets, depth, backoff):
+    """Process pool initializer: load the models into this worker's registry"""
+    for poet in poets:
+        model_registry.get(poet, depth, backoff=backoff)
+
+def _generate_in_worker(poet, depth, backoff, num_lines, devices, seed, rhyme_scheme):
+    """Generate one poem in a worker; returns (poem, served from result cache, generation ms)"""
+    model = model_registry.get(poet, depth, backoff=backoff)
+    if not model:
+        raise ValueError(f"No model for {poet}")
+    hits = result_cache.hits
+    start = time.perf_counter()
+    poem = generate_poem(None, num_lines, model, devices, seed=seed, rhyme_scheme=rhyme_scheme)
+    return poem, result_cache.hits > hits, (time.perf_counter() - start) * 1000
+
+class ServiceMetrics:
+    """Request counters, per-endpoint latency percentiles and throughput"""
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.in_flight = 0
+        self.statuses = {}
+        self.latencies_ms = {}  # Endpoint -> recent request latencies
+        self.generation_ms = deque(maxlen=METRICS_WINDOW)  # Time spent in workers
+        self.cached_poems = 0
+        self._finished = deque()  # Completion times within THROUGHPUT_WINDOW_SECONDS
+    
+    def record(self, endpoint, status, latency_ms):
+        now = time.monotonic()
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        window = self.latencies_ms.get(endpoint)
+        if window is None:
+            window = self.latencies_ms[endpoint] = deque(maxlen=METRICS_WINDOW)
+        window.append(latency_ms)
+        self._finished.append(now)
+        self._trim(now)
+    
+    def _trim(self, now):
+        while self._finished and now - self._finished[0] > THROUGHPUT_WINDOW_SECONDS:
+            self._finished.popleft()
+    
+    def snapshot(self):
+        """JSON-ready view of the metrics"""
+        now = time.monotonic()
+        self._trim(now)
+        uptime = now - self.started
+        window = min(uptime, THROUGHPUT_WINDOW_SECONDS)
+        return {
+            'uptime_seconds': uptime,
+            'requests': self.requests,
+            'in_flight': self.in_flight,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'throughput': {
+                'requests_per_second': len(self._finished) / window if window > 0 else 0.0,
+                'window_seconds': THROUGHPUT_WINDOW_SECONDS,
+                'average_requests_per_second': self.requests / uptime if uptime > 0 else 0.0
+            },
+            'latency_ms': {
+                endpoint: _latency_summary(samples)
+                for endpoint, samples in sorted(self.latencies_ms.items())
+            },
+            'generation_ms': _latency_summary(self.generation_ms) if self.generation_ms else None,
+            'cached_poems': self.cached_poems
+        }
+
+def _latency_summary(samples):
+    samples = list(samples)
+    return {
+        'count': len(samples),
+        'p50': percentile(samples, 0.50),
+        'p90': percentile(samples, 0.90),
+        'p99': percentile(samples, 0.99),
+        'max': max(samples)
+    }
+
+class PoemService:
+    """
+    The HTTP service: GET /health, /poets and /metrics; POST /generate with a JSON body
+    {"poet": ..., "lines": 10, "devices": [...], "seed": 42, "rhyme_scheme": "ABAB"}.
+    Poems with the same seed and options come back identical (unseeded requests get a
+    random seed, returned with the poem).
+    """
+    def __init__(self, host='127.0.0.1', port=DEFAULT_PORT, workers=None, depth=2, backoff=False):
+        if not _is_loopback(host):
+            raise ValueError(f"The service only listens on loopback addresses, not {host}")
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.depth = depth
+        self.backoff = backoff
+        self.poets = []
+        self.metrics = ServiceMetrics()
+        self._executor = None
+        self._server = None
+    
+    async def start(self):
+        """Build or validate every poet's model, start the workers and begin listening"""
+        loop = asyncio.get_running_loop()
+        for poet in poet_files:
+            # Builds (and caches) in a thread so startup doesn't block the loop either
+            file_path = resolve_corpus_path(poet)
+            model = await loop.run_in_executor(
+                None, partial(preprocess_text, file_path, self.depth,
+                              workers=build_workers(file_path), backoff=self.backoff))
+            if model:
+                self.poets.append(poet)
+            else:
+                print(f"Warning: no model for {poet}; it won't be served", file=sys.stderr)
+        
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             initializer=_init_service_worker,
+                                             initargs=(self.poets, self.depth, self.backoff))
+        # Start every worker now so the first requests don't pay for loading models
+        await asyncio.gather(*(loop.run_in_executor(self._executor, time.sleep, 0)
+                               for _ in range(self.workers)))
+        
+        # limit caps the header block, which is read with a single readuntil
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port,
+                                                  limit=MAX_HEADER_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]  # Resolves port 0
+    
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+    
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+    
+    async def _handle_connection(self, reader, writer):
+        """Serve requests on one connection until the client closes it (keep-alive)"""
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except RequestError as e:
+                    await _write_response(writer, e.status, {'error': str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                path = path.split('?', 1)[0]
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                
+                start = time.perf_counter()
+                self.metrics.in_flight += 1
+                try:
+                    status, payload = 200, await self._dispatch(method, path, body)
+                except RequestError as e:
+                    status, payload = e.status, {'error': str(e)}
+                except Exception as e:
+                    status, payload = 500, {'error': f"Error generating poem: {e}"}
+                finally:
+                    self.metrics.in_flight -= 1
+                await _write_response(writer, status, payload, keep_alive)
+                endpoint = f"{method} {path}" if path in ROUTES else "other"
+                self.metrics.record(endpoint, status, (time.perf_counter() - start) * 1000)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+    
+    async def _dispatch(self, method, path, body):
+        route = ROUTES.get(path)
+        if route is None:
+            raise RequestError(404, f"No such endpoint: {path}")
+        if method != route[0]:
+            raise RequestError(405, f"{path} expects {route[0]}")
+        return await getattr(self, route[1])(body)
+    
+    async def _health(self, body):
+        return {'status': 'ok', 'poets': len(self.poets), 'workers': self.workers}
+    
+    async def _list_poets(self, body):
+        return {'poets': self.poets, 'devices': poetic_devices,
+                'rhyme_schemes': [scheme.split()[0] for scheme in rhyme_schemes]}
+    
+    async def _metrics(self, body):
+        snapshot = self.metrics.snapshot()
+        snapshot['workers'] = self.workers
+        return snapshot
+    
+    async def _generate(self, body):
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError as e:
+            raise RequestError(400, f"Body must be JSON: {e}")
+        if not isinstance(request, dict):
+            raise RequestError(400, "Body must be a JSON object")
+        
+        poet = request.get('poet')
+        if poet not in self.poets:
+            raise RequestError(400, f"poet must be one of: {', '.join(self.poets)}")
+        num_lines = request.get('lines', 10)
+        if (not isinstance(num_lines, int) or isinstance(num_lines, bool)
+                or not 1 <= num_lines <= MAX_POEM_LINES):
+            raise RequestError(400, f"lines must be a whole number from 1 to {MAX_POEM_LINES}")
+        devices = request.get('devices', [])
+        if not isinstance(devices, list) or any(device not in poetic_devices for device in devices):
+            raise RequestError(400, f"devices must be a list of: {', '.join(poetic_devices)}")
+        seed = request.get('seed')
+        if seed is None:
+            seed = random.randrange(2 ** 32)
+        elif not isinstance(seed, int) or isinstance(seed, bool):
+            raise RequestError(400, "seed must be a whole number")
+        rhyme_scheme = request.get('rhyme_scheme')
+        if rhyme_scheme is not None:
+            try:
+                parse_rhyme_scheme(rhyme_scheme if isinstance(rhyme_scheme, str) else '')
+            except ValueError as e:
+                raise RequestError(400, str(e))
+        
+        loop = asyncio.get_running_loop()
+        poem, cached, generation_ms = await loop.run_in_executor(
+            self._executor, _generate_in_worker, poet, self.depth, self.backoff, num_lines,
+            devices, seed, rhyme_scheme)
+        self.metrics.generation_ms.append(generation_ms)
+        self.metrics.cached_poems += cached
+        return {'poet': poet, 'lines': num_lines, 'devices': devices, 'seed': seed,
+                'rhyme_scheme': rhyme_scheme, 'text': poem, 'cached': cached}
+
+def _is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+async def _read_request(reader):
+    """
+    Read one HTTP request: (method, path, lower-cased headers, body), or None if the
+    client closed the connection between requests
+    """
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise
+    except asyncio.LimitOverrunError:
+        raise RequestError(413, "Request headers too large")
+    
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise RequestError(400, "Malformed request line")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+    
+    if 'transfer-encoding' in headers:  # Bodies are only read by Content-Length
+        raise RequestError(501, "Transfer-Encoding is not supported; send a Content-Length")
+    length = headers.get('content-length', '0')
+    if not (length.isascii() and length.isdigit()):  # int() would also take '-1', ' 1_0'
+        raise RequestError(400, "Bad Content-Length")
+    length = int(length)
+    if length > MAX_BODY_BYTES:
+        raise RequestError(413, "Request body too large")
+    body = await reader.readexactly(length) if length else b''
+    return parts[0].upper(), parts[1], headers, body
+
+async def _write_response(writer, status, payload, keep_alive=True):
+    body = json.dumps(payload).encode('utf-8')
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+async def run_service(host='127.0.0.1', port=DEFAULT_PORT, workers=None, depth=2, backoff=False):
+    """Start a PoemService and serve until cancelled"""
+    service = PoemService(host, port, workers, depth, backoff)
+    await service.start()
+    print(f"Serving {len(service.poets)} poets on http://{host}:{service.port} "
+          f"with {service.workers} workers", file=sys.stderr)
+    try:
+        await service.serve_forever()
+    finally:
+        await service.stop()
+
+def service_main(argv=None):
+    """Command line entry point: python muse_service.py --port ..."""
+    parser = argparse.ArgumentParser(description="Serve poem generation over local HTTP")
+    parser.add_argument('--host', default='127.0.0.1', help="loopback address to listen on")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f"port to listen on (default {DEFAULT_PORT}, 0 = any free port)")
+    parser.add_argument('--workers', type=int, help="generation processes (default: CPU count)")
+    parser.add_argument('--depth', type=int, default=2, help="Markov context depth (default 2)")
+    parser.add_argument('--backoff', action='store_true',
+                        help="use variable-order models that back off to shorter contexts")
+    args = parser.parse_args(argv)
+    
+    if not _is_loopback(args.host):
+        parser.error("--host must be a loopback address such as 127.0.0.1")
+    try:
+        asyncio.run(run_service(args.host, args.port, args.workers, args.depth, args.backoff))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(service_main())
@@ -0,0 +1,444 @@
+"""
+Saved-poem library: an SQLite index (library.sqlite3) in the saves directory that holds
+each poem's metadata, favorite flag and text, so the browser can list, sort and open
+poems with indexed queries instead of globbing and parsing every JSON file per click.
+
+The JSON files stay the portable copy of each poem: saving, favoriting and deleting
+keep them in step with the index. The index also remembers each file's mtime and size,
+so sync() can pick up files added, edited or removed outside the app with one directory
+scan, re-reading only the files that changed.
+
+Search goes through an FTS5 full-text index over poet, date and text, kept in step with
+the poems table by triggers (a LIKE scan is used if SQLite was built without FTS5).
+"""
+import json
+import os
+import re
+import sqlite3
+from collections.abc import Sequence
+from datetime import datetime
+
+STORE_FILENAME = 'library.sqlite3'
+
+# Browser sort options -> ORDER BY clauses, each served by one of the indexes below
+SORT_ORDERS = {
+    "Date (Newest)": "date DESC, id DESC",
+    "Date (Oldest)": "date ASC, id ASC",
+    "Poet A-Z": "poet ASC, date DESC, id DESC",
+    "Poet Z-A": "poet DESC, date DESC, id DESC",
+    "Favorites First": "favorite DESC, date DESC, id DESC"
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS poems (
+    id INTEGER PRIMARY KEY,
+    file_name TEXT UNIQUE,
+    poet TEXT NOT NULL,
+    date TEXT NOT NULL,
+    theme TEXT,
+    devices TEXT NOT NULL DEFAULT '[]',
+    favorite INTEGER NOT NULL DEFAULT 0,
+    text TEXT NOT NULL,
+    file_mtime_ns INTEGER,
+    file_size INTEGER
+);
+CREATE INDEX IF NOT EXISTS poems_by_date ON poems (date, id);
+CREATE INDEX IF NOT EXISTS poems_by_poet ON poems (poet, date, id);
+CREATE INDEX IF NOT EXISTS poems_by_favorite ON poems (favorite, date, id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Full-text index over the poems table. Prefix indexes make 1-3 letter prefix queries
+# (what you get while typing) as cheap as whole-word ones.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS poems_fts USING fts5 (
+    poet, date, text, content='poems', content_rowid='id', prefix='1 2 3'
+);
+CREATE TRIGGER IF NOT EXISTS poems_fts_insert AFTER INSERT ON poems BEGIN
+    INSERT INTO poems_fts (rowid, poet, date, text) VALUES (new.id, new.poet, new.date, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS poems_fts_delete AFTER DELETE ON poems BEGIN
+    INSERT INTO poems_fts (poems_fts, rowid, poet, date, text)
+    VALUES ('delete', old.id, old.poet, old.date, old.text);
+END;
+CREATE TRIGGER IF NOT EXISTS poems_fts_update AFTER UPDATE OF poet, date, text ON poems BEGIN
+    INSERT INTO poems_fts (poems_fts, rowid, poet, date, text)
+    VALUES ('delete', old.id, old.poet, old.date, old.text);
+    INSERT INTO poems_fts (rowid, poet, date, text) VALUES (new.id, new.poet, new.date, new.text);
+END;
+"""
+
+_SEARCH_TOKEN_RE = re.compile(r'\w+')
+
+# Searches matching more poems than this (typically the first letter or two typed) are
+# answered lazily by SearchResults instead of listing every match up front
+LAZY_SEARCH_MIN = 4096
+
+# Rough cost, in microseconds, of checking one poem id against the full-text index and of
+# fetching one matching id in bulk; SearchResults picks whichever is cheaper
+PROBE_COST = 35
+FETCH_COST = 0.3
+
+def search_tokens(query):
+    """Lower-cased word tokens of a search query, each matched as a word prefix"""
+    return _SEARCH_TOKEN_RE.findall(query.lower())
+
+def narrows(tokens, previous_tokens):
+    """
+    True if every poem matching tokens also matches previous_tokens: each earlier token
+    is a prefix of the token in the same place (more tokens only narrow further)
+    """
+    return (len(tokens) >= len(previous_tokens)
+            and all(token.startswith(previous) for token, previous in zip(tokens, previous_tokens)))
+
+class SearchResults(Sequence):
+    """
+    Ids, in sort order, of the poems matching a broad search, found only as far as they're
+    read. The length comes from a COUNT query, so the browser can size its scrollbar and
+    show the first page without the store listing tens of thousands of matches per
+    keystroke. Pages near the top are found by checking the next stretch of the sort order
+    against the index; reading further in fetches every match at once and filters the rest.
+    """
+    def __init__(self, store, match, ordered, count):
+        self._store = store
+        self._match = match  # FTS5 MATCH expression
+        self._ordered = ordered  # Ids of every poem in sort order
+        self._count = count
+        self._found = []  # Matches among ordered[:self._scanned], in order
+        self._scanned = 0
+        self._ids = None  # Set of every matching id, once fetched
+    
+    def __len__(self):
+        return self._count
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            positions = range(*index.indices(self._count))
+            if positions:
+                self._fill(max(positions[0], positions[-1]) + 1)
+            return [self._found[i] for i in positions if i < len(self._found)]
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("search result index out of range")
+        self._fill(index + 1)
+        return self._found[index]
+    
+    def __iter__(self):
+        self._fill(self._count)
+        return iter(self._found)
+    
+    def __contains__(self, poem_id):
+        if self._ids is None:
+            return bool(self._store._matches_among(self._match, [poem_id]))
+        return poem_id in self._ids
+    
+    def index(self, poem_id, start=0, stop=None):
+        if poem_id not in self:
+            raise ValueError(f"{poem_id} is not in the search results")
+        self._fill(self._count)
+        return self._found.index(poem_id, start, self._count if stop is None else stop)
+    
+    def _fill(self, stop):
+        """Find matches until the first stop of them are known (or the ordering runs out)"""
+        while len(self._found) < stop and self._scanned < len(self._ordered):
+            # Stretch of the ordering expected to hold the missing matches
+            density = self._count / len(self._ordered)
+            span = int((stop - len(self._found)) / density) + 8
+            if (self._ids is None
+                    and span * PROBE_COST > (self._count - len(self._found)) * FETCH_COST):
+                self._ids = self._store._fetch_matches(self._match)
+            chunk = self._ordered[self._scanned:self._scanned + span]
+            if self._ids is None:
+                matched = self._store._matches_among(self._match, chunk)
+            else:
+                matched = self._ids
+            self._found.extend(poem_id for poem_id in chunk if poem_id in matched)
+            self._scanned += len(chunk)
+
+class PoemStore:
+    """
+    Indexed library of saved poems. Rows are identified by a stable integer id, which is
+    what callers should hold on to (list positions change with sorting and filtering).
+    """
+    def __init__(self, saves_dir):
+        self.saves_dir = saves_dir
+        self.path = os.path.join(saves_dir, STORE_FILENAME)
+        self._db = sqlite3.connect(self.path)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.executescript(_SCHEMA)
+            columns = {row['name'] for row in self._db.execute("PRAGMA table_info(poems)")}
+            for column in ('file_mtime_ns', 'file_size'):
+                if column not in columns:  # Libraries created before files were tracked
+                    self._db.execute(f"ALTER TABLE poems ADD COLUMN {column} INTEGER")
+        try:
+            with self._db:
+                self._db.executescript(_FTS_SCHEMA)
+                if self._get_meta('fts_built') is None:
+                    # Index poems stored before the full-text index existed
+                    self._db.execute("INSERT INTO poems_fts (poems_fts) VALUES ('rebuild')")
+                    self._set_meta('fts_built', '1')
+            self.full_text = True
+        except sqlite3.OperationalError:
+            self.full_text = False  # No FTS5 in this SQLite build
+        self._orders = {}  # sort -> ids in that order
+        self._last_search = None  # (tokens, sort, ids) of the previous fully listed search
+        
+        # Directory snapshot: JSON file name -> (mtime_ns, size) when it was last read
+        self._snapshot = {row['file_name']: (row['file_mtime_ns'], row['file_size'])
+                          for row in self._db.execute(
+                              "SELECT file_name, file_mtime_ns, file_size FROM poems "
+                              "WHERE file_name IS NOT NULL")}
+        self._unreadable = {}  # Same, for files that failed to parse (so they warn only once)
+        if not self._snapshot:
+            self.sync()  # First open: import the JSON files already saved
+    
+    def _get_meta(self, key):
+        row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row['value']
+    
+    def _set_meta(self, key, value):
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+    
+    def _upsert(self, data, file_name, stat):
+        """Insert or refresh the row for a poem's JSON file (as of stat) and return its id"""
+        # An UPDATE then INSERT rather than ON CONFLICT ... RETURNING, which needs SQLite 3.35
+        values = (data.get('poet', ''), data.get('date', ''), data.get('theme'),
+                  json.dumps(data.get('devices', [])), int(bool(data.get('favorite', False))),
+                  data.get('text', ''), stat.st_mtime_ns, stat.st_size, file_name)
+        cursor = self._db.execute(
+            """UPDATE poems SET poet = ?, date = ?, theme = ?, devices = ?, favorite = ?, text = ?,
+                                file_mtime_ns = ?, file_size = ?
+               WHERE file_name = ?""", values)
+        if cursor.rowcount:
+            poem_id = self._db.execute("SELECT id FROM poems WHERE file_name = ?",
+                                       (file_name,)).fetchone()['id']
+        else:
+            poem_id = self._db.execute(
+                """INSERT INTO poems (poet, date, theme, devices, favorite, text, file_mtime_ns,
+                                      file_size, file_name)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""", values).lastrowid
+        self._snapshot[file_name] = (stat.st_mtime_ns, stat.st_size)
+        return poem_id
+    
+    def sync(self):
+        """
+        Bring the index up to date with the saves directory in one scandir: new JSON files
+        are imported, files whose mtime or size changed are re-read, and poems whose file
+        is gone are dropped. Unchanged files are never opened.
+        
+        :return: (added, updated, removed) counts
+        """
+        added = updated = 0
+        seen = set()
+        with self._db:
+            for entry in os.scandir(self.saves_dir):
+                if not entry.name.endswith('.json') or not entry.is_file():
+                    continue
+                seen.add(entry.name)
+                stat = entry.stat()
+                known = self._snapshot.get(entry.name)
+                if (known == (stat.st_mtime_ns, stat.st_size)
+                        or self._unreadable.get(entry.name) == (stat.st_mtime_ns, stat.st_size)):
+                    continue
+                
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    print(f"Warning: skipping unreadable saved poem {entry.name}: {e}")
+                    self._unreadable[entry.name] = (stat.st_mtime_ns, stat.st_size)
+                    continue
+                self._unreadable.pop(entry.name, None)
+                self._upsert(data, entry.name, stat)
+                if known is None:
+                    added += 1
+                else:
+                    updated += 1
+            
+            removed = [file_name for file_name in self._snapshot if file_name not in seen]
+            for start in range(0, len(removed), 500):
+                chunk = removed[start:start + 500]
+                self._db.execute(f"DELETE FROM poems WHERE file_name IN "
+                                 f"({', '.join('?' * len(chunk))})", chunk)
+            for file_name in removed:
+                del self._snapshot[file_name]
+        
+        if added or updated or removed:
+            self._invalidate()
+        return added, updated, len(removed)
+    
+    def _write_json(self, file_name, data, new=False):
+        """Write a poem's JSON file and return its new stat (if new, one that doesn't exist yet)"""
+        path = os.path.join(self.saves_dir, file_name)
+        with open(path, 'x' if new else 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=4)
+        return os.stat(path)
+    
+    def save(self, poem_data):
+        """
+        Save a poem (a dict with text, poet, date, theme, devices and favorite) as a JSON
+        file in the saves directory and index it. Returns (poem id, path of the JSON file).
+        """
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        file_name = f"poem_{stamp}.json"
+        attempt = 1
+        while True:
+            try:
+                stat = self._write_json(file_name, poem_data, new=True)
+                break
+            except FileExistsError:
+                # Saved within the same second as another poem - number it instead of overwriting
+                attempt += 1
+                file_name = f"poem_{stamp}_{attempt}.json"
+        with self._db:
+            poem_id = self._upsert(poem_data, file_name, stat)
+        self._invalidate()
+        return poem_id, os.path.join(self.saves_dir, file_name)
+    
+    def _invalidate(self):
+        """Forget cached orderings and search results after the library changes"""
+        self._orders.clear()
+        self._last_search = None
+    
+    def ordered_ids(self, sort="Date (Newest)"):
+        """Ids of every poem in the given browser sort order (cached until the library changes)"""
+        ids = self._orders.get(sort)
+        if ids is None:
+            order = SORT_ORDERS.get(sort, SORT_ORDERS["Date (Newest)"])
+            ids = [row[0] for row in self._db.execute(f"SELECT id FROM poems ORDER BY {order}")]
+            self._orders[sort] = ids
+        return ids
+    
+    def _in_order(self, ids, sort):
+        """A set of ids as a list in the given sort order"""
+        if not ids:
+            return []
+        # One pass over the ordering costs less than building a position lookup for it,
+        # which would have to be redone after every change to the library
+        return [poem_id for poem_id in self.ordered_ids(sort) if poem_id in ids]
+    
+    def _fetch_matches(self, match):
+        """Set of ids of the poems matching an FTS5 expression"""
+        # One comma-joined row parses several times faster than a row per id
+        joined = self._db.execute("SELECT group_concat(rowid) FROM poems_fts "
+                                  "WHERE poems_fts MATCH ?", (match,)).fetchone()[0]
+        return frozenset(json.loads(f"[{joined or ''}]"))
+    
+    def _matches_among(self, match, ids):
+        """Set of the given ids whose poems match an FTS5 expression"""
+        return {row[0] for row in self._db.execute(
+            "SELECT rowid FROM poems_fts WHERE poems_fts MATCH ? "
+            f"AND rowid IN ({', '.join('?' * len(ids))})", (match, *ids))}
+    
+    def search(self, query, sort="Date (Newest)"):
+        """
+        Ids, in the given sort order, of the poems matching query: every word of the query
+        must start a word of the poem's poet, date or text (case-insensitive). Broad queries
+        return a SearchResults, which finds matches only as the list reads them. When a query
+        narrows the previous one (more letters or more words), its matches are picked out of
+        the previous list, which is already in order.
+        """
+        tokens = search_tokens(query)
+        if not tokens:
+            self._last_search = None
+            return self.ordered_ids(sort)
+        if not self.full_text:
+            return self._search_like(query, sort)
+        
+        match = ' '.join(f'"{token}"*' for token in tokens)
+        previous = self._last_search
+        if previous and previous[1] == sort and narrows(tokens, previous[0]):
+            ids = self._fetch_matches(match)
+            poem_ids = [poem_id for poem_id in previous[2] if poem_id in ids]
+        else:
+            count = self._db.execute("SELECT count(*) FROM poems_fts WHERE poems_fts MATCH ?",
+                                     (match,)).fetchone()[0]
+            if count > LAZY_SEARCH_MIN:
+                self._last_search = None
+                return SearchResults(self, match, self.ordered_ids(sort), count)
+            poem_ids = self._in_order(self._fetch_matches(match), sort)
+        self._last_search = (tokens, sort, poem_ids)
+        return poem_ids
+    
+    def _search_like(self, query, sort):
+        """Substring search for SQLite builds without FTS5"""
+        order = SORT_ORDERS.get(sort, SORT_ORDERS["Date (Newest)"])
+        pattern = '%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        return [row[0] for row in self._db.execute(
+            f"""SELECT id FROM poems
+                WHERE poet LIKE ?1 ESCAPE '\\' OR date LIKE ?1 ESCAPE '\\'
+                   OR text LIKE ?1 ESCAPE '\\'
+                ORDER BY {order}""", (pattern,))]
+    
+    def summaries(self, ids):
+        """Rows of (id, poet, date, favorite) for the given ids, in the same order"""
+        rows = {}
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            for row in self._db.execute(
+                    "SELECT id, poet, date, favorite FROM poems WHERE id IN "
+                    f"({', '.join('?' * len(chunk))})", chunk):
+                rows[row['id']] = row
+        return [rows[poem_id] for poem_id in ids if poem_id in rows]
+    
+    def get(self, poem_id):
+        """The full poem for an id as a dict (like its JSON file), or None if it's gone"""
+        row = self._db.execute("SELECT * FROM poems WHERE id = ?", (poem_id,)).fetchone()
+        if row is None:
+            return None
+        poem = dict(row)
+        poem['devices'] = json.loads(poem['devices'])
+        poem['favorite'] = bool(poem['favorite'])
+        return poem
+    
+    def set_favorite(self, poem_id, favorite):
+        """Set a poem's favorite flag in the index and in its JSON file"""
+        poem = self.get(poem_id)
+        if poem is None:
+            raise KeyError(poem_id)
+        with self._db:
+            self._db.execute("UPDATE poems SET favorite = ? WHERE id = ?", (int(favorite), poem_id))
+        self._orders.pop("Favorites First", None)
+        self._last_search = None  # Its list may be in the old favorites-first order
+        if not poem['file_name']:
+            return
+        
+        # Rewrite the JSON file keeping any fields the index doesn't know about
+        try:
+            with open(os.path.join(self.saves_dir, poem['file_name']), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = {key: poem[key] for key in ('text', 'poet', 'date', 'theme', 'devices')}
+        data['favorite'] = bool(favorite)
+        stat = self._write_json(poem['file_name'], data)
+        with self._db:
+            self._db.execute("UPDATE poems SET file_mtime_ns = ?, file_size = ? WHERE id = ?",
+                             (stat.st_mtime_ns, stat.st_size, poem_id))
+        self._snapshot[poem['file_name']] = (stat.st_mtime_ns, stat.st_size)
+    
+    def delete(self, poem_id):
+        """Remove a poem from the index and delete its JSON file"""
+        poem = self.get(poem_id)
+        if poem is None:
+            return
+        if poem['file_name']:
+            try:
+                os.remove(os.path.join(self.saves_dir, poem['file_name']))
+            except FileNotFoundError:
+                pass
+        with self._db:
+            self._db.execute("DELETE FROM poems WHERE id = ?", (poem_id,))
+        self._snapshot.pop(poem['file_name'], None)
+        self._invalidate()
+    
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM poems").fetchone()[0]
+    
+    def close(self):
+        self._db.close()
@@ -0,0 +1,218 @@
+"""
+Stage timing for the generation pipeline. The engine wraps each stage (reading the
+corpus, tokenizing, building the model, sampling lines, the rhyme search, the poetic
+device pass) in tracer.span(name); while the tracer is disabled those calls return a
+shared do-nothing span, so instrumented code costs one method call per span.
+
+Spans opened with no span around them (on the same thread) are runs. Each finished run
+is kept with its spans, and the time spent in each stage (minus the stages nested inside
+it) goes into a rolling window per stage, reported as percentiles and a histogram.
+Runs can be exported as a JSON summary or in Chrome's trace event format
+(chrome://tracing or https://ui.perfetto.dev).
+
+    from muse_trace import tracer
+    tracer.enable()
+    with tracer.span('generate') as run_span:
+        ...
+    print(format_run(run_span.run))
+
+Setting MUSE_TRACE=1 in the environment enables the tracer at import.
+"""
+import json
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from functools import wraps
+
+# Finished runs kept for export, and per-stage durations kept for the rolling statistics
+RUN_HISTORY_LENGTH = 50
+STAGE_WINDOW_LENGTH = 500
+
+# Upper bounds (ms) of the stage histogram buckets; anything slower lands in a last bucket
+HISTOGRAM_BOUNDS_MS = (0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000, 5000)
+
+class _NullSpan:
+    """What span() returns while tracing is disabled"""
+    __slots__ = ()
+    run = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+class _Span:
+    """One timed stage; nests under whatever span is open on the same thread"""
+    __slots__ = ('tracer', 'name', 'parent', 'start_ns', 'child_ns', 'events', 'run')
+    
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+        self.run = None
+    
+    def __enter__(self):
+        local = self.tracer._local
+        self.parent = getattr(local, 'span', None)
+        local.span = self
+        self.events = [] if self.parent is None else self.parent.events
+        self.child_ns = 0
+        self.start_ns = time.perf_counter_ns()
+        return self
+    
+    def __exit__(self, *exc_info):
+        duration = time.perf_counter_ns() - self.start_ns
+        self.tracer._local.span = self.parent
+        self.events.append((self.name, self.start_ns, duration, duration - self.child_ns))
+        if self.parent is not None:
+            self.parent.child_ns += duration
+        else:
+            self.tracer._finish_run(self)
+        return False
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile of a non-empty list of numbers"""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+def histogram(samples_ms):
+    """Counts of samples per HISTOGRAM_BOUNDS_MS bucket, as {'<=bound': count, '>last': count}"""
+    counts = OrderedDict((f"<={bound}", 0) for bound in HISTOGRAM_BOUNDS_MS)
+    counts[f">{HISTOGRAM_BOUNDS_MS[-1]}"] = 0
+    labels = list(counts)
+    for sample in samples_ms:
+        for bound, label in zip(HISTOGRAM_BOUNDS_MS, labels):
+            if sample <= bound:
+                counts[label] += 1
+                break
+        else:
+            counts[labels[-1]] += 1
+    return counts
+
+class StageTracer:
+    """
+    Collects stage spans while enabled. Safe to use from several threads: spans nest per
+    thread and finished runs are recorded under a lock.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.runs = deque(maxlen=RUN_HISTORY_LENGTH)
+        self.stage_ms = {}  # Stage name -> deque of recent per-run self times in ms
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+    
+    def enable(self):
+        self.enabled = True
+    
+    def disable(self):
+        self.enabled = False
+    
+    def span(self, name):
+        """Context manager timing a stage; its .run is set when it finishes a run"""
+        return _Span(self, name) if self.enabled else NULL_SPAN
+    
+    def traced(self, name):
+        """Decorator running every call of a function inside span(name)"""
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with _Span(self, name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+    
+    def _finish_run(self, root):
+        """Record a finished top-level span and its nested spans as a run"""
+        stages = OrderedDict()
+        for name, _, _, self_ns in sorted(root.events, key=lambda event: event[1]):
+            stages[name] = stages.get(name, 0) + self_ns / 1e6
+        root.run = {
+            'name': root.name,
+            'thread': threading.get_ident(),
+            'start_ns': root.start_ns,
+            'duration_ms': root.events[-1][2] / 1e6,
+            'stages': stages,
+            'spans': root.events
+        }
+        with self._lock:
+            self.runs.append(root.run)
+            for name, ms in stages.items():
+                window = self.stage_ms.get(name)
+                if window is None:
+                    window = self.stage_ms[name] = deque(maxlen=STAGE_WINDOW_LENGTH)
+                window.append(ms)
+    
+    def stage_stats(self):
+        """Per stage: count, p50/p90/p99/max (ms) and histogram over the rolling window"""
+        with self._lock:
+            windows = {name: list(window) for name, window in self.stage_ms.items()}
+        return {
+            name: {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 0.50),
+                'p90_ms': percentile(samples, 0.90),
+                'p99_ms': percentile(samples, 0.99),
+                'max_ms': max(samples),
+                'histogram': histogram(samples)
+            }
+            for name, samples in windows.items()
+        }
+    
+    def to_json(self):
+        """JSON-ready summary: rolling stage statistics and the recent runs' stage times"""
+        with self._lock:
+            runs = list(self.runs)
+        return {
+            'stages': self.stage_stats(),
+            'runs': [
+                {key: run[key] for key in ('name', 'duration_ms', 'stages')}
+                for run in runs
+            ]
+        }
+    
+    def chrome_trace(self):
+        """The recent runs as Chrome trace events (complete 'X' events, times in us)"""
+        with self._lock:
+            runs = list(self.runs)
+        events = []
+        for run in runs:
+            for name, start_ns, duration_ns, _ in run['spans']:
+                events.append({
+                    'name': name,
+                    'cat': run['name'],
+                    'ph': 'X',
+                    'ts': start_ns / 1000,
+                    'dur': duration_ns / 1000,
+                    'pid': self._pid,
+                    'tid': run['thread']
+                })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    
+    def export(self, path, format='json'):
+        """Write to_json() ('json') or chrome_trace() ('chrome') to path"""
+        data = self.chrome_trace() if format == 'chrome' else self.to_json()
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+    
+    def clear(self):
+        with self._lock:
+            self.runs.clear()
+            self.stage_ms.clear()
+
+def format_run(run):
+    """One-line summary of a run for a status bar, e.g. 'generate 312 ms (sample 4 ms, ...)'"""
+    if not run:
+        return ""
+    stages = [f"{name} {ms:.0f} ms" if ms >= 1 else f"{name} {ms:.2f} ms"
+              for name, ms in run['stages'].items() if name != run['name']]
+    summary = f"{run['name']} {run['duration_ms']:.0f} ms"
+    return f"{summary} ({', '.join(stages)})" if stages else summary
+
+# Shared tracer used by the engine's spans
+tracer = StageTracer(enabled=os.environ.get('MUSE_TRACE', '') not in ('', '0'))
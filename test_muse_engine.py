@@ -0,0 +1,470 @@
+"""Tests for muse_engine: python -m pytest (or python -m unittest)"""
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import muse_engine
+from muse_engine import (CORPUS_DIR, FeatureTable, MetaphorLexicon, ModelRegistry, NgramCounter,
+                         ResultCache, WordFeatures, apply_poetic_devices, build_feature_table,
+                         count_corpus_parallel, generate_poem, iter_corpus_pieces,
+                         load_cached_model, model_cache_path, model_fingerprint,
+                         poet_files, preprocess_text, resolve_corpus_path, tokenize_line,
+                         update_model, word_features)
+
+def write_corpus(directory, lines=4000, seed=7):
+    """A corpus of random lines with blank lines, Roman numerals and stop words mixed in"""
+    rng = random.Random(seed)
+    vocabulary = [rng.choice('bcdfglmnrst') + rng.choice('aeiou') + rng.choice('dkmnrst')
+                  for _ in range(300)] + ["the", "and", "of", "XIV", "moon", "night"]
+    path = os.path.join(directory, "corpus.txt")
+    with open(path, 'w', encoding='utf-8') as f:
+        for _ in range(lines):
+            words = [rng.choice(vocabulary) for _ in range(rng.randrange(0, 12))]
+            f.write(' '.join(words) + "\n")
+    return path
+
+def serial_counts(path, depth):
+    counter = NgramCounter(depth)
+    for piece, starts_line in iter_corpus_pieces(path):
+        counter.feed_text(piece, starts_line)
+    return counter
+
+class StreamedCorpusTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, "corpus.txt")
+        rng = random.Random(11)
+        vocabulary = ["moon", "night", "the", "XIV", "café", "naïve", "shadow", "o'er", "l", "IV."]
+        lines = [' '.join(rng.choice(vocabulary) for _ in range(rng.randrange(0, 9)))
+                 for _ in range(200)]
+        lines[50] = ' '.join(rng.choice(vocabulary) for _ in range(400))  # Longer than any chunk
+        lines[90] = "unbroken" * 40
+        with open(self.path, 'w', encoding='utf-8', newline='') as f:
+            f.write('\r\n'.join(lines[:100]) + '\n' + '\r'.join(lines[100:]))
+    
+    def tearDown(self):
+        self._directory.cleanup()
+    
+    def test_small_chunks_equal_the_whole_file(self):
+        with open(self.path, encoding='utf-8') as f:
+            text = f.read()
+        for depth in (1, 2, 3):
+            whole = NgramCounter(depth)
+            for line in text.split('\n'):
+                whole.feed_text(line)
+            for chunk_size in (1, 7, 64, 1000):
+                words = []
+                streamed = NgramCounter(depth)
+                for piece, starts_line in iter_corpus_pieces(self.path, chunk_size=chunk_size):
+                    words += tokenize_line(piece)
+                    streamed.feed_text(piece, starts_line)
+                self.assertEqual(words, tokenize_line(text), chunk_size)
+                self.assertEqual(list(streamed.payload()['transition_matrix'].items()),
+                                 list(whole.payload()['transition_matrix'].items()))
+                self.assertEqual(streamed.payload()['line_starts'], whole.payload()['line_starts'])
+                self.assertEqual(streamed.state(), whole.state())
+
+class ParallelCountingTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = write_corpus(self._directory.name)
+    
+    def tearDown(self):
+        self._directory.cleanup()
+    
+    def test_sharded_counts_equal_serial_counts(self):
+        for depth in (1, 2, 3):
+            serial = serial_counts(self.path, depth).payload()
+            for shards in (2, 7, 31):
+                sharded = count_corpus_parallel(self.path, depth, workers=2, shards=shards).payload()
+                self.assertEqual(sharded['transition_matrix'], serial['transition_matrix'])
+                self.assertEqual(sharded['line_starts'], serial['line_starts'])
+                self.assertEqual(sharded['counter_state'], serial['counter_state'])
+    
+    def test_parallel_build_equals_serial_build(self):
+        serial = preprocess_text(self.path, use_cache=False)
+        parallel = preprocess_text(self.path, use_cache=False, workers=2)
+        self.assertEqual(dict(parallel.items()), dict(serial.items()))
+        self.assertEqual(parallel.line_start_contexts, serial.line_start_contexts)
+
+class FeatureTableTest(unittest.TestCase):
+    def test_entries_match_word_features(self):
+        words = ("moon", "night", "Thorn", "a", "xiv", "shadows", "bright")
+        table = FeatureTable(words)
+        self.assertEqual(dict(table), {word: word_features(word) for word in words})
+        self.assertIsNone(table.get("missing"))
+        extended = table.extended(["light", "moon"])
+        self.assertEqual(len(extended), len(words) + 1)
+        self.assertEqual(extended["light"], word_features("light"))
+        self.assertNotIn("light", table)
+    
+    def test_id_columns_widen(self):
+        words = tuple(f"w{i}" for i in range(70000))
+        source = {word: WordFeatures((word, "x"), word[-2:], None) for word in words}
+        table = FeatureTable(words, source=source)
+        self.assertTrue(all(table[word] == source[word] for word in words))
+    
+    def test_models_keep_features_through_updates(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = write_corpus(directory, lines=300)
+            for options in ({}, {'compact': True}, {'backoff': True}):
+                model = preprocess_text(path, use_cache=False, **options)
+                updated = update_model(model, "zebra quagga moon")
+                for word in ("zebra", "quagga", "moon"):
+                    self.assertEqual(updated.features[word], word_features(word))
+                self.assertNotIn("zebra", model.features)
+
+class CorpusPathTest(unittest.TestCase):
+    def test_only_poet_names_resolve_under_the_corpus_directory(self):
+        poet, file_name = next(iter(poet_files.items()))
+        self.assertEqual(resolve_corpus_path(poet), os.path.join(CORPUS_DIR, file_name))
+        self.assertEqual(resolve_corpus_path(file_name), os.path.abspath(file_name))
+        self.assertEqual(resolve_corpus_path(os.path.join("poems", "mine.txt")),
+                         os.path.join(os.getcwd(), "poems", "mine.txt"))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "corpus.txt")
+            self.assertEqual(resolve_corpus_path(path), path)
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self._directory.name, "cache")
+        self._environment = mock.patch.dict(os.environ, {'MARKOVSMUSE_CACHE_DIR': self.cache_dir})
+        self._environment.start()
+        self.path = write_corpus(self._directory.name, lines=200)
+    
+    def tearDown(self):
+        self._environment.stop()
+        self._directory.cleanup()
+    
+    def cached_files(self):
+        return sorted(name for name in os.listdir(self.cache_dir) if name.endswith('.pickle'))
+    
+    def test_build_is_cached(self):
+        model = preprocess_text(self.path)
+        self.assertTrue(os.path.exists(model_cache_path(self.path, 2)))
+        cached = load_cached_model(self.path, 2)
+        self.assertEqual(dict(cached.items()), dict(model.items()))
+        self.assertIsNone(load_cached_model(self.path, 3))
+        self.assertIsNone(load_cached_model(self.path, 2, model_class=muse_engine.CompactMarkovModel))
+    
+    def test_tokenizer_change_invalidates(self):
+        preprocess_text(self.path)
+        path = model_cache_path(self.path, 2)
+        for name, value in (('STOP_WORDS', muse_engine.STOP_WORDS | {"moon"}),
+                            ('MODEL_CACHE_VERSION', muse_engine.MODEL_CACHE_VERSION + 1)):
+            with mock.patch.object(muse_engine, name, value):
+                self.assertNotEqual(model_cache_path(self.path, 2), path)
+                self.assertIsNone(load_cached_model(self.path, 2))
+        with mock.patch.object(muse_engine, 'STOP_WORDS', muse_engine.STOP_WORDS | {"moon"}):
+            model = preprocess_text(self.path)
+            self.assertFalse(any("moon" in key for key in model))
+            self.assertEqual(self.cached_files(), [os.path.basename(model_cache_path(self.path, 2))])
+        self.assertIsNone(load_cached_model(self.path, 2))  # Pruned as unloadable
+    
+    def test_corpus_change_invalidates(self):
+        preprocess_text(self.path)
+        with open(self.path, encoding='utf-8') as f:
+            text = f.read()
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.write("zebra quagga " + text)  # An edit, not an append
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertIsNone(load_cached_model(self.path, 2))
+        model = preprocess_text(self.path)
+        self.assertIn(("zebra", "quagga"), model)
+        self.assertEqual(dict(model.items()), dict(preprocess_text(self.path, use_cache=False).items()))
+        
+        # Unchanged contents under a new mtime still hit the cache
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10 ** 9))
+        self.assertIsNotNone(load_cached_model(self.path, 2))
+
+class ModelRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._environment = mock.patch.dict(os.environ, {'MARKOVSMUSE_CACHE_DIR': self._directory.name})
+        self._environment.start()
+        self.paths = []
+        for i in range(3):
+            os.mkdir(os.path.join(self._directory.name, str(i)))
+            self.paths.append(write_corpus(os.path.join(self._directory.name, str(i)), lines=200, seed=i))
+    
+    def tearDown(self):
+        self._environment.stop()
+        self._directory.cleanup()
+    
+    def test_least_recently_used_models_are_evicted_over_budget(self):
+        registry = ModelRegistry(max_bytes=1 << 40)
+        first, second, third = self.paths
+        models = {path: registry.get(path) for path in self.paths}
+        self.assertEqual(registry.stats()['misses'], 3)
+        sizes = {path: size for (path, *_), (_, size, _) in registry._models.items()}
+        self.assertEqual(registry.stats()['bytes'], sum(sizes.values()))
+        
+        # Room for any two, with slack: a model reloaded from the disk cache sizes up a
+        # little differently
+        registry.set_budget(sum(sizes.values()) - min(sizes.values()) // 2)
+        self.assertEqual(list(key[0] for key in registry._models), [second, third])
+        self.assertEqual(registry.stats()['evictions'], 1)
+        
+        self.assertIs(registry.get(second), models[second])  # Now the most recently used
+        self.assertIsNot(registry.get(first), models[first])  # Rebuilt, evicting third
+        self.assertEqual(list(key[0] for key in registry._models), [second, first])
+        self.assertLessEqual(registry.stats()['bytes'], registry.max_bytes)
+        
+        registry.set_budget(0)  # The newest model is always kept
+        self.assertEqual(list(key[0] for key in registry._models), [first])
+        self.assertEqual(registry.stats()['bytes'], registry._models[(first, 2, False, False)][1])
+    
+    def test_counters(self):
+        registry = ModelRegistry()
+        path = self.paths[0]
+        model = registry.get(path)
+        self.assertIs(registry.get(path), model)
+        self.assertIs(registry.get(path), model)
+        registry.get(path, depth=3)
+        self.assertEqual({name: registry.stats()[name] for name in ('models', 'hits', 'misses', 'reloads')},
+                         {'models': 2, 'hits': 2, 'misses': 2, 'reloads': 0})
+        
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write("zebra quagga moon\n")
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        reloaded = registry.get(path)
+        self.assertIsNot(reloaded, model)
+        self.assertIn(("zebra", "quagga"), reloaded)
+        self.assertEqual({name: registry.stats()[name] for name in ('models', 'hits', 'misses', 'reloads')},
+                         {'models': 2, 'hits': 2, 'misses': 3, 'reloads': 1})
+        
+        registry.clear()
+        self.assertEqual((registry.stats()['models'], registry.stats()['bytes']), (0, 0))
+        self.assertEqual(registry.stats()['misses'], 3)  # Counters are kept
+
+class ReverseChainTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = write_corpus(self._directory.name, lines=300)
+    
+    def tearDown(self):
+        self._directory.cleanup()
+    
+    def test_chain_counts_every_order(self):
+        for depth in (1, 2, 3):
+            for options in ({}, {'compact': True}, {'backoff': True}):
+                model = preprocess_text(self.path, depth=depth, use_cache=False, **options)
+                expected = {}
+                grams = [key + (word,) + (count,) for key in model for word, count in model[key].items()]
+                head = model.counter_state['head']
+                grams += [tuple(head[:position + 1]) + (1,) for position in range(1, depth)]
+                for *gram, count in grams:
+                    for start in range(1, len(gram)):
+                        before = expected.setdefault(tuple(gram[start:]), {})
+                        before[gram[start - 1]] = before.get(gram[start - 1], 0) + count
+                self.assertEqual(model.reverse_chain().table(), expected)
+    
+    def test_updates_equal_a_full_build(self):
+        for options in ({}, {'compact': True}, {'backoff': True}):
+            model = preprocess_text(self.path, use_cache=False, **options)
+            updated = update_model(model, "zebra quagga moon\nthe moon and the zebra")
+            rebuilt = type(model)(depth=model.depth, **updated.payload())
+            self.assertEqual(updated.reverse_chain().table(), rebuilt.reverse_chain().table())
+            self.assertIn("zebra", updated.reverse_chain())
+            self.assertNotIn("zebra", model.reverse_chain())
+            rng = random.Random(5)
+            words = sorted(updated.features)
+            for _ in range(300):
+                line = [rng.choice(words) for _ in range(rng.randrange(1, 3))]
+                seed = rng.random()
+                self.assertEqual(updated.reverse_chain().sample_before(line, random.Random(seed)),
+                                 rebuilt.reverse_chain().sample_before(line, random.Random(seed)))
+    
+    def test_update_repacks_when_word_ids_outgrow_their_bits(self):
+        model = preprocess_text(self.path, use_cache=False)
+        letters = 'abcdefghij'
+        new_words = ' '.join("zz" + letters[i // 100] + letters[i // 10 % 10] + letters[i % 10]
+                             for i in range(2 * len(model.features)))
+        updated = update_model(model, new_words)
+        self.assertGreater(updated.reverse_chain()._bits, model.reverse_chain()._bits)
+        rebuilt = type(model)(depth=model.depth, **updated.payload())
+        self.assertEqual(updated.reverse_chain().table(), rebuilt.reverse_chain().table())
+    
+    def test_models_are_built_with_their_reverse_chain(self):
+        for options in ({}, {'compact': True}, {'backoff': True}):
+            model = preprocess_text(self.path, use_cache=False, **options)
+            self.assertGreater(model.nbytes(), model.reverse_chain().nbytes())
+
+class ModelUpdateTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._environment = mock.patch.dict(os.environ, {'MARKOVSMUSE_CACHE_DIR': self._directory.name})
+        self._environment.start()
+        self.path = write_corpus(self._directory.name, lines=300)
+    
+    def tearDown(self):
+        self._environment.stop()
+        self._directory.cleanup()
+    
+    def assertSameModel(self, model, expected):
+        self.assertIs(type(model), type(expected))
+        payload, expected_payload = model.payload(), expected.payload()
+        self.assertEqual(list(payload['transition_matrix'].items()),
+                         list(expected_payload['transition_matrix'].items()))
+        self.assertEqual(list(payload['line_starts']), list(expected_payload['line_starts']))
+        self.assertEqual({ending: tuple(bucket) for ending, bucket in payload['rhyme_index'].items()},
+                         {ending: tuple(bucket) for ending, bucket in expected_payload['rhyme_index'].items()})
+        self.assertEqual(dict(model.features), dict(expected.features))
+        self.assertEqual(model.reverse_chain().table(), expected.reverse_chain().table())
+        
+        rng = random.Random(3)
+        keys = list(expected) + [("moon",) * model.depth, ("night",)]
+        for _ in range(200):
+            key, seed = rng.choice(keys), rng.random()
+            self.assertEqual(model.sample_next(key, random.Random(seed)),
+                             expected.sample_next(key, random.Random(seed)))
+        for mode in ('uniform', 'weighted', 'line'):
+            self.assertEqual(model.random_context(random.Random(mode), mode),
+                             expected.random_context(random.Random(mode), mode))
+        for seed in range(5):
+            self.assertEqual(
+                generate_poem("", 8, model, ["Rhyme"], depth=model.depth, seed=seed, use_cache=False),
+                generate_poem("", 8, expected, ["Rhyme"], depth=model.depth, seed=seed, use_cache=False))
+    
+    def test_appended_corpus_equals_a_full_build(self):
+        with open(self.path, encoding='utf-8') as f:
+            corpus = f.read()
+        extra = os.path.join(self._directory.name, "extra")
+        os.mkdir(extra)
+        with open(write_corpus(extra, lines=60, seed=8), encoding='utf-8') as f:
+            appended_text = "zebra quagga moon the night\nXIV quagga\n" + f.read()
+        for depth in (1, 2, 3):
+            for options in ({}, {'compact': True}, {'backoff': True}):
+                with open(self.path, 'w', encoding='utf-8') as f:
+                    f.write(corpus)
+                preprocess_text(self.path, depth=depth, **options)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(appended_text)
+                appended = preprocess_text(self.path, depth=depth, **options)
+                self.assertSameModel(appended, preprocess_text(self.path, depth=depth, use_cache=False,
+                                                               **options))
+    
+    def test_updates_equal_a_full_build(self):
+        for depth in (1, 2, 3):
+            for options in ({}, {'compact': True}, {'backoff': True}):
+                model = preprocess_text(self.path, depth=depth, use_cache=False, **options)
+                updated = update_model(model, "zebra quagga moon\nthe moon and the zebra\n" * 3)
+                self.assertSameModel(updated, type(model)(depth=depth, **updated.payload()))
+                self.assertNotIn(("zebra",) * depth, model)
+    
+    def test_compact_update_repacks_keys_for_new_words(self):
+        letters = 'abcdefghij'
+        for depth in (1, 2, 3):
+            model = preprocess_text(self.path, depth=depth, use_cache=False, compact=True)
+            new_words = ' '.join("zz" + letters[i // 100] + letters[i // 10 % 10] + letters[i % 10]
+                                 for i in range(len(model.words) + 50))
+            updated = update_model(model, "the moon " + new_words + "\nXIV " + new_words[::-1])
+            self.assertGreater(updated._base, model._base)
+            self.assertSameModel(updated, type(model)(depth=depth, **updated.payload()))
+
+class MetaphorLexiconTest(unittest.TestCase):
+    def test_keys_match_whole_words_only(self):
+        lexicon = MetaphorLexicon({"sun": "golden eye", "moon": "pale coin"})
+        self.assertEqual(lexicon.substitute("the sun will sunder sunlight, sun."),
+                         "the golden eye will sunder sunlight, golden eye.")
+        self.assertEqual(lexicon.substitute("Sun and moonrise and moon"),
+                         "Sun and moonrise and pale coin")
+    
+    def test_longest_key_wins(self):
+        lexicon = MetaphorLexicon({"sun": "star", "sun dog": "halo", "sun dog rising": "omen"})
+        self.assertEqual(lexicon.substitute("a sun dog rising, a sun dog, a sun dogs"),
+                         "a omen, a halo, a star dogs")
+        # Substituted text is never matched again
+        self.assertEqual(MetaphorLexicon({"sun": "sun dog", "dog": "hound"}).substitute("sun dog"),
+                         "sun dog hound")
+    
+    def test_device_uses_the_given_lexicon(self):
+        lexicon = MetaphorLexicon({"night": "velvet", "the night": "the dark"})
+        self.assertEqual(apply_poetic_devices("in the night\nnightfall", ["Metaphor"], metaphors=lexicon),
+                         "in the dark\nnightfall")
+
+class ResultCacheTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = write_corpus(self._directory.name, lines=300)
+        self._cache = mock.patch.object(muse_engine, 'result_cache', ResultCache())
+        self.cache = self._cache.start()
+    
+    def tearDown(self):
+        self._cache.stop()
+        self._directory.cleanup()
+    
+    def test_cached_poems_equal_fresh_ones(self):
+        for options in ({}, {'compact': True}, {'backoff': True}):
+            model = preprocess_text(self.path, use_cache=False, **options)
+            for devices in ([], ["Rhyme"], ["Alliteration", "Metaphor", "Repetition"]):
+                for seed in range(3):
+                    fresh = generate_poem(None, 6, model, devices, seed=seed, use_cache=False)
+                    first = generate_poem(None, 6, model, devices, seed=seed)
+                    again = generate_poem(None, 6, model, devices, seed=seed)
+                    self.assertEqual(first, fresh)
+                    self.assertEqual(again, fresh)
+        self.assertEqual(self.cache.stats()['hits'], self.cache.stats()['misses'])
+    
+    def test_key_covers_depth_devices_and_model(self):
+        model = preprocess_text(self.path, use_cache=False)
+        updated = update_model(model, "zebra quagga moon")
+        self.assertNotEqual(model_fingerprint(updated), model_fingerprint(model))
+        variants = [(model, ["Rhyme"]), (model, ["Rhyme", "Metaphor"]), (model, []),
+                    (preprocess_text(self.path, depth=3, use_cache=False), ["Rhyme"]),
+                    (updated, ["Rhyme"])]
+        for variant, devices in variants:
+            generate_poem(None, 4, variant, devices, depth=2, seed=1)
+        self.assertEqual(self.cache.stats()['poems'], len(variants))
+        self.assertEqual(self.cache.stats()['hits'], 0)
+        
+        # Same devices in another order are the same request
+        generate_poem(None, 4, model, ["Metaphor", "Rhyme", "Rhyme"], seed=1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+def original_alliteration(lines):
+    """The Alliteration device as it was before alliterate_line, for comparison"""
+    new_lines = []
+    for line in lines:
+        clusters = {sound: [] for sound in ('ch', 'sh', 'th', 'wh', 'ph')
+                    + tuple('bcdfghjklmnpqrstvwxyz')}
+        words = [w for w in line.split() if len(w) >= 2]
+        for word in words:
+            if word.lower()[:2] in clusters and len(word) >= 3:
+                clusters[word.lower()[:2]].append(word)
+            elif word.lower()[0] in clusters and len(word) >= 3:
+                clusters[word.lower()[0]].append(word)
+        most_common_sound, max_words = None, 1
+        for sound, word_list in clusters.items():
+            if len(word_list) > max_words:
+                most_common_sound, max_words = sound, len(word_list)
+        if most_common_sound:
+            alliterative_words = clusters[most_common_sound][:3]
+            remaining_words = [w for w in words if w not in alliterative_words and len(w) >= 3][:2]
+            new_lines.append(' '.join(alliterative_words + remaining_words).capitalize())
+        else:
+            new_lines.append(line)
+    return new_lines
+
+class AlliterationTest(unittest.TestCase):
+    def test_matches_the_original_device(self):
+        rng = random.Random(11)
+        vocabulary = ["thorn", "Thine", "tide", "shade", "Sharp", "bright", "Bold", "by", "a",
+                      "moon", "mist", "echo", "over", "chime", "church", "phantom", "whisper",
+                      "wind", "yarn", "zeal", "stone", "star", "éclair", "x", "quiet", "Quill"]
+        table = build_feature_table(word.lower() for word in vocabulary[::2])
+        for _ in range(300):
+            lines = [' '.join(rng.choice(vocabulary) for _ in range(rng.randrange(0, 9)))
+                     for _ in range(rng.randrange(1, 6))]
+            expected = '\n'.join(original_alliteration(lines))
+            for features in (None, table):
+                self.assertEqual(apply_poetic_devices('\n'.join(lines), ["Alliteration"], features),
+                                 expected)
+
+if __name__ == "__main__":
+    unittest.main()
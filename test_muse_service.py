@@ -0,0 +1,100 @@
+"""Tests for muse_service: python -m pytest (or python -m unittest)"""
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import muse_service
+from muse_service import MAX_HEADER_BYTES, PoemService
+
+async def request(port, method, path, body=b'', headers=()):
+    """Send one request on a fresh connection; returns (status, JSON payload)"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    head = [f"{method} {path} HTTP/1.1", "Host: localhost", "Connection: close",
+            *headers]
+    if not any(header.lower().startswith('content-length') for header in headers):
+        head.append(f"Content-Length: {len(body)}")
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    await writer.wait_closed()
+    status_line, _, payload = response.partition(b'\r\n\r\n')
+    return int(status_line.split()[1]), json.loads(payload)
+
+class ServiceRoundTripTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._patches = [mock.patch.dict(os.environ, {'MARKOVSMUSE_CACHE_DIR': self._directory.name}),
+                         mock.patch.object(muse_service, 'poet_files', {"Robert Frost": "frost.txt"})]
+        for patch in self._patches:
+            patch.start()
+        self.service = PoemService(port=0, workers=1)
+        await self.service.start()
+    
+    async def asyncTearDown(self):
+        await self.service.stop()
+        for patch in reversed(self._patches):
+            patch.stop()
+        self._directory.cleanup()
+    
+    async def generate(self, **fields):
+        return await request(self.service.port, 'POST', '/generate', json.dumps(fields).encode())
+    
+    async def test_generate_round_trip(self):
+        status, payload = await request(self.service.port, 'GET', '/poets')
+        self.assertEqual((status, payload['poets']), (200, ["Robert Frost"]))
+        
+        status, first = await self.generate(poet="Robert Frost", lines=4, devices=["Rhyme"], seed=42)
+        self.assertEqual(status, 200)
+        self.assertEqual(first['seed'], 42)
+        self.assertTrue(first['text'])
+        status, second = await self.generate(poet="Robert Frost", lines=4, devices=["Rhyme"], seed=42)
+        self.assertEqual(second['text'], first['text'])
+        
+        status, metrics = await request(self.service.port, 'GET', '/metrics')
+        self.assertEqual(metrics['latency_ms']['POST /generate']['count'], 2)
+    
+    async def test_rejects_bad_requests(self):
+        for fields in ({'poet': "Robert Frost", 'lines': True},
+                       {'poet': "Robert Frost", 'seed': False},
+                       {'poet': "Nobody"}):
+            status, payload = await self.generate(**fields)
+            self.assertEqual(status, 400, fields)
+        
+        for length in ("-1", "+4", "1_0", "x", "\xb2"):
+            status, _ = await request(self.service.port, 'POST', '/generate', b'{}',
+                                      headers=[f"Content-Length: {length}"])
+            self.assertEqual(status, 400, length)
+        
+        status, _ = await request(self.service.port, 'GET', '/health',
+                                  headers=["X-Padding: " + "a" * MAX_HEADER_BYTES])
+        self.assertEqual(status, 413)
+        status, _ = await request(self.service.port, 'GET', '/health')
+        self.assertEqual(status, 200)
+    
+    async def test_rejects_chunked_bodies_and_closes(self):
+        reader, writer = await asyncio.open_connection('127.0.0.1', self.service.port)
+        writer.write(b"POST /generate HTTP/1.1\r\nHost: localhost\r\n"
+                     b"Transfer-Encoding: chunked\r\n\r\n2\r\n{}\r\n0\r\n\r\n")
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), 10)  # Returns once the server closes
+        writer.close()
+        await writer.wait_closed()
+        head, _, payload = response.partition(b'\r\n\r\n')
+        self.assertEqual(int(head.split()[1]), 501)
+        self.assertIn(b"Connection: close", head)
+        self.assertIn("Content-Length", json.loads(payload)['error'])
+    
+    def test_backoff_is_off_by_default(self):
+        self.assertFalse(self.service.backoff)
+        with mock.patch.object(muse_service, 'run_service') as run_service:
+            with mock.patch.object(muse_service.asyncio, 'run', lambda coroutine: coroutine.close()):
+                muse_service.service_main([])
+                muse_service.service_main(['--backoff'])
+        self.assertEqual([call.args[-1] for call in run_service.call_args_list], [False, True])
+
+if __name__ == "__main__":
+    unittest.main()
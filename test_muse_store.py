@@ -0,0 +1,100 @@
+"""Tests for muse_store: python -m pytest (or python -m unittest)"""
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+import muse_store
+from muse_store import PoemStore, SearchResults
+
+class SearchTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.store = PoemStore(self._directory.name)
+        rng = random.Random(3)
+        vocabulary = [rng.choice('bcdklmrst') + rng.choice('aeiou') + rng.choice('dkmnrst')
+                      for _ in range(60)]
+        with self.store._db:
+            for i in range(600):
+                text = '\n'.join(' '.join(rng.choice(vocabulary) for _ in range(5))
+                                 for _ in range(3))
+                self.store._db.execute(
+                    "INSERT INTO poems (poet, date, favorite, text) VALUES (?, ?, ?, ?)",
+                    (rng.choice(["Robert Frost", "Edgar Allan Poe"]),
+                     f"2025-01-{rng.randrange(1, 29):02d} 12:00:00", rng.random() < 0.2, text))
+    
+    def tearDown(self):
+        self.store.close()
+        self._directory.cleanup()
+    
+    def listed(self, query, sort):
+        """Search results with every query answered up front"""
+        self.store._invalidate()
+        with mock.patch.object(muse_store, 'LAZY_SEARCH_MIN', float('inf')):
+            return self.store.search(query, sort)
+    
+    def test_lazy_results_equal_listed_results(self):
+        # Free probes check the ordering against the index; costly ones fetch every match
+        for probe_cost in (0, float('inf')):
+            for sort in muse_store.SORT_ORDERS:
+                for query in ("b", "ro", "s ma", "e", "zzz"):
+                    expected = self.listed(query, sort)
+                    self.store._invalidate()
+                    with mock.patch.multiple(muse_store, LAZY_SEARCH_MIN=10, PROBE_COST=probe_cost):
+                        results = self.store.search(query, sort)
+                        self.assertEqual(len(results), len(expected))
+                        if not expected:
+                            continue
+                        self.assertIsInstance(results, SearchResults)
+                        self.assertEqual(results[:50], expected[:50])
+                        self.assertEqual(results[len(expected) // 2], expected[len(expected) // 2])
+                        self.assertIn(expected[-1], results)
+                        self.assertEqual(list(results), expected)
+                        self.assertEqual(results.index(expected[-1]), len(expected) - 1)
+    
+    def test_narrowing_keeps_sort_order(self):
+        self.store.search("b", "Poet A-Z")
+        narrowed = self.store.search("ba", "Poet A-Z")
+        self.assertEqual(list(narrowed), self.listed("ba", "Poet A-Z"))
+        self.assertEqual(list(self.store.search("bad", "Poet A-Z")), self.listed("bad", "Poet A-Z"))
+
+class SaveTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.store = PoemStore(self._directory.name)
+    
+    def tearDown(self):
+        self.store.close()
+        self._directory.cleanup()
+    
+    def test_saves_in_the_same_second_get_their_own_files(self):
+        poems = [{'text': f"poem {i}", 'poet': "Robert Frost", 'date': "2025-01-01 12:00:00",
+                  'devices': [], 'favorite': False} for i in range(3)]
+        with mock.patch.object(muse_store, 'datetime') as clock:
+            clock.now.return_value.strftime.return_value = "20250101_120000"
+            saved = [self.store.save(poem) for poem in poems]
+        self.assertEqual([os.path.basename(path) for _, path in saved],
+                         ["poem_20250101_120000.json", "poem_20250101_120000_2.json",
+                          "poem_20250101_120000_3.json"])
+        self.assertEqual(len({poem_id for poem_id, _ in saved}), 3)
+        for (poem_id, path), poem in zip(saved, poems):
+            with open(path, encoding='utf-8') as f:
+                self.assertEqual(json.load(f), poem)
+            self.assertEqual(self.store.get(poem_id)['text'], poem['text'])
+    
+    def test_sync_updates_rows_in_place(self):
+        poem_id, path = self.store.save({'text': "old", 'poet': "Robert Frost",
+                                         'date': "2025-01-01 12:00:00"})
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'text': "new text", 'poet': "Robert Frost", 'date': "2025-01-01 12:00:00"}, f)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.store.sync(), (0, 1, 0))
+        self.assertEqual(self.store.get(poem_id)['text'], "new text")
+        self.assertEqual(self.store.count(), 1)
+        self.assertEqual(list(self.store.search("new")), [poem_id])
+
+if __name__ == "__main__":
+    unittest.main()